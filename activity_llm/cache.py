@@ -0,0 +1,77 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+class SQLiteCache:
+    def __init__(self, path: str, ttl: float = None, max_entries: int = None):
+        """
+        Persistent key-value cache in a SQLite file, with optional expiry and LRU eviction.
+
+        Args:
+            path (str): Path to the SQLite file (created if it does not exist)
+            ttl (float): Time in seconds after which an entry expires. None means entries never expire.
+            max_entries (int): Maximum number of entries. The least recently used entries are evicted first.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache "
+            "(key TEXT PRIMARY KEY, value TEXT, created_at REAL, last_access REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)")
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(*parts):
+        """Hash arbitrary (JSON-serializable) parts into a cache key."""
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """Return the cached value for `key`, or None if it is missing or expired."""
+        row = self.conn.execute("SELECT value, created_at FROM cache WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute("UPDATE cache SET last_access = ? WHERE key = ?", (now, key))
+        self.conn.commit()
+        return json.loads(row[0])
+
+    def set(self, key: str, value):
+        """Store a JSON-serializable value under `key` and evict old entries if the cache is full."""
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, created_at, last_access) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), now, now),
+        )
+        if self.ttl is not None:
+            self.conn.execute("DELETE FROM cache WHERE created_at < ?", (now - self.ttl,))
+        if self.max_entries is not None:
+            self.conn.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    @property
+    def hit_rate(self):
+        requests = self.hits + self.misses
+        return self.hits / requests if requests > 0 else 0.0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate, "entries": len(self)}
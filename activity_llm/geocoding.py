@@ -0,0 +1,126 @@
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from geopy.geocoders import Nominatim
+
+from activity_llm.cache import SQLiteCache
+from activity_llm.profiling import profiler
+from activity_llm.rate_limit import TokenBucket, call_with_retries
+from activity_llm.surrounding_poi import POIIndex, create_bounding_box, haversine_distance
+
+ADDRESS_NOT_FOUND = "Address not found"
+ADDRESS_COLUMNS = ["addr:street", "addr:housenumber", "addr:postcode", "addr:city"]
+
+
+class OfflineAddressLookup:
+    def __init__(self, address_path: str, max_distance: float = 100):
+        """
+        Resolve addresses from a local file instead of Nominatim.
+
+        Args:
+            address_path (str): File readable by geopandas (e.g. GeoJSON) with point geometries and either an
+                "address" column or OSM address tags (addr:street, addr:housenumber, addr:postcode, addr:city)
+            max_distance (float): Maximum distance in meters between the coordinates and the address point
+        """
+        addresses = gpd.read_file(address_path)
+        if "address" not in addresses.columns:
+            parts = addresses.reindex(columns=ADDRESS_COLUMNS).fillna("").astype(str)
+            street = (parts["addr:street"] + " " + parts["addr:housenumber"]).str.strip()
+            city = (parts["addr:postcode"] + " " + parts["addr:city"]).str.strip()
+            addresses["address"] = (street + ", " + city).str.strip(", ")
+        addresses = addresses[addresses["address"].fillna("") != ""]
+
+        self.address_path = address_path
+        self.max_distance = max_distance
+        self.index = POIIndex(
+            pd.DataFrame(
+                {
+                    "lon": addresses.geometry.x.values,
+                    "lat": addresses.geometry.y.values,
+                    "address": addresses["address"].values,
+                }
+            )
+        )
+
+    @property
+    def name(self):
+        """Identity of the lookup for cache keys (the file and the distance cutoff)."""
+        return f"offline:{os.path.abspath(self.address_path)}:{self.max_distance}"
+
+    def __call__(self, latitude: float, longitude: float):
+        _, idx = self.index.query_bboxes([create_bounding_box(latitude, longitude, self.max_distance)])
+        if len(idx) == 0:
+            return ADDRESS_NOT_FOUND
+        distance = haversine_distance(longitude, latitude, self.index.lons[idx], self.index.lats[idx])
+        if distance.min() > self.max_distance:
+            return ADDRESS_NOT_FOUND
+        return self.index.pois["address"].iloc[idx[np.argmin(distance)]]
+
+
+class ReverseGeocoder:
+    def __init__(
+        self,
+        cache: SQLiteCache = None,
+        snap_decimals: int = 4,
+        requests_per_minute: float = 60,
+        offline_backend: OfflineAddressLookup = None,
+        user_agent: str = "geoapi",
+        **nominatim_kwargs,
+    ):
+        """
+        Reverse geocoding with one reused Nominatim client, a persistent cache and rate limiting.
+
+        Args:
+            cache (SQLiteCache): Optional persistent cache for the addresses, keyed by the backend (offline file or
+                Nominatim domain) and the coordinates. Coordinates without address are not cached.
+            snap_decimals (int): Coordinates are rounded to this many decimals for the cache key (4 decimals ≈ 11m)
+            requests_per_minute (float): Maximum request rate (Nominatim's usage policy allows one per second)
+            offline_backend (OfflineAddressLookup): If given, addresses are resolved from a local file and no
+                requests are sent to Nominatim
+            user_agent (str): User agent for Nominatim
+            nominatim_kwargs: Further arguments for `geopy.geocoders.Nominatim`, e.g. `domain` for a local server
+        """
+        self.cache = cache
+        self.snap_decimals = snap_decimals
+        self.offline_backend = offline_backend
+        self.geolocator = Nominatim(user_agent=user_agent, **nominatim_kwargs) if offline_backend is None else None
+        # no bursts: requests are spread evenly over time
+        self.rate_limiter = TokenBucket(requests_per_minute, capacity=1)
+
+    @property
+    def backend_name(self):
+        if self.offline_backend is not None:
+            return self.offline_backend.name
+        return f"nominatim:{self.geolocator.domain}"
+
+    def _reverse(self, latitude: float, longitude: float):
+        if self.offline_backend is not None:
+            return self.offline_backend(latitude, longitude)
+        self.rate_limiter.acquire()
+        with profiler.timed("nominatim"):
+            location = call_with_retries(self.geolocator.reverse, (latitude, longitude), exactly_one=True)
+        return location.address if location else ADDRESS_NOT_FOUND
+
+    def __call__(self, latitude: float, longitude: float):
+        latitude, longitude = round(latitude, self.snap_decimals), round(longitude, self.snap_decimals)
+        if self.cache is not None:
+            key = self.cache.make_key("reverse", self.backend_name, latitude, longitude)
+            address = self.cache.get(key)
+            if address is not None:
+                return address
+
+        address = self._reverse(latitude, longitude)
+
+        # missing addresses are requested again, e.g. from another backend that shares the cache
+        if self.cache is not None and address != ADDRESS_NOT_FOUND:
+            self.cache.set(key, address)
+        return address
+
+    def reverse_many(self, latitudes, longitudes):
+        """Resolve the addresses of many coordinates. Identical (snapped) coordinates are only requested once."""
+        snapped = [
+            (round(lat, self.snap_decimals), round(lon, self.snap_decimals)) for lat, lon in zip(latitudes, longitudes)
+        ]
+        addresses = {coords: self(*coords) for coords in dict.fromkeys(snapped)}
+        return [addresses[coords] for coords in snapped]
@@ -1,47 +1,51 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
 import pandas as pd
 import trackintel as ti
 import geopandas as gpd
-from geopy.geocoders import Nominatim
 from trackintel.analysis.location_identification import location_identifier
 
+from activity_llm.geocoding import ReverseGeocoder
+from activity_llm.surrounding_poi import POIIndex, create_bounding_box, haversine_distance
+
+_default_geocoder = None
+
 
 def get_address_from_coords(latitude, longitude):
-    geolocator = Nominatim(user_agent="geoapi")
-    location = geolocator.reverse((latitude, longitude), exactly_one=True)
-    return location.address if location else "Address not found"
+    global _default_geocoder
+    if _default_geocoder is None:
+        _default_geocoder = ReverseGeocoder()
+    return _default_geocoder(latitude, longitude)
 
 
-def location_identifier_with_grouping(
-    all_sp: gpd.GeoDataFrame,
+def sufficiently_visited_locations(all_sp: gpd.GeoDataFrame, min_visits_whole_time: int = 5):
+    """Location ids that were visited more than `min_visits_whole_time` times overall."""
+    visit_per_location = all_sp.groupby("location_id")["location_id"].count()
+    return set(visit_per_location[visit_per_location > min_visits_whole_time].index)
+
+
+def monthly_location_identifier(
+    sp: gpd.GeoDataFrame,
     loc_identify_kwargs: dict,
-    min_visits_whole_time: int = 5,
     min_visit_rate_for_month: float = 0.2,
     min_samples_for_month: int = 5,
 ):
     """
-    Identifies home and work locations grouped by month.
-
-    Parameters:
-    - sp (GeoDataFrame): Input GeoDataFrame with 'started_at', 'finished_at', and point geometry.
-    - loc_identify_kwargs (dict): Arguments for the `location_identifier` function.
-    - min_visits (int): Minimum number of occurrences in a month to identify a location as home/work.
+    Runs `location_identifier` separately for each user and month.
 
     Returns:
-    - GeoDataFrame with a 'purpose' column containing 'home', 'work', or NaN.
+    - GeoDataFrame with a 'month' column and a 'purpose' column containing 'home', 'work', or None.
     """
-
-    # prefilter for the ones that have min_visits visits overall
-    visit_per_location = all_sp.groupby("location_id")["location_id"].count()
-    sufficiently_visited_locs = list(visit_per_location[visit_per_location > min_visits_whole_time].index)
-    sp = all_sp[all_sp["location_id"].isin(sufficiently_visited_locs)]
-
-    # group by month
+    sp = sp.copy()
+    # group by month (per user)
     sp["month"] = sp["started_at"].dt.to_period("M")
 
     # Placeholder for combined results
     results = []
 
-    for month, group in sp.groupby("month"):
+    for (user_id, month), group in sp.groupby(["user_id", "month"]):
         if len(group) < min_samples_for_month:
             # print(f"Skip month {month} bc not enough data")
             group["purpose"] = None
@@ -57,7 +61,37 @@ def location_identifier_with_grouping(
 
         results.append(group)
 
-    results = pd.concat(results).drop("month", axis=1)
+    if not results:
+        return sp.assign(purpose=None)
+    return pd.concat(results)
+
+
+def location_identifier_with_grouping(
+    all_sp: gpd.GeoDataFrame,
+    loc_identify_kwargs: dict,
+    min_visits_whole_time: int = 5,
+    min_visit_rate_for_month: float = 0.2,
+    min_samples_for_month: int = 5,
+):
+    """
+    Identifies home and work locations grouped by month.
+
+    Parameters:
+    - sp (GeoDataFrame): Input GeoDataFrame with 'started_at', 'finished_at', and point geometry.
+    - loc_identify_kwargs (dict): Arguments for the `location_identifier` function.
+    - min_visits (int): Minimum number of occurrences in a month to identify a location as home/work.
+
+    Returns:
+    - GeoDataFrame with a 'purpose' column containing 'home', 'work', or NaN.
+    """
+
+    # prefilter for the ones that have min_visits visits overall
+    sufficiently_visited_locs = sufficiently_visited_locations(all_sp, min_visits_whole_time)
+    sp = all_sp[all_sp["location_id"].isin(sufficiently_visited_locs)]
+
+    results = monthly_location_identifier(
+        sp, loc_identify_kwargs, min_visit_rate_for_month, min_samples_for_month
+    ).drop("month", axis=1)
     work_home_dict = results.set_index("location_id")["purpose"].dropna().to_dict()
     all_sp["purpose"] = all_sp["location_id"].map(work_home_dict)
 
@@ -65,13 +99,13 @@ def location_identifier_with_grouping(
     return all_sp
 
 
-def find_basic_locations(
+def identify_locations(
     sp: gpd.GeoDataFrame,
     grouped_by_month: bool = True,
     loc_generate_kwargs: dict = {"epsilon": 100},
     loc_identify_kwargs: dict = {"method": "OSNA", "pre_filter": False},
 ):
-    assert sp.index.name == "id", "Staypoints must have an index named 'id'"
+    """Generate locations from staypoints and identify home and work (runs in the worker processes)."""
     sp, locs = ti.preprocessing.staypoints.generate_locations(sp, **loc_generate_kwargs)
 
     # identify work and home
@@ -79,15 +113,234 @@ def find_basic_locations(
         sp_w_purpose = location_identifier_with_grouping(sp, loc_identify_kwargs)
     else:
         sp_w_purpose = location_identifier(sp, **loc_identify_kwargs)
+    return sp_w_purpose, locs
+
+
+class IncrementalLocationIdentifier:
+    def __init__(
+        self,
+        state_dir: str,
+        loc_generate_kwargs: dict = {"epsilon": 100},
+        loc_identify_kwargs: dict = {"method": "OSNA", "pre_filter": False},
+        min_visits_whole_time: int = 5,
+        min_visit_rate_for_month: float = 0.2,
+        min_samples_for_month: int = 5,
+    ):
+        """
+        Home and work identification that is updated incrementally when new staypoints arrive.
+
+        The staypoints, locations and per-month identification results are persisted in `state_dir`. On an
+        update, new staypoints are assigned to the closest existing location of the same user within `epsilon`,
+        the remaining ones are clustered into new locations, and only the months that received new staypoints
+        (or contain locations that newly passed `min_visits_whole_time`) are identified again. Location centers
+        are not moved when staypoints are added.
+
+        Parameters:
+        - state_dir (str): Directory for the persisted state.
+        - Further parameters as in `find_basic_locations` and `location_identifier_with_grouping`.
+        """
+        os.makedirs(state_dir, exist_ok=True)
+        self.sp_path = os.path.join(state_dir, "staypoints.parquet")
+        self.locs_path = os.path.join(state_dir, "locations.parquet")
+        self.monthly_path = os.path.join(state_dir, "monthly_purposes.parquet")
+        self.loc_generate_kwargs = loc_generate_kwargs
+        self.loc_identify_kwargs = loc_identify_kwargs
+        self.min_visits_whole_time = min_visits_whole_time
+        self.min_visit_rate_for_month = min_visit_rate_for_month
+        self.min_samples_for_month = min_samples_for_month
+
+    def _load_state(self):
+        if not all(os.path.exists(path) for path in [self.sp_path, self.locs_path, self.monthly_path]):
+            return None
+        sp = gpd.read_parquet(self.sp_path)
+        sp = ti.io.from_geopandas.read_staypoints_gpd(sp.reset_index(), geom_col="geometry", tz="utc").set_index("id")
+        locs = gpd.read_parquet(self.locs_path)
+        return sp, locs, pd.read_parquet(self.monthly_path)
+
+    def _save_state(self, sp, locs, monthly):
+        sp.drop(columns="purpose", errors="ignore").to_parquet(self.sp_path)
+        locs.to_parquet(self.locs_path)
+        monthly.to_parquet(self.monthly_path)
+
+    def _identify_months(self, all_sp, months=None):
+        """Per-month results (id, user_id, month, location_id, purpose) for all or only the given (user, month) keys."""
+        sufficiently_visited_locs = sufficiently_visited_locations(all_sp, self.min_visits_whole_time)
+        sp = all_sp[all_sp["location_id"].isin(sufficiently_visited_locs)]
+        if months is not None:
+            sp = sp[pd.MultiIndex.from_arrays([sp["user_id"], _month_key(sp)]).isin(months)]
+        results = monthly_location_identifier(
+            sp, self.loc_identify_kwargs, self.min_visit_rate_for_month, self.min_samples_for_month
+        )
+        return pd.DataFrame(
+            {
+                "id": results.index.values,
+                "user_id": results["user_id"].values,
+                "month": _month_key(results).values,
+                "location_id": results["location_id"].values,
+                "purpose": results["purpose"].values,
+            }
+        )
+
+    def _assign_to_locations(self, new_sp, locs):
+        """Assign staypoints to the closest existing location of the same user within epsilon (else NaN)."""
+        epsilon = self.loc_generate_kwargs.get("epsilon", 100)
+        centers = gpd.GeoSeries(locs["center"])
+        index = POIIndex(pd.DataFrame({"lon": centers.x.values, "lat": centers.y.values}))
+        lons, lats = new_sp.geometry.x.values, new_sp.geometry.y.values
+        bboxes = [create_bounding_box(lat, lon, epsilon) for lon, lat in zip(lons, lats)]
+        query_idx, loc_idx = index.query_bboxes(bboxes)
+
+        distance = haversine_distance(lons[query_idx], lats[query_idx], index.lons[loc_idx], index.lats[loc_idx])
+        valid = (distance <= epsilon) & (locs["user_id"].values[loc_idx] == new_sp["user_id"].values[query_idx])
+        matches = pd.DataFrame(
+            {"sp": query_idx[valid], "location_id": locs.index.values[loc_idx[valid]], "distance": distance[valid]}
+        )
+        nearest = matches.sort_values("distance").drop_duplicates("sp")
+
+        location_id = np.full(len(new_sp), np.nan)
+        location_id[nearest["sp"].values] = nearest["location_id"].values
+        return new_sp.assign(location_id=location_id)
+
+    def update(self, sp: gpd.GeoDataFrame):
+        """
+        Add new staypoints and update the home and work identification.
+
+        Parameters:
+        - sp (GeoDataFrame): All staypoints or only the new ones, with an index named 'id'. Staypoints whose id
+          is already in the state are ignored.
+
+        Returns:
+        - Tuple of all staypoints with 'location_id' and 'purpose', and all locations.
+        """
+        state = self._load_state()
+        if state is None:
+            print("No incremental state found, identifying locations for all staypoints.")
+            all_sp, locs = ti.preprocessing.staypoints.generate_locations(sp, **self.loc_generate_kwargs)
+            monthly = self._identify_months(all_sp)
+        else:
+            all_sp, locs, monthly = state
+            new_sp = sp[~sp.index.isin(all_sp.index)].drop(columns=["location_id", "purpose"], errors="ignore")
+            print(f"Adding {len(new_sp)} new staypoints to {len(all_sp)} existing ones.")
+            if len(new_sp) == 0:
+                return self._with_purpose(all_sp, monthly), locs
+
+            # assign to existing locations, and cluster the remaining staypoints into new locations
+            new_sp = self._assign_to_locations(new_sp, locs)
+            unassigned = new_sp["location_id"].isna()
+            if unassigned.any():
+                clustered_sp, new_locs = ti.preprocessing.staypoints.generate_locations(
+                    new_sp[unassigned].drop(columns="location_id"), **self.loc_generate_kwargs
+                )
+                offset = locs.index.max() + 1 if len(locs) > 0 else 0
+                new_locs.index = new_locs.index + offset
+                new_sp.loc[unassigned, "location_id"] = clustered_sp["location_id"] + offset
+                locs = pd.concat([locs, new_locs])
+
+            previous_locs = sufficiently_visited_locations(all_sp, self.min_visits_whole_time)
+            all_sp = pd.concat([all_sp, new_sp])
+
+            # months with new staypoints, or with locations whose overall visit count crossed the threshold
+            changed_locs = previous_locs ^ sufficiently_visited_locations(all_sp, self.min_visits_whole_time)
+            affected = all_sp[all_sp.index.isin(new_sp.index) | all_sp["location_id"].isin(changed_locs)]
+            months = pd.MultiIndex.from_arrays([affected["user_id"], _month_key(affected)]).unique()
+            print(f"Identifying home and work again for {len(months)} user-months.")
+
+            keep = ~pd.MultiIndex.from_arrays([monthly["user_id"], monthly["month"]]).isin(months)
+            monthly = pd.concat([monthly[keep], self._identify_months(all_sp, months)], ignore_index=True)
+            # chronological order as in a full run, so that the purpose of the latest month wins
+            monthly = monthly.sort_values(["user_id", "month"], kind="stable", ignore_index=True)
+
+        self._save_state(all_sp, locs, monthly)
+        return self._with_purpose(all_sp, monthly), locs
+
+    @staticmethod
+    def _with_purpose(all_sp, monthly):
+        monthly = monthly.sort_values(["user_id", "month"], kind="stable")
+        work_home_dict = monthly.set_index("location_id")["purpose"].dropna().to_dict()
+        return all_sp.assign(purpose=all_sp["location_id"].map(work_home_dict))
+
+
+def _month_key(sp: gpd.GeoDataFrame):
+    return sp["started_at"].dt.strftime("%Y-%m")
+
+
+def _merge_user_locations(results: list):
+    """Combine per-user results and offset the location ids so that they are unique across users."""
+    all_sp, all_locs = [], []
+    offset = 0
+    for sp_w_purpose, locs in results:
+        sp_w_purpose = sp_w_purpose.copy()
+        sp_w_purpose["location_id"] = sp_w_purpose["location_id"] + offset
+        locs = locs.copy()
+        locs.index = locs.index + offset
+        all_sp.append(sp_w_purpose)
+        all_locs.append(locs)
+        if len(locs) > 0:
+            offset = locs.index.max() + 1
+    return pd.concat(all_sp), pd.concat(all_locs)
+
+
+def find_basic_locations(
+    sp: gpd.GeoDataFrame,
+    grouped_by_month: bool = True,
+    loc_generate_kwargs: dict = {"epsilon": 100},
+    loc_identify_kwargs: dict = {"method": "OSNA", "pre_filter": False},
+    geocoder: ReverseGeocoder = None,
+    n_workers: int = 1,
+    incremental_state_dir: str = None,
+):
+    """
+    Generate locations and identify home and work locations with their addresses.
+
+    Parameters:
+    - sp (GeoDataFrame): Staypoints (of one or many users) with an index named 'id'.
+    - grouped_by_month (bool): Identify home and work per month (see `location_identifier_with_grouping`).
+    - geocoder (ReverseGeocoder): Reverse geocoder for the addresses of home and work locations.
+    - n_workers (int): Number of processes. If larger than 1, the users are processed in parallel and the
+      location ids are made unique across users afterwards.
+    - incremental_state_dir (str): If given, results are persisted in this directory and only updated for new
+      staypoints (see `IncrementalLocationIdentifier`). Requires grouped_by_month, and runs in one process
+      (n_workers must be 1).
+
+    Returns:
+    - Tuple of staypoints with 'location_id' and 'purpose', locations, and a DataFrame of home and work locations.
+    """
+    assert sp.index.name == "id", "Staypoints must have an index named 'id'"
+    if incremental_state_dir is not None:
+        assert grouped_by_month, "Incremental identification is only implemented for grouped_by_month=True"
+        assert n_workers == 1, "Incremental identification runs in one process, set n_workers=1"
+        sp_w_purpose, locs = IncrementalLocationIdentifier(
+            incremental_state_dir, loc_generate_kwargs, loc_identify_kwargs
+        ).update(sp)
+    elif n_workers > 1:
+        user_sps = [user_sp for _, user_sp in sp.groupby("user_id")]
+        with ProcessPoolExecutor(n_workers) as executor:
+            results = executor.map(
+                identify_locations,
+                user_sps,
+                repeat(grouped_by_month),
+                repeat(loc_generate_kwargs),
+                repeat(loc_identify_kwargs),
+            )
+            sp_w_purpose, locs = _merge_user_locations(list(results))
+        print(f"Identified locations for {len(user_sps)} users with {n_workers} workers.")
+    else:
+        sp_w_purpose, locs = identify_locations(sp, grouped_by_month, loc_generate_kwargs, loc_identify_kwargs)
 
     # get dictionary of form {location_id: purpose} with work and home locations
     work_home_dict = sp_w_purpose.set_index("location_id")["purpose"].dropna().to_dict()
 
     # reverse geocoding:
-    home_work_result = []
-    for location_id, purpose in work_home_dict.items():
-        loc = locs.loc[location_id]
-        address = get_address_from_coords(loc.center.y, loc.center.x)
-        home_work_result.append({"location_id": location_id, "purpose": purpose, "address": address})
+    if geocoder is None:
+        geocoder = ReverseGeocoder()
+    home_work_locs = locs.loc[list(work_home_dict.keys())]
+    centers = gpd.GeoSeries(home_work_locs["center"])
+    addresses = geocoder.reverse_many(centers.y.values, centers.x.values)
+    home_work_result = [
+        {"user_id": user_id, "location_id": location_id, "purpose": purpose, "address": address}
+        for (location_id, purpose), user_id, address in zip(
+            work_home_dict.items(), home_work_locs["user_id"], addresses
+        )
+    ]
 
     return sp_w_purpose, locs, pd.DataFrame(home_work_result)
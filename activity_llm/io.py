@@ -1,4 +1,11 @@
 import os
+import json
+import time
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import count
 import numpy as np
 import geopandas as gpd
 import pandas as pd
@@ -6,7 +13,6 @@ from xml.etree import ElementTree as ET
 from shapely.geometry import Point
 import trackintel as ti
 import shapely
-from datetime import datetime
 
 modes = [
     "Driving",
@@ -18,13 +24,89 @@ modes = [
     "Running",
 ]
 
+KML_NAMESPACE = {"kml": "http://www.opengis.net/kml/2.2"}
+PLACEMARK_TAG = "{http://www.opengis.net/kml/2.2}Placemark"
+KML_COLUMNS = ["time_start", "time_end", "geometry", "label", "address", "distance", "type"]
+# version of the parsed file format in the KML cache (cached files from other versions are parsed again)
+KML_CACHE_VERSION = 3
 
-def format_date(date_str: str):
-    # Convert to datetime object
-    date_obj = datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%S.%fZ")
-    # Format it to a nicer format
-    formatted_date = date_obj.strftime("%Y/%m/%d at %I:%M %p")
-    return formatted_date
+
+def parse_coordinates(coordinates: str):
+    """Parse a KML coordinate string ("lon,lat[,alt] lon,lat[,alt] ...") into an array of shape (n, 2)."""
+    coordinates = coordinates.strip()
+    n_dims = coordinates.split(None, 1)[0].count(",") + 1
+    coords = np.fromstring(coordinates.replace(",", " "), sep=" ").reshape(-1, n_dims)
+    return coords[:, :2]
+
+
+def parse_placemark(placemark: ET.Element):
+    """Extract timestamps, geometry and labels from a KML placemark. Returns None if it has no geometry."""
+    namespace = KML_NAMESPACE
+    name = placemark.find("kml:name", namespace)
+    address = placemark.find("kml:address", namespace)
+    address = address.text if address is not None else None
+    time_start, time_end = None, None
+
+    # Extract time if available
+    timespan = placemark.find("kml:TimeSpan", namespace)
+    if timespan is not None:
+        time_start_elem = timespan.find("kml:begin", namespace)
+        time_end_elem = timespan.find("kml:end", namespace)
+        time_start = time_start_elem.text if time_start_elem is not None else None
+        time_end = time_end_elem.text if time_end_elem is not None else None
+
+    # label
+    label = name.text if name is not None else "Unknown"
+
+    # Extract Distance if available
+    distance = pd.NA
+    extended_data = placemark.find("kml:ExtendedData", namespace)
+    if extended_data is not None:
+        distance_elem = extended_data.find(".//kml:Data[@name='Distance']/kml:value", namespace)
+        distance = int(distance_elem.text) if distance_elem is not None else pd.NA
+
+    # Extract coordinates
+    point = placemark.find(".//kml:Point/kml:coordinates", namespace)
+    linestring = placemark.find(".//kml:LineString/kml:coordinates", namespace)
+    if point is not None:
+        longitude, latitude = parse_coordinates(point.text)[0]
+        geometry, geometry_type = Point(longitude, latitude), "staypoint"
+    elif linestring is not None:
+        geometry, geometry_type = shapely.LineString(parse_coordinates(linestring.text)), "tripleg"
+    else:
+        return None
+
+    return [time_start, time_end, geometry, label, address, distance, geometry_type]
+
+
+def iter_placemarks(kml_path: str):
+    """
+    Stream the placemarks of a KML file without loading the whole document tree.
+
+    Processed elements are removed from the tree, so memory stays bounded for large files.
+
+    Parameters:
+        kml_path (str): Path to the KML file.
+
+    Yields:
+        list: One row [time_start, time_end, geometry, label, address, distance, type] per placemark.
+    """
+    open_elements = []
+    for event, elem in ET.iterparse(kml_path, events=("start", "end")):
+        if event == "start":
+            open_elements.append(elem)
+            continue
+        open_elements.pop()
+        if elem.tag != PLACEMARK_TAG:
+            continue
+
+        row = parse_placemark(elem)
+        # free the processed placemark
+        elem.clear()
+        if open_elements:
+            open_elements[-1].remove(elem)
+        if row is not None:
+            yield row
 
 
 def parse_kml(kml_path: str):
@@ -37,128 +119,272 @@ def parse_kml(kml_path: str):
     Returns:
         gpd.GeoDataFrame: A geodataframe with columns [time_start, time_end, geometry, label].
     """
-    # Parse the KML file
-    tree = ET.parse(kml_path)
-    root = tree.getroot()
-
-    # Define the KML namespace
-    namespace = {"kml": "http://www.opengis.net/kml/2.2"}
-
-    # Extract placemarks
-    data = []
-    for placemark in root.findall(".//kml:Placemark", namespace):
-        name = placemark.find("kml:name", namespace)
-        address = placemark.find("kml:address", namespace).text
-        time_start, time_end = None, None
-
-        # Extract time if available
-        timespan = placemark.find("kml:TimeSpan", namespace)
-        if timespan is not None:
-            time_start_elem = timespan.find("kml:begin", namespace)
-            time_end_elem = timespan.find("kml:end", namespace)
-            time_start = time_start_elem.text if time_start_elem is not None else None
-            time_end = time_end_elem.text if time_end_elem is not None else None
-
-        # label
-        label = name.text if name is not None else "Unknown"
-
-        # distance if available
-        # Extract Distance if available
-        distance = pd.NA
-        extended_data = placemark.find("kml:ExtendedData", namespace)
-        if extended_data is not None:
-            distance_elem = extended_data.find(".//kml:Data[@name='Distance']/kml:value", namespace)
-            distance = int(distance_elem.text) if distance_elem is not None else pd.NA
-
-        # Extract coordinates
-        point = placemark.find(".//kml:Point/kml:coordinates", namespace)
-        linestring = placemark.find(".//kml:LineString/kml:coordinates", namespace)
-        if point is not None:
-            coords = point.text.strip().split(",")
-            longitude, latitude = float(coords[0]), float(coords[1])
-            geometry = Point(longitude, latitude)
-
-            data.append(
-                [
-                    format_date(time_start),
-                    format_date(time_end),
-                    geometry,
-                    label,
-                    address,
-                    distance,
-                    "staypoint",
-                ]
-            )
+    return placemarks_to_gdf(list(iter_placemarks(kml_path)))
 
-        elif linestring is not None:
-            coords_list = linestring.text.strip().replace("\n", "").split(" ")
-            coords = shapely.LineString(
-                [
-                    (float(coord.split(",")[0]), float(coord.strip().split(",")[1]))
-                    for coord in coords_list
-                    if len(coord) > 1
-                ]
-            )
-            data.append(
-                [
-                    format_date(time_start),
-                    format_date(time_end),
-                    coords,
-                    label,
-                    address,
-                    distance,
-                    "tripleg",
-                ]
-            )
 
-    # Create and return GeoDataFrame
-    gdf = gpd.GeoDataFrame(
-        data,
-        columns=[
-            "time_start",
-            "time_end",
-            "geometry",
-            "label",
-            "address",
-            "distance",
-            "type",
-        ],
-        crs="EPSG:4326",
-    )
-    return gdf
+def iter_kml_chunks(kml_path: str, chunk_size: int = 100_000):
+    """
+    Parse a KML file lazily in chunks, so that even a single large (e.g. multi-year) export is never fully in memory.
+
+    Yields:
+        gpd.GeoDataFrame: At most `chunk_size` placemarks in the format of `parse_kml`.
+    """
+    rows = []
+    for row in iter_placemarks(kml_path):
+        rows.append(row)
+        if len(rows) == chunk_size:
+            yield placemarks_to_gdf(rows)
+            rows = []
+    if rows:
+        yield placemarks_to_gdf(rows)
 
 
-def load_trackintel_from_kml_dir(kml_path: str):
-    all_tracks = []
-    for file in sorted(os.listdir(kml_path)):
-        kml_file_path = os.path.join(kml_path, file)
-        gdf = parse_kml(kml_file_path)
-        all_tracks.append(gdf)
+def placemarks_to_gdf(rows: list):
+    """Convert placemark rows of `iter_placemarks` into a GeoDataFrame with typed columns."""
+    gdf = gpd.GeoDataFrame(rows, columns=KML_COLUMNS, crs="EPSG:4326")
+    gdf["distance"] = gdf["distance"].astype("Int64")
+    # convert the ISO timestamps in one vectorized pass (keeping full precision), with or without fractional seconds
+    gdf["time_start"] = pd.to_datetime(gdf["time_start"], utc=True, format="ISO8601")
+    gdf["time_end"] = pd.to_datetime(gdf["time_end"], utc=True, format="ISO8601")
+    return gdf
 
-    # combine all tracks
-    all_tracks = pd.concat(all_tracks)
-    all_tracks["id"] = np.arange(len(all_tracks))
 
-    # convert to geodataframe
-    all_tracks = gpd.GeoDataFrame(all_tracks, geometry="geometry")
+def tracks_to_trackintel(all_tracks: gpd.GeoDataFrame, user_id: int = 1):
+    """
+    Convert parsed KML tracks (with an "id" column) into trackintel staypoints and triplegs.
 
+    Returns:
+        Tuple of staypoints, triplegs and the number of removed invalid tripleg geometries. Staypoints or triplegs
+        are None if the tracks contain none of them (e.g. a chunk of days spent at home).
+    """
     # change attributes to fit trackintel format
     trackintel_tracks = all_tracks.rename({"time_start": "started_at", "time_end": "finished_at"}, axis=1)
-    trackintel_tracks["user_id"] = 1
+    trackintel_tracks["user_id"] = user_id
 
-    # import staypoints into trackintel
+    # import staypoints into trackintel (trackintel does not accept empty frames)
     staypoints = trackintel_tracks[trackintel_tracks["type"] == "staypoint"]
-    sp = ti.io.from_geopandas.read_staypoints_gpd(
-        staypoints.drop(["distance", "type"], axis=1), geom_col="geometry", tz="utc"
-    )
+    sp = None
+    if len(staypoints) > 0:
+        sp = ti.io.from_geopandas.read_staypoints_gpd(
+            staypoints.drop(["distance", "type"], axis=1), geom_col="geometry", tz="utc"
+        )
 
     # import triplegs into trackintel
     triplegs = trackintel_tracks[trackintel_tracks["type"] != "staypoint"]
     valid_triplegs = triplegs[triplegs.geometry.is_valid]
-    tpls = ti.io.from_geopandas.read_triplegs_gpd(
-        valid_triplegs.drop(["distance", "type"], axis=1), geom_col="geometry", tz="utc"
-    )
+    tpls = None
+    if len(valid_triplegs) > 0:
+        tpls = ti.io.from_geopandas.read_triplegs_gpd(
+            valid_triplegs.drop(["distance", "type"], axis=1), geom_col="geometry", tz="utc"
+        )
+    return sp, tpls, len(triplegs) - len(valid_triplegs)
+
+
+def parse_kml_to_parts(kml_path: str, part_dir: str, chunk_size: int = 100_000):
+    """
+    Parse a KML file in chunks and write each chunk as GeoParquet part to `part_dir` (used by the process pool, so
+    that the parsed files are not kept in memory until they are merged).
+
+    Returns:
+        float: Time it took to parse the file.
+    """
+    tic = time.time()
+    shutil.rmtree(part_dir, ignore_errors=True)
+    os.makedirs(part_dir)
+    for i, gdf in enumerate(iter_kml_chunks(kml_path, chunk_size)):
+        gdf.to_parquet(os.path.join(part_dir, f"part-{i:05d}.parquet"))
+    return time.time() - tic
+
+
+def _file_signature(file_path: str):
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def load_trackintel_from_kml_dir(
+    kml_path: str, chunk_size: int = 100_000, n_workers: int = 1, cache_dir: str = None, user_id: int = 1
+):
+    """
+    Load all KML files in a directory as trackintel staypoints and triplegs.
+
+    Parameters:
+        kml_path (str): Directory with KML files (e.g. daily exports from Google Timeline).
+        chunk_size (int): Maximum number of placemarks that are collected before they are converted to
+            trackintel format, which bounds the memory used for intermediate rows. Large files are split into
+            several chunks.
+        n_workers (int): Number of processes for parsing the files in parallel. At most 2 * n_workers files are
+            parsed ahead, their chunks are written to disk and merged in sorted file order, so the ids are the same
+            as for serial parsing.
+        cache_dir (str): If given, the parsed files (in parts of at most `chunk_size` placemarks) and the resulting
+            staypoints and triplegs are cached as GeoParquet in this directory. Files are re-parsed only if their
+            name, size or mtime changed, and if no file changed, the cached staypoints and triplegs are loaded
+            directly.
+        user_id (int): User id assigned to all staypoints and triplegs (one directory per user).
+
+    Returns:
+        Tuple of staypoints and triplegs (both indexed by "id").
+    """
+    files = sorted(os.listdir(kml_path))
+    signatures = {file: _file_signature(os.path.join(kml_path, file)) for file in files}
+
+    # check which files are cached already
+    cached_files = set()
+    if cache_dir is not None:
+        os.makedirs(os.path.join(cache_dir, "files"), exist_ok=True)
+        manifest_path = os.path.join(cache_dir, "manifest.json")
+        manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as infile:
+                manifest = json.load(infile)
+        if manifest.get("version") != KML_CACHE_VERSION:
+            manifest = {}
+        cached_files = {file for file in files if manifest.get("files", {}).get(file) == signatures[file]}
+
+        sp_cache_path = os.path.join(cache_dir, "staypoints.parquet")
+        tpls_cache_path = os.path.join(cache_dir, "triplegs.parquet")
+        unchanged = manifest.get("files") == signatures and manifest.get("user_id") == user_id
+        if unchanged and os.path.exists(sp_cache_path) and os.path.exists(tpls_cache_path):
+            sp = ti.io.from_geopandas.read_staypoints_gpd(
+                gpd.read_parquet(sp_cache_path).reset_index(), geom_col="geometry", tz="utc"
+            )
+            tpls = ti.io.from_geopandas.read_triplegs_gpd(
+                gpd.read_parquet(tpls_cache_path).reset_index(), geom_col="geometry", tz="utc"
+            )
+            print("Loaded ", len(sp), "staypoints and", len(tpls), "triplegs from cache.")
+            return sp.set_index("id"), tpls.set_index("id")
+        print(f"Using cache for {len(cached_files)} of {len(files)} files.")
+
+    sp_chunks, tpls_chunks = [], []
+    n_invalid, n_rows = 0, 0
+
+    def convert_chunk(file_gdfs):
+        nonlocal n_invalid, n_rows
+        chunk = pd.concat(file_gdfs, ignore_index=True)
+        chunk["id"] = np.arange(n_rows, n_rows + len(chunk))
+        n_rows += len(chunk)
+        sp_chunk, tpls_chunk, n_invalid_chunk = tracks_to_trackintel(chunk, user_id=user_id)
+        if sp_chunk is not None:
+            sp_chunks.append(sp_chunk)
+        if tpls_chunk is not None:
+            tpls_chunks.append(tpls_chunk)
+        n_invalid += n_invalid_chunk
+
+    files_to_parse = [file for file in files if file not in cached_files]
+    file_times = {}
+    # parts of the files parsed by the worker processes (in the cache, or temporary)
+    tmp_dir = tempfile.TemporaryDirectory() if n_workers > 1 and cache_dir is None else nullcontext()
+    parts_root = os.path.join(cache_dir, "files") if cache_dir is not None else getattr(tmp_dir, "name", None)
+
+    def file_chunks(file, futures):
+        """Chunks of at most chunk_size placemarks of one file, from the cache or parsed lazily."""
+        part_dir = os.path.join(parts_root, file) if parts_root is not None else None
+        if n_workers > 1 and file not in cached_files:
+            file_times[file] = futures.pop(file).result()
+        if file in cached_files or n_workers > 1:
+            for part in sorted(os.listdir(part_dir)):
+                yield gpd.read_parquet(os.path.join(part_dir, part))
+            if cache_dir is None:
+                shutil.rmtree(part_dir)
+            return
+
+        file_times[file] = 0.0
+        chunks = iter_kml_chunks(os.path.join(kml_path, file), chunk_size)
+        if part_dir is not None:
+            shutil.rmtree(part_dir, ignore_errors=True)
+            os.makedirs(part_dir)
+        for i in count():
+            tic_chunk = time.time()
+            gdf = next(chunks, None)
+            file_times[file] += time.time() - tic_chunk
+            if gdf is None:
+                return
+            if part_dir is not None:
+                gdf.to_parquet(os.path.join(part_dir, f"part-{i:05d}.parquet"))
+            yield gdf
+
+    tic = time.time()
+    with tmp_dir, ProcessPoolExecutor(n_workers) if n_workers > 1 else nullcontext() as executor:
+        parse_queue, futures = iter(files_to_parse), {}
+
+        # merge cached and newly parsed files in sorted file order, splitting large files into several chunks
+        file_gdfs, n_buffered = [], 0
+        for file in files:
+            # bounded window of files that are parsed ahead
+            while executor is not None and len(futures) < 2 * n_workers:
+                next_file = next(parse_queue, None)
+                if next_file is None:
+                    break
+                futures[next_file] = executor.submit(
+                    parse_kml_to_parts,
+                    os.path.join(kml_path, next_file),
+                    os.path.join(parts_root, next_file),
+                    chunk_size,
+                )
+            for gdf in file_chunks(file, futures):
+                file_gdfs.append(gdf)
+                n_buffered += len(gdf)
+                if n_buffered >= chunk_size:
+                    convert_chunk(file_gdfs)
+                    file_gdfs, n_buffered = [], 0
+        if file_gdfs:
+            convert_chunk(file_gdfs)
+
+    # combine all chunks (chunks without staypoints or triplegs are skipped)
+    assert len(sp_chunks) > 0, "No staypoints found in the KML files"
+    assert len(tpls_chunks) > 0, "No triplegs found in the KML files"
+    sp = pd.concat(sp_chunks)
+    tpls = pd.concat(tpls_chunks)
     print("Loaded ", len(sp), "staypoints and", len(tpls), "triplegs.")
-    print(f"(removed {len(triplegs) - len(valid_triplegs)} invalid geometries)")
+    print(f"(removed {n_invalid} invalid geometries)")
+
+    # timing report
+    file_times = pd.Series(file_times, dtype=float)
+    print(
+        f"Parsed {len(files_to_parse)} files in {round(time.time() - tic, 2)}s with {n_workers} worker(s) "
+        f"(per file: mean {round(file_times.mean(), 3)}s, max {round(file_times.max(), 3)}s)"
+    )
+    if len(file_times) > 0:
+        print("Slowest files:", file_times.nlargest(3).round(3).to_dict())
+
+    sp, tpls = sp.set_index("id"), tpls.set_index("id")
+    if cache_dir is not None:
+        sp.to_parquet(sp_cache_path)
+        tpls.to_parquet(tpls_cache_path)
+        with open(manifest_path, "w") as outfile:
+            json.dump({"version": KML_CACHE_VERSION, "user_id": user_id, "files": signatures}, outfile)
+
+    return sp, tpls
+
+
+def read_jsonl(path: str):
+    """Read a JSON Lines file into a list of dictionaries. An incomplete last line (e.g. after a crash) is ignored."""
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, "r") as infile:
+        for line in infile:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+class JsonlWriter:
+    def __init__(self, path: str):
+        """Append-only JSON Lines writer that flushes every record, so that no result is lost on a crash."""
+        self.path = path
+        self.outfile = open(path, "a")
+
+    def write(self, record: dict):
+        self.outfile.write(json.dumps(record, default=str) + "\n")
+        self.outfile.flush()
+
+    def close(self):
+        self.outfile.close()
+
+    def __enter__(self):
+        return self
 
-    return sp.set_index("id"), tpls.set_index("id")
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,164 @@
+import re
+from typing import Any, Callable
+
+from langchain_core.exceptions import OutputParserException
+from langchain_core.language_models.chat_models import BaseChatModel, SimpleChatModel
+from langchain_core.runnables import RunnableLambda
+from langchain_openai import ChatOpenAI
+from pydantic import PrivateAttr, ValidationError
+
+from activity_llm.prompt_design import POI_TYPE_LABELS
+
+# POI lines of `prompt_pois` ("Name (type:cafe italian) 23m away,") and `prompt_pois_grouped`
+# ("cafe 23m away: Name;" or "3x cafe within 23-80m: Name, ...;")
+POI_LINE = re.compile(r"^(?P<name>.+?) \(type:(?P<types>.*?)\) (?P<distance>\d+)m away")
+GROUPED_POI_LINE = re.compile(
+    r"^(?:\d+x )?(?P<types>.+?) (?:(?P<distance>\d+)m away|within (?P<min_distance>\d+)-\d+m): (?P<name>[^,;(]+)"
+)
+ITEM_SPLIT = re.compile(r"(?:^|\n)Item (\d+):\n")
+# text answer in the format of `PROMPT_FORMAT`
+TEXT_ANSWER = re.compile(
+    r"Place:\s*(?P<place>.*?)\s*Type:\s*(?P<label>.*?)\s*(?:Reasoning:\s*(?P<reasoning>.*?)\s*)?$", re.S
+)
+
+
+def text_to_structured(message, schema):
+    """
+    Parse the text answer of a chat model into `schema` (a pydantic model with the fields place, label and
+    reasoning). Raises OutputParserException or ValidationError for malformed answers, like langchain's structured
+    output.
+    """
+    text = message.content
+    try:
+        return schema.model_validate_json(text)
+    except ValidationError:
+        pass
+    match = TEXT_ANSWER.search(text)
+    if match is None:
+        raise OutputParserException(f"Could not parse the answer: {text}")
+    return schema.model_validate({**match.groupdict(), "reasoning": match.group("reasoning") or ""})
+
+
+class TextChatModel(SimpleChatModel):
+    """Chat model answering in text, with structured output parsed from the text answer."""
+
+    def with_structured_output(self, schema, **kwargs):
+        return self | RunnableLambda(lambda message: text_to_structured(message, schema))
+
+
+class CallableChatModel(TextChatModel):
+    """
+    Chat model that answers with a plain function `fn(prompt) -> str`. The model name (e.g. for the keys of the
+    response cache) defaults to the module and qualified name of the function. Lambdas or partials should be given
+    their own `model_name`, so that their cached answers are not mixed up.
+    """
+
+    fn: Callable[[str], str]
+    model_name: str = None
+
+    def model_post_init(self, __context):
+        super().model_post_init(__context)
+        if self.model_name is None:
+            name = getattr(self.fn, "__qualname__", type(self.fn).__qualname__)
+            self.model_name = f"callable:{getattr(self.fn, '__module__', None)}.{name}"
+
+    @property
+    def _llm_type(self):
+        return "callable"
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs):
+        return self.fn(messages[-1].content)
+
+
+class RuleBasedChatModel(TextChatModel):
+    """
+    Deterministic stub that labels a stay point from the type of the closest POI in the prompt, e.g. for
+    benchmarking the pipeline offline. Answers in the text format of `PROMPT_FORMAT` (or per item for batches),
+    which is parsed for structured output.
+    """
+
+    poi_type_labels: dict = POI_TYPE_LABELS
+    model_name: str = "rule-based"
+
+    @property
+    def _llm_type(self):
+        return "rule-based"
+
+    def label_prompt(self, prompt: str):
+        """Answer "Place: <name> Type: <label> Reasoning: ..." for a prompt describing one stay point."""
+        pois = []
+        for line in prompt.split("\n"):
+            match = POI_LINE.match(line) or GROUPED_POI_LINE.match(line)
+            if match is None:
+                continue
+            distance = match.group("distance") or match.group("min_distance")
+            pois.append((int(distance), match.group("name").strip(), match.group("types")))
+        if not pois:
+            return "Place: Private place Type: visiting friends Reasoning: There is no POI nearby."
+
+        for distance, name, types in sorted(pois):
+            for poi_type in re.split(r"[\s,;]+", types.lower()):
+                if poi_type in self.poi_type_labels:
+                    label = self.poi_type_labels[poi_type]
+                    reasoning = f"The closest known POI is a {poi_type} ({distance}m)."
+                    return f"Place: {name} Type: {label} Reasoning: {reasoning}"
+        distance, name, _ = min(pois)
+        return f"Place: {name} Type: other Reasoning: The closest POI ({distance}m) has no known type."
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt = messages[-1].content
+        parts = ITEM_SPLIT.split(prompt)
+        if len(parts) == 1:
+            return self.label_prompt(prompt)
+        # batch prompt: one answer per item
+        return "\n".join(
+            f"Item {item_number}: {self.label_prompt(item_prompt)}"
+            for item_number, item_prompt in zip(parts[1::2], parts[2::2])
+        )
+
+
+class LocalChatModel(TextChatModel):
+    """Chat model running locally on CPU with a Hugging Face transformers text-generation pipeline."""
+
+    model_name: str = "Qwen/Qwen2.5-0.5B-Instruct"
+    max_new_tokens: int = 128
+    _pipeline: Any = PrivateAttr(default=None)
+
+    @property
+    def _llm_type(self):
+        return "transformers"
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs):
+        if self._pipeline is None:
+            try:
+                from transformers import pipeline
+            except ImportError as e:
+                raise ImportError(
+                    "Local models require transformers and torch, install them with `pip install -e .[local]`"
+                ) from e
+
+            self._pipeline = pipeline("text-generation", model=self.model_name, device="cpu")
+        chat = [{"role": "user", "content": messages[-1].content}]
+        output = self._pipeline(chat, max_new_tokens=self.max_new_tokens, do_sample=False)
+        return output[0]["generated_text"][-1]["content"]
+
+
+def make_llm(llm):
+    """
+    Create a chat model for `QueryLLM`.
+
+    Args:
+        llm: Either a langchain chat model (returned as is), a function `fn(prompt) -> str`, or a string:
+            "rule-based" for the deterministic stub, "local:<huggingface model>" for a local transformers model,
+            or the name of an OpenAI model. The retries of the OpenAI client are disabled, since `QueryLLM`
+            retries with backoff and rate limiting itself.
+    """
+    if isinstance(llm, BaseChatModel):
+        return llm
+    if callable(llm):
+        return CallableChatModel(fn=llm)
+    if llm == "rule-based":
+        return RuleBasedChatModel()
+    if llm.startswith("local:"):
+        return LocalChatModel(model_name=llm[len("local:") :])
+    return ChatOpenAI(model=llm, max_retries=0)
@@ -0,0 +1,180 @@
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyarrow.parquet as pq
+
+from activity_llm.surrounding_poi import (
+    POI_COLUMNS,
+    POIIndex,
+    SurroundingPOI,
+    format_osm_pois,
+    haversine_distance,
+    top_k_indices,
+)
+
+# zoom level of the slippy map tiles (zoom 14: tiles of about 2.4 x 2.4 km at the equator)
+TILE_ZOOM = 14
+# string columns with few distinct values, stored dictionary-encoded (pandas categoricals)
+CATEGORY_COLUMNS = ["amenity_type", "poi_my_label", "details", "opening_hours"]
+
+
+def lonlat_to_tile(lons, lats, zoom: int = TILE_ZOOM):
+    """Vectorized conversion of coordinates to slippy map tile numbers (x, y) as in the OSM tile scheme."""
+    lons, lats = np.asarray(lons, dtype=float), np.radians(np.asarray(lats, dtype=float))
+    n = 2**zoom
+    x = np.floor((lons + 180) / 360 * n).astype(int)
+    y = np.floor((1 - np.arcsinh(np.tan(lats)) / np.pi) / 2 * n).astype(int)
+    return np.clip(x, 0, n - 1), np.clip(y, 0, n - 1)
+
+
+def tile_path(store_dir: str, x: int, y: int, zoom: int = TILE_ZOOM):
+    return os.path.join(store_dir, str(zoom), str(x), f"{y}.parquet")
+
+
+def write_poi_tiles(pois: gpd.GeoDataFrame, store_dir: str, zoom: int = TILE_ZOOM):
+    """
+    Write POIs to a tiled store with one Parquet file per slippy map tile ({store_dir}/{zoom}/{x}/{y}.parquet).
+    POIs of tiles that exist already (e.g. from a neighbouring city) are merged, without duplicates.
+
+    Args:
+        pois (gpd.GeoDataFrame): POIs from `preprocess_osm_pois.py` with point geometries, id, name and poi_type
+        store_dir (str): Directory of the tiled store
+        zoom (int): Zoom level of the tiles
+    """
+    metadata_path = os.path.join(store_dir, "metadata.json")
+    if os.path.exists(metadata_path):
+        with open(metadata_path, "r") as infile:
+            zoom = json.load(infile)["zoom"]
+
+    pois = format_osm_pois(pois)
+    pois["tile_x"], pois["tile_y"] = lonlat_to_tile(pois["lon"], pois["lat"], zoom)
+    for (x, y), tile in pois.groupby(["tile_x", "tile_y"]):
+        path = tile_path(store_dir, x, y, zoom)
+        tile = tile.drop(columns=["tile_x", "tile_y"])
+        if os.path.exists(path):
+            tile = pd.concat([pd.read_parquet(path), tile], ignore_index=True)
+            tile = tile.drop_duplicates(subset="id" if "id" in tile.columns else None, keep="last")
+        for col in CATEGORY_COLUMNS:
+            if col in tile.columns:
+                tile[col] = tile[col].astype("category")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tile.reset_index(drop=True).to_parquet(path, index=False)
+
+    with open(metadata_path, "w") as outfile:
+        json.dump({"zoom": zoom}, outfile)
+
+
+class TiledPOIStore:
+    def __init__(self, store_dir: str, max_tiles: int = 64):
+        """
+        Reader for the tiled POI store of `write_poi_tiles`. Tiles are memory-mapped only when a query touches
+        them, and at most `max_tiles` tiles are kept in memory (least recently used tiles are dropped).
+
+        Args:
+            store_dir (str): Directory of the tiled store
+            max_tiles (int): Maximum number of loaded tiles
+        """
+        with open(os.path.join(store_dir, "metadata.json"), "r") as infile:
+            self.zoom = json.load(infile)["zoom"]
+        self.store_dir = store_dir
+        self.max_tiles = max_tiles
+        self.tiles = OrderedDict()
+        self.tiles_loaded = 0
+
+    def load_tile(self, x: int, y: int):
+        """Return the `POIIndex` of a tile, or None if there are no POIs in the tile."""
+        if (x, y) in self.tiles:
+            self.tiles.move_to_end((x, y))
+            return self.tiles[(x, y)]
+
+        path = tile_path(self.store_dir, x, y, self.zoom)
+        if os.path.exists(path):
+            pois = pq.read_table(path, memory_map=True).to_pandas()
+            # the categories only save space on disk, queries return plain strings as the other backends
+            for col in pois.columns[pois.dtypes == "category"]:
+                pois[col] = pois[col].astype(object)
+            index = POIIndex(pois.drop(columns=["id"], errors="ignore"))
+            self.tiles_loaded += 1
+        else:
+            index = None
+        self.tiles[(x, y)] = index
+        if len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+        return index
+
+    def tiles_for_bboxes(self, bboxes: np.ndarray):
+        """Map each tile (x, y) touched by the bounding boxes to the indices of these bounding boxes."""
+        # tile y numbers grow towards the south
+        x_min, y_max = lonlat_to_tile(bboxes[:, 1], bboxes[:, 0], self.zoom)
+        x_max, y_min = lonlat_to_tile(bboxes[:, 3], bboxes[:, 2], self.zoom)
+        tile_queries = {}
+        for i, (x0, x1, y0, y1) in enumerate(zip(x_min, x_max, y_min, y_max)):
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    tile_queries.setdefault((x, y), []).append(i)
+        return tile_queries
+
+    def query_many(self, lons, lats, bboxes, k: int = None):
+        """
+        Find the POIs inside the bounding box of each query point, loading only the touched tiles.
+
+        Args:
+            lons (np.ndarray): Longitudes of the query points
+            lats (np.ndarray): Latitudes of the query points
+            bboxes: One bounding box (min_lat, min_lon, max_lat, max_lon) per query point
+            k (int): If given, only the k closest POIs are returned per query point
+
+        Returns:
+            list: One DataFrame per query point (in input order), sorted by distance.
+        """
+        bboxes = np.asarray(bboxes, dtype=float).reshape(-1, 4)
+        matches = []
+        for (x, y), queries in self.tiles_for_bboxes(bboxes).items():
+            index = self.load_tile(x, y)
+            if index is None:
+                continue
+            queries = np.asarray(queries)
+            query_idx, poi_idx = index.query_bboxes(bboxes[queries])
+            query_idx = queries[query_idx]
+            distance = haversine_distance(lons[query_idx], lats[query_idx], index.lons[poi_idx], index.lats[poi_idx])
+            matches.append(index.to_frame(poi_idx, distance).assign(query_idx=query_idx))
+        if not matches:
+            return [pd.DataFrame(columns=POI_COLUMNS) for _ in range(len(lons))]
+
+        # split the matches of all tiles into one group per query point
+        matches = pd.concat(matches, ignore_index=True).sort_values("query_idx", kind="stable")
+        query_idx = matches.pop("query_idx").to_numpy()
+        distance = matches["distance"].to_numpy()
+        splits = np.searchsorted(query_idx, np.arange(1, len(lons)))
+        results = []
+        for rows in np.split(np.arange(len(matches)), splits):
+            closest = rows[top_k_indices(distance[rows], k)]
+            results.append(matches.iloc[closest].reset_index(drop=True))
+        return results
+
+
+class TiledSurroundingPOI(SurroundingPOI):
+    def __init__(self, radius: int, store_dir: str, max_tiles: int = 64):
+        """
+        Offline alternative to `SurroundingPOI` that answers queries from the tiled POI store written by
+        `preprocess_osm_pois.py`, so that only the regions that are actually visited are loaded.
+
+        Args:
+            radius (int): Size of the bounding box around point
+            store_dir (str): Directory of the tiled store
+            max_tiles (int): Maximum number of tiles kept in memory
+        """
+        super().__init__(radius)
+        self.store = TiledPOIStore(store_dir, max_tiles=max_tiles)
+
+    def __call__(self, longitude: float, latitude: float):
+        return self.query_many([longitude], [latitude])[0]
+
+    def query_many(self, lons, lats, k: int = None):
+        lons, lats = np.asarray(lons, dtype=float), np.asarray(lats, dtype=float)
+        bboxes = [self.create_bounding_box(lat, lon) for lon, lat in zip(lons, lats)]
+        return self.store.query_many(lons, lats, bboxes, k=k)
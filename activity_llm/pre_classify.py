@@ -0,0 +1,205 @@
+import json
+import re
+
+import numpy as np
+import pandas as pd
+
+from activity_llm.prompt_design import POI_TYPE_LABELS
+
+OSM_DAYS = ["Mo", "Tu", "We", "Th", "Fr", "Sa", "Su"]
+DAY_SELECTOR = re.compile(r"^\s*((?:(?:Mo|Tu|We|Th|Fr|Sa|Su|PH)(?:\s*-\s*(?:Mo|Tu|We|Th|Fr|Sa|Su))?\s*,?\s*)+)(.*)$")
+TIME_RANGE = re.compile(r"(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})")
+
+# hours (start, end) at which an activity is plausible; visits outside of these hours get `time_penalty`
+LABEL_HOURS = {
+    "eating": [(7, 10), (11, 15), (17, 24)],
+    "shopping": [(7, 21)],
+    "education": [(7, 18)],
+    "health": [(7, 20)],
+    "personal errands": [(7, 20)],
+    "culture": [(10, 24)],
+    "sport": [(6, 23)],
+}
+
+
+def _parse_days(selector: str):
+    days = set()
+    for part in selector.replace(" ", "").split(","):
+        if not part or part == "PH":
+            continue
+        if "-" in part:
+            first, last = (OSM_DAYS.index(day) for day in part.split("-"))
+            days.update(day % 7 for day in range(first, last + 1 if last >= first else last + 8))
+        else:
+            days.add(OSM_DAYS.index(part))
+    return days
+
+
+def is_open(opening_hours: str, time: pd.Timestamp):
+    """
+    Whether a POI is open at `time` according to its OSM opening_hours tag, e.g. "Mo-Fr 08:00-18:00; Sa 09:00-12:00".
+    Only weekday and time ranges are supported (later rules override earlier ones, as in OSM).
+
+    Returns:
+        True or False, or None if the opening hours are unknown or cannot be parsed.
+    """
+    if not isinstance(opening_hours, str) or opening_hours.strip() in ("", "unknown"):
+        return None
+    if opening_hours.strip() == "24/7":
+        return True
+
+    minute = time.hour * 60 + time.minute
+    state, parsed = None, False
+    for rule in opening_hours.split(";"):
+        match = DAY_SELECTOR.match(rule)
+        try:
+            days, rest = (_parse_days(match.group(1)), match.group(2)) if match else (set(range(7)), rule)
+        except ValueError:
+            continue
+        ranges = [
+            (int(h1) * 60 + int(m1), int(h2) * 60 + int(m2)) for h1, m1, h2, m2 in TIME_RANGE.findall(rest)
+        ]
+        closed = "off" in rest or "closed" in rest
+        if not ranges and not closed:
+            continue
+        parsed = True
+        if time.weekday() not in days:
+            continue
+        if closed:
+            state = False
+        else:
+            # ranges ending before they start last past midnight
+            state = any(
+                start <= minute < end if start < end else minute >= start or minute < end for start, end in ranges
+            )
+    if not parsed:
+        return None
+    return bool(state)
+
+
+class PreClassifier:
+    def __init__(
+        self,
+        tz: str,
+        label_mapping=None,
+        confidence_threshold: float = 0.7,
+        max_distance: float = 50,
+        distance_scale: float = 25,
+        prior_weight: float = 0.2,
+        closed_penalty: float = 0.2,
+        time_penalty: float = 0.5,
+        label_hours: dict = LABEL_HOURS,
+    ):
+        """
+        Label staypoints directly from the surrounding POIs if the evidence is unambiguous, e.g. a staypoint right
+        on top of a single gym, so that only the ambiguous cases are sent to the LLM.
+
+        Each POI within `max_distance` votes for its label with weight exp(-distance / distance_scale), reduced if
+        the POI is closed during the visit or the visit time is implausible for the label. The confidence is the
+        share of the best label in the total weight, including `prior_weight` for places that are not in OSM
+        (e.g. private homes).
+
+        Args:
+            tz (str): Local time zone of the staypoints, e.g. "Europe/Zurich". The (UTC) visit times are converted
+                to it before they are compared with the opening hours and `label_hours`.
+            label_mapping (dict or str): Mapping from OSM POI type to activity label, or the path to a JSON file
+                with this mapping (e.g. the `osm_poi_mapping.json` used by `preprocess_osm_pois.py`).
+                Defaults to `POI_TYPE_LABELS`. A `poi_my_label` column in the POIs takes precedence.
+            confidence_threshold (float): Minimum confidence to assign a label without querying the LLM
+            max_distance (float): POIs further away than this (in meters) are ignored
+            distance_scale (float): Distance (in meters) at which the weight of a POI has decayed to 1/e
+            prior_weight (float): Weight of the unknown alternatives
+            closed_penalty (float): Factor for the weight of POIs that are closed during the visit
+            time_penalty (float): Factor for visits outside of the plausible hours of a label
+            label_hours (dict): Plausible hours per label. The keys must use the vocabulary of `label_mapping`;
+                the default `LABEL_HOURS` uses `ACTIVITY_LABELS`, so a mapping with other labels (e.g. from
+                `osm_poi_mapping.json`) needs its own `label_hours`, otherwise the visit time is not considered.
+        """
+        if tz is None:
+            raise ValueError("The local time zone of the staypoints is required, e.g. tz='Europe/Zurich'")
+        if isinstance(label_mapping, str):
+            with open(label_mapping, "r") as infile:
+                label_mapping = json.load(infile)
+        self.label_mapping = label_mapping if label_mapping is not None else POI_TYPE_LABELS
+        self.confidence_threshold = confidence_threshold
+        self.max_distance = max_distance
+        self.distance_scale = distance_scale
+        self.prior_weight = prior_weight
+        self.closed_penalty = closed_penalty
+        self.time_penalty = time_penalty
+        self.tz = tz
+        self.label_hours = label_hours
+        unknown_labels = set(self.label_mapping.values()) - set(label_hours)
+        if unknown_labels == set(self.label_mapping.values()):
+            print("Warning: no label of the mapping is in label_hours, the visit time is not used for scoring.")
+
+    def poi_label(self, poi):
+        """Activity label of a POI (row of the `SurroundingPOI` output), or None if its type is not mapped."""
+        label = poi.get("poi_my_label")
+        if isinstance(label, str):
+            return label
+        for poi_type in [poi.get("amenity_type")] + str(poi.get("details", "")).split():
+            if poi_type in self.label_mapping:
+                return self.label_mapping[poi_type]
+        return None
+
+    def _visit_times(self, started_at, finished_at):
+        if not isinstance(started_at, pd.Series):
+            started_at, finished_at = pd.Series([started_at]), pd.Series([finished_at])
+        times = started_at + (finished_at - started_at) / 2
+        # trackintel times are in UTC, naive times are assumed to be local already
+        if times.dt.tz is not None:
+            times = times.dt.tz_convert(self.tz)
+        return list(times)
+
+    def _time_factor(self, label: str, opening_hours: str, times: list):
+        factors = []
+        for time in times:
+            factor = 1.0
+            if is_open(opening_hours, time) is False:
+                factor *= self.closed_penalty
+            hours = self.label_hours.get(label)
+            if hours is not None and not any(start <= time.hour < end for start, end in hours):
+                factor *= self.time_penalty
+            factors.append(factor)
+        return np.mean(factors)
+
+    def __call__(self, closest_pois: pd.DataFrame, started_at, finished_at):
+        """
+        Score the candidate labels of one staypoint (or location with several visits).
+
+        Args:
+            closest_pois (pd.DataFrame): Surrounding POIs with columns name, amenity_type, details, opening_hours
+                and distance, as returned by `SurroundingPOI`
+            started_at, finished_at: Start and end of the visit(s), timestamps or Series of timestamps
+
+        Returns:
+            Tuple (place, label, confidence). place and label are None if no POI could be mapped to a label.
+        """
+        times = self._visit_times(started_at, finished_at)
+        scores, places = {}, {}
+        total = self.prior_weight
+        for _, poi in closest_pois[closest_pois["distance"] <= self.max_distance].iterrows():
+            weight = np.exp(-poi["distance"] / self.distance_scale)
+            label = self.poi_label(poi)
+            if label is None:
+                total += weight
+                continue
+            weight *= self._time_factor(label, poi.get("opening_hours"), times)
+            total += weight
+            scores[label] = scores.get(label, 0) + weight
+            # the closest POI with this label is the visited place
+            if label not in places:
+                places[label] = poi["name"]
+
+        if not scores:
+            return None, None, 0.0
+        label = max(scores, key=scores.get)
+        return places[label], label, scores[label] / total
+
+    def classify(self, closest_pois: pd.DataFrame, started_at, finished_at):
+        """Return (place, label, confidence) if the confidence reaches the threshold, otherwise None."""
+        place, label, confidence = self(closest_pois, started_at, finished_at)
+        if label is None or confidence < self.confidence_threshold:
+            return None
+        return place, label, confidence
@@ -0,0 +1,146 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+# upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# USD per 1M (input, output) tokens, used for the cost estimate
+LLM_PRICES = {
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-4.1": (2.0, 8.0),
+    "gpt-4.1-mini": (0.4, 1.6),
+    "gpt-4.1-nano": (0.1, 0.4),
+}
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int):
+    """Estimated cost in USD of an LLM request. Unknown (e.g. local) models are free."""
+    input_price, output_price = LLM_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+
+def _metric_name(name: str, labels: dict):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}"
+
+
+class Profiler:
+    def __init__(self, buckets: list = LATENCY_BUCKETS):
+        """
+        Collects the timing of a pipeline run: wall time per stage, latencies of the external requests
+        (Overpass, Nominatim, LLM), counters (e.g. tokens and cost) and the hit ratios of the caches.
+
+        Args:
+            buckets (list): Upper bounds in seconds of the latency histogram buckets
+        """
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.latencies = {}
+        self.counters = {}
+        self.caches = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        """Measure the wall time of a pipeline stage (accumulated if the stage runs several times)."""
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - tic
+
+    @contextmanager
+    def timed(self, name: str):
+        """Measure the latency of one call, e.g. `with profiler.timed("overpass"): ...`."""
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - tic)
+
+    def observe(self, name: str, seconds: float):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(seconds)
+
+    def count(self, name: str, value: float = 1, **labels):
+        """Increase a counter, optionally with labels, e.g. `count("llm_prompt_tokens", 512, model="gpt-4o")`."""
+        key = _metric_name(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def track_cache(self, name: str, cache):
+        """Include the hit ratio of a `SQLiteCache` in the report."""
+        self.caches[name] = cache
+
+    def latency_summary(self, name: str):
+        latencies = np.asarray(self.latencies[name])
+        return {
+            "count": len(latencies),
+            "total": float(latencies.sum()),
+            "mean": float(latencies.mean()),
+            "p50": float(np.percentile(latencies, 50)),
+            "p90": float(np.percentile(latencies, 90)),
+            "p99": float(np.percentile(latencies, 99)),
+            "max": float(latencies.max()),
+            # cumulative counts as in Prometheus histograms
+            "buckets": {str(bound): int((latencies <= bound).sum()) for bound in self.buckets},
+        }
+
+    def report(self):
+        """Structured report of the run as a JSON-serializable dictionary."""
+        with self.lock:
+            return {
+                "stages": dict(self.stages),
+                "latencies": {name: self.latency_summary(name) for name in self.latencies},
+                "counters": dict(self.counters),
+                "caches": {name: cache.stats() for name, cache in self.caches.items()},
+            }
+
+    def save_json(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as outfile:
+            json.dump(self.report(), outfile, indent=2)
+
+    def to_prometheus(self, prefix: str = "activity_llm"):
+        """Report in the Prometheus text exposition format."""
+        report = self.report()
+        lines = []
+        for name, seconds in report["stages"].items():
+            lines.append(f'{prefix}_stage_seconds{{stage="{name}"}} {seconds}')
+        for name, summary in report["latencies"].items():
+            metric = f"{prefix}_{name}_request_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for bound, count in summary["buckets"].items():
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {count}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {summary["count"]}')
+            lines.append(f"{metric}_sum {summary['total']}")
+            lines.append(f"{metric}_count {summary['count']}")
+        for name, value in report["counters"].items():
+            lines.append(f"{prefix}_{name} {value}")
+        for name, stats in report["caches"].items():
+            for key in ["hits", "misses", "entries"]:
+                lines.append(f'{prefix}_cache_{key}{{cache="{name}"}} {stats[key]}')
+        return "\n".join(lines) + "\n"
+
+    def save_prometheus(self, path: str, prefix: str = "activity_llm"):
+        """Write the report in the Prometheus text format, e.g. for the textfile collector of the node exporter."""
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as outfile:
+            outfile.write(self.to_prometheus(prefix))
+
+
+# shared profiler that is filled by the instrumented components
+profiler = Profiler()
@@ -1,5 +1,10 @@
+import re
+import json
+import numpy as np
 import pandas as pd
 import datetime
+from typing import Literal
+from pydantic import BaseModel, Field
 
 BASE_PROMPT = "You are a system to find out what places a person visited. We only have the raw location data from this person,\
  meaning longitude, latitude and start and end time. We want to know what exactly the person did. To find out, we have\
@@ -12,6 +17,62 @@ BASE_PROMPT = "You are a system to find out what places a person visited. We onl
 
 PROMPT_FORMAT = 'What place did the person visit or what activity did they do? Please answer with "Place: <output> Type: <output> Reasoning: <reasoning>" '
 
+STRUCTURED_PROMPT_FORMAT = "What place did the person visit or what activity did they do? Answer with the place, its\
+ activity label and a short reasoning."
+
+ACTIVITY_LABELS = [
+    "eating",
+    "shopping",
+    "leisure",
+    "sport",
+    "culture",
+    "education",
+    "health",
+    "personal errands",
+    "religion",
+    "transport",
+    "accommodation",
+    "visiting friends",
+    "other",
+]
+
+# default activity label for frequent OSM POI types (amenity, shop, leisure, tourism, ...)
+POI_TYPE_LABELS = {
+    **dict.fromkeys(
+        ["restaurant", "cafe", "fast_food", "bar", "pub", "biergarten", "food_court", "ice_cream"], "eating"
+    ),
+    **dict.fromkeys(
+        ["supermarket", "convenience", "mall", "department_store", "clothes", "bakery", "marketplace", "shop"],
+        "shopping",
+    ),
+    **dict.fromkeys(["park", "playground", "garden", "nature_reserve", "beach_resort", "picnic_site"], "leisure"),
+    **dict.fromkeys(["fitness_centre", "sports_centre", "swimming_pool", "pitch", "stadium", "sport"], "sport"),
+    **dict.fromkeys(["theatre", "cinema", "museum", "arts_centre", "gallery", "library", "attraction"], "culture"),
+    **dict.fromkeys(["school", "university", "college", "kindergarten", "language_school"], "education"),
+    **dict.fromkeys(["hospital", "clinic", "doctors", "dentist", "pharmacy", "healthcare"], "health"),
+    **dict.fromkeys(["bank", "post_office", "townhall", "hairdresser", "car_wash", "fuel"], "personal errands"),
+    **dict.fromkeys(["place_of_worship", "christian", "muslim", "jewish", "buddhist", "religious"], "religion"),
+    **dict.fromkeys(["station", "bus_station", "ferry_terminal", "transportation", "taxi"], "transport"),
+    **dict.fromkeys(["hotel", "hostel", "guest_house", "motel", "camp_site", "apartment"], "accommodation"),
+}
+
+
+class ActivityAnswer(BaseModel):
+    """Structured answer of the LLM for one stay point."""
+
+    place: str = Field(description="The place the person visited, e.g. the name of the POI")
+    label: Literal[tuple(ACTIVITY_LABELS)] = Field(description="Activity label of the visit")
+    reasoning: str = Field(description="Short reasoning for the answer")
+
+
+BATCH_INTRO = "There are several stay points, each starting with \"Item <number>:\". Classify each item independently.\n"
+
+BATCH_PROMPT_FORMAT = 'What place did the person visit or what activity did they do at each item? Please answer with one line per item:\
+ "Item <number>: Place: <output> Type: <output> Reasoning: <reasoning>" '
+
+# batches are answered in text, so the label vocabulary of the structured output is given in the prompt
+STRUCTURED_BATCH_PROMPT_FORMAT = BATCH_PROMPT_FORMAT + f"The type must be one of: {', '.join(ACTIVITY_LABELS)}. "
+
 WEEKDAYS = [
     "Monday",
     "Tuesday",
@@ -23,6 +84,44 @@ WEEKDAYS = [
 ]
 
 
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+_encoding = None
+
+
+def estimate_tokens(text: str):
+    """
+    Number of LLM tokens in a text, counted with tiktoken if it is installed (`pip install -e .[tokens]`) and its
+    encoding can be loaded. Otherwise, the number is estimated with four characters per token, which is only a rough
+    approximation (e.g. names in other scripts need more tokens).
+    """
+    global _encoding
+    if tiktoken is not None and _encoding is None:
+        try:
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return len(text) // 4 + 1
+
+
+def normalize_prompt(prompt: str, minute_resolution: int = 15):
+    """Round down all times of the form "%I:%M %p" in a prompt to `minute_resolution` minutes and collapse whitespace,
+    so that prompts for near-identical visits are equal."""
+
+    def round_time(match):
+        hour, minute, period = int(match.group(1)), int(match.group(2)), match.group(3)
+        minute = minute // minute_resolution * minute_resolution
+        return f"{hour:02d}:{minute:02d} {period}"
+
+    prompt = re.sub(r"(\d{1,2}):(\d{2}) ([AP]M)", round_time, prompt)
+    return " ".join(prompt.split())
+
+
 def prompt_pois(closest_pois: pd.DataFrame, skip_unnamed: bool = True, save_to_file: str = None):
     """Design prompt that lists the closest POIs to a location."""
 
@@ -51,6 +150,77 @@ def prompt_pois(closest_pois: pd.DataFrame, skip_unnamed: bool = True, save_to_f
     return text_for_activity[:-1] + ".\n"  # remove comma
 
 
+def prompt_pois_grouped(
+    closest_pois: pd.DataFrame, max_tokens: int = 250, max_per_type: int = 5, skip_unnamed: bool = True
+):
+    """
+    Design a compact prompt of the closest POIs: duplicates are dropped, POIs are grouped by type
+    ("3x restaurant within 40-90m: ..."), ranked by distance and informativeness, and the prompt is cut to
+    `max_tokens` tokens (counted by `estimate_tokens`, i.e. only estimated if tiktoken is not installed). If not even
+    the first group fits, only its type and distance are given.
+    """
+    text_for_activity = "Nearby OSM points of interests are:"
+    # missing values get the defaults of `SurroundingPOI`
+    defaults = {"name": "Unnamed", "amenity_type": "Unknown", "details": "", "opening_hours": "unknown"}
+    pois = closest_pois.assign(
+        **{col: closest_pois[col].fillna(default).astype(str) for col, default in defaults.items()}
+    )
+    if skip_unnamed:
+        pois = pois[pois["name"] != "Unnamed"]
+    pois = pois.sort_values("distance").drop_duplicates(["name", "amenity_type"])
+    if len(pois) == 0:
+        return "There are no OSM points of interest nearby.\n"
+
+    # POIs without amenity (e.g. shops) are typed by their details
+    details = pois["details"].str.replace("Unknown", "").str.strip()
+    from_details = (pois["amenity_type"] == "Unknown").values
+    poi_type = np.where(from_details, details.replace("", "other"), pois["amenity_type"])
+    details = details.where(~from_details, "")
+    opening = pois["opening_hours"]
+    opening = ("opened " + opening).where(opening != "unknown", "")
+
+    # extra information per POI, e.g. "Name (italian, opened Mo-Fr 10:00-22:00)"
+    extra = (details + np.where((details != "") & (opening != ""), ", ", "") + opening).str.strip()
+    entry = pois["name"] + (" (" + extra + ")").where(extra != "", "")
+    # informative POIs are preferred over slightly closer ones
+    informativeness = (details != "").astype(int) + (opening != "").astype(int)
+    pois = pois.assign(poi_type=poi_type, entry=entry, rank_key=pois["distance"] - 10 * informativeness)
+    pois = pois.sort_values("rank_key")
+
+    groups = (
+        pois.groupby("poi_type", sort=False)
+        .agg(
+            n=("entry", "size"),
+            min_distance=("distance", "min"),
+            max_distance=("distance", "max"),
+            entries=("entry", lambda entries: ", ".join(entries.iloc[:max_per_type])),
+        )
+        .reset_index()
+    )
+    min_distance = groups["min_distance"].round().astype(int).astype(str)
+    max_distance = groups["max_distance"].round().astype(int).astype(str)
+    more = (" and " + (groups["n"] - max_per_type).astype(str) + " more").where(groups["n"] > max_per_type, "")
+    lines = np.where(
+        groups["n"] == 1,
+        groups["poi_type"] + " " + min_distance + "m away: " + groups["entries"],
+        groups["n"].astype(str) + "x " + groups["poi_type"] + " within " + min_distance + "-" + max_distance + "m: "
+        + groups["entries"] + more,
+    )
+
+    # enforce the token budget
+    n_lines = 0
+    for line in lines:
+        if estimate_tokens(text_for_activity + "\n" + line + ";") > max_tokens:
+            break
+        text_for_activity += "\n" + line + ";"
+        n_lines += 1
+    if n_lines == 0:
+        # not even the first group fits, so only its type and distance are given (if at all)
+        text_for_activity = f"{text_for_activity} {groups['poi_type'].iloc[0]} {min_distance.iloc[0]}m away.\n"
+        return text_for_activity if estimate_tokens(text_for_activity) <= max_tokens else ""
+    return text_for_activity[:-1] + ".\n"
+
+
 def prompt_for_activity(
     lon: float,
     lat: float,
@@ -58,8 +228,93 @@ def prompt_for_activity(
     time_end: datetime.datetime,
     existing_label: str = None,
 ):
-    text_for_activity = f'Detected at coordinates {round(lon, 3), round(lat, 3)} on {WEEKDAYS[time_start.weekday()]}, \
+    # plain floats, numpy scalars would be printed as "np.float64(...)"
+    text_for_activity = f'Detected at coordinates {round(float(lon), 3), round(float(lat), 3)} on {WEEKDAYS[time_start.weekday()]}, \
 {time_start.strftime("%Y/%m/%d from %I:%M %p")} {time_end.strftime(" to %I:%M %p")}.'
     if existing_label is not None:
         text_for_activity += f' This point was already labelled as "{existing_label}" (label not reliable!).'
     return text_for_activity + "\n"
+
+
+def _format_hour(hour: int):
+    return f"{hour % 12 or 12}{'am' if hour < 12 else 'pm'}"
+
+
+def prompt_for_location(lon: float, lat: float, started_at: pd.Series, finished_at: pd.Series):
+    """Design prompt that summarizes all visits of a person to one location (weekdays, times and durations)."""
+    durations = (finished_at - started_at).dt.total_seconds() / 60
+    weekday_counts = started_at.dt.weekday.value_counts()
+    hour_counts = started_at.dt.hour.value_counts().sort_index()
+
+    weekday_text = ", ".join(f"{WEEKDAYS[day]}: {weekday_counts.get(day, 0)}" for day in range(7))
+    hour_text = ", ".join(f"{_format_hour(hour)}: {count}" for hour, count in hour_counts.items())
+
+    text_for_activity = f"Detected at coordinates {round(float(lon), 3), round(float(lat), 3)}. The person visited this location \
+{len(started_at)} times between {started_at.min().strftime('%Y/%m/%d')} and {started_at.max().strftime('%Y/%m/%d')}.\
+ Visits per weekday: {weekday_text}. Visits per starting hour: {hour_text}. The visits typically lasted\
+ {round(durations.median())} minutes (between {round(durations.quantile(0.25))} and\
+ {round(durations.quantile(0.75))} minutes)."
+    return text_for_activity + "\n"
+
+
+def parse_response(response: str, labels: list = None):
+    """
+    Extract the place and label from an LLM answer, either structured output (JSON) or text in the format
+    "Place: <output> Type: <output> Reasoning: <reasoning>".
+
+    Args:
+        response (str): Answer of the LLM
+        labels (list): If given, answers with a label outside of these labels (e.g. `ACTIVITY_LABELS`) are malformed
+
+    Returns:
+        Tuple (place, label), or None if the answer is malformed.
+    """
+    try:
+        answer = ActivityAnswer.model_validate(json.loads(response))
+        return answer.place, answer.label
+    except ValueError:
+        pass
+
+    if "Place:" not in response or "Type:" not in response:
+        return None
+    place = response.split("Place:")[1].split("Type:")[0].replace("\n", "").strip()
+    label = response.split("Type:")[1].split("Reasoning:")[0].replace("\n", "").strip()
+    if not place or not label:
+        return None
+    if labels is not None and label not in labels:
+        return None
+    return place, label
+
+
+def prompt_batch(item_prompts: list):
+    """Design prompt that lists several stay points (with their POIs) as numbered items."""
+    return BATCH_INTRO + "".join(f"Item {i}:\n{item_prompt}" for i, item_prompt in enumerate(item_prompts, start=1))
+
+
+def parse_batch_response(response: str):
+    """
+    Split the answer to a batch prompt into the answers per item.
+
+    Returns:
+        dict: {item number: answer text} for all items whose answer contains "Place:" and "Type:".
+    """
+    parts = re.split(r"(?:^|\n)[\s*#]*Item\s+(\d+)[\s*]*:[*]*", response)
+    answers = {}
+    for item_number, answer in zip(parts[1::2], parts[2::2]):
+        if "Place:" in answer and "Type:" in answer:
+            answers[int(item_number)] = answer.strip()
+    return answers
+
+
+def make_batches(token_counts: list, max_batch_size: int, token_budget: int):
+    """Greedily group items into batches of at most `max_batch_size` items and `token_budget` tokens."""
+    batches, batch, batch_tokens = [], [], 0
+    for i, tokens in enumerate(token_counts):
+        if batch and (len(batch) >= max_batch_size or batch_tokens + tokens > token_budget):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
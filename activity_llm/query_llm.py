@@ -1,69 +1,609 @@
-import json
+import asyncio
 import os
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-from langchain_openai import ChatOpenAI
+import geopandas as gpd
+from langchain_core.exceptions import OutputParserException
+from pydantic import ValidationError
 
+from activity_llm.cache import SQLiteCache
+from activity_llm.io import JsonlWriter, read_jsonl
+from activity_llm.llm_backends import make_llm
+from activity_llm.pre_classify import PreClassifier
+from activity_llm.profiling import profiler, estimate_cost
 from activity_llm.surrounding_poi import SurroundingPOI
+from activity_llm.rate_limit import RateLimiter, call_with_retries, acall_with_retries
 from activity_llm.prompt_design import (
     BASE_PROMPT,
     PROMPT_FORMAT,
+    STRUCTURED_PROMPT_FORMAT,
+    BATCH_INTRO,
+    BATCH_PROMPT_FORMAT,
+    STRUCTURED_BATCH_PROMPT_FORMAT,
+    ACTIVITY_LABELS,
     prompt_pois,
+    prompt_pois_grouped,
+    prompt_batch,
+    parse_batch_response,
+    parse_response,
+    ActivityAnswer,
+    make_batches,
     prompt_for_activity,
+    prompt_for_location,
+    estimate_tokens,
+    normalize_prompt,
 )
 
+# columns of the results per queried point (besides the id)
+# (for batched requests, prompt_llm is the batch prompt and batch_item the number of the point in it)
+RESULT_COLUMNS = ["place_llm", "label_llm", "response_llm", "prompt_llm", "batch_item", "fingerprint"]
+
+
+def run_coroutine(coroutine):
+    """Run a coroutine to completion, also from code that runs inside an event loop (e.g. a Jupyter notebook)."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    # asyncio.run cannot be nested in a running loop, so the coroutine gets its own loop in a worker thread
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
 
 class QueryLLM:
-    def __init__(self, poi_finder: SurroundingPOI, model="gpt-4o", max_pois=15):
-        self.llm = ChatOpenAI(model=model)
+    def __init__(
+        self,
+        poi_finder: SurroundingPOI,
+        model="gpt-4o",
+        max_pois=15,
+        llm=None,
+        max_concurrency: int = 1,
+        requests_per_minute: float = None,
+        tokens_per_minute: float = None,
+        max_retries: int = 5,
+        response_cache: SQLiteCache = None,
+        normalize_minutes: int = None,
+        batch_size: int = 1,
+        batch_token_budget: int = 8000,
+        structured_output: bool = False,
+        max_parse_retries: int = 2,
+        poi_prompt_tokens: int = None,
+        easy_llm=None,
+        easy_max_pois: int = 1,
+        pre_classifier: PreClassifier = None,
+    ):
+        """
+        Args:
+            poi_finder (SurroundingPOI): Finds the POIs around each staypoint
+            model (str): Name of the OpenAI model
+            max_pois (int): Maximum number of POIs listed in the prompt
+            llm: Backend to use instead of ChatOpenAI(model=model): any langchain chat model (e.g. a
+                FakeListChatModel with injected latency for testing), a function `fn(prompt) -> str`,
+                "rule-based" for the deterministic stub or "local:<model>" for a local model (see `make_llm`)
+            max_concurrency (int): Number of concurrent LLM requests. If larger than 1, the requests are sent
+                asynchronously via `ainvoke`
+            requests_per_minute (float): Rate limit for the LLM requests
+            tokens_per_minute (float): Rate limit for the (estimated) prompt tokens
+            max_retries (int): Number of retries with exponential backoff on rate limit and server errors
+            response_cache (SQLiteCache): Optional cache for the LLM responses, keyed by model name and prompt
+            normalize_minutes (int): If given, times in the prompt are rounded to this many minutes for the cache
+                key, so that near-identical visits share the cached response
+            batch_size (int): Maximum number of staypoints per LLM request. If larger than 1, several staypoints are
+                sent in one prompt with a numbered answer per item
+            batch_token_budget (int): Maximum number of (estimated) prompt tokens per batch request; batches are
+                filled with as many items as fit into this budget
+            structured_output (bool): Request the answer as structured output (`ActivityAnswer` with a fixed label
+                vocabulary) via langchain's `with_structured_output` instead of parsing free text
+            max_parse_retries (int): Number of times an answer that cannot be parsed or validated is requested again
+            poi_prompt_tokens (int): If given, the POIs are listed grouped by type, without duplicates and within
+                this token budget (see `prompt_pois_grouped`) instead of one line per POI
+            easy_llm: Optional cheaper backend (same options as `llm`) for easy staypoints with at most
+                `easy_max_pois` POIs nearby. Malformed answers of the easy backend are requested from `llm` again.
+            easy_max_pois (int): Maximum number of POIs for a staypoint to be routed to `easy_llm`
+            pre_classifier (PreClassifier): If given, staypoints with unambiguous POI evidence are labelled directly
+                and only the remaining ones are sent to the LLM
+        """
+        self.llm = make_llm(llm if llm is not None else model)
+        self.easy_llm = make_llm(easy_llm) if easy_llm is not None else None
+        self.easy_max_pois = easy_max_pois
         self.poi_finder = poi_finder
         self.base_prompt = BASE_PROMPT
 
         self.max_pois = max_pois
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.max_retries = max_retries
+        self.response_cache = response_cache
+        self.normalize_minutes = normalize_minutes
+        self.batch_size = batch_size
+        self.batch_token_budget = batch_token_budget
+        self.structured_output = structured_output
+        self.max_parse_retries = max_parse_retries
+        self.poi_prompt_tokens = poi_prompt_tokens
+        self.pre_classifier = pre_classifier
+        self.parse_failures = 0
+        self.pre_classified = 0
+        self._structured_llms = {}
+
+    def __call__(
+        self,
+        locations,
+        output_dir: str = None,
+        group_by_location: bool = False,
+        locs: gpd.GeoDataFrame = None,
+        resume: bool = False,
+    ):
+        """
+        Query the LLM for the activity at each staypoint.
 
-    def __call__(self, locations, output_dir: str = None):
-        llm_results = []
+        Args:
+            locations (GeoDataFrame): Staypoints with point geometry, 'started_at' and 'finished_at'
+            output_dir (str): If given, each result is appended to results_llm.jsonl in this directory
+            group_by_location (bool): Query the LLM once per 'location_id' (with a summary of all visits)
+                instead of once per staypoint, and assign the label to all staypoints of the location
+            locs (GeoDataFrame): Locations from trackintel's `generate_locations`, used for the location
+                centers if group_by_location is True. Defaults to the mean coordinates of the staypoints.
+            resume (bool): Reuse the results already saved in output_dir and only query the remaining staypoints
+
+        Returns:
+            pd.DataFrame: One row per staypoint with columns sp_id, place_llm, label_llm, response_llm, prompt_llm,
+                batch_item, fingerprint
+        """
+        if group_by_location:
+            return self.query_by_location(locations, locs=locs, output_dir=output_dir, resume=resume)
+        return self.query_staypoints(locations, output_dir=output_dir, resume=resume)
+
+    def query_staypoints(
+        self, locations, output_dir: str = None, resume: bool = False, output_file: str = "results_llm.jsonl"
+    ):
+        """Query the LLM once per staypoint (see `__call__`)."""
         print(f"Querying LLM for {len(locations)} locations...")
-        for sp_id, row in locations.iterrows():
-            lon = row.geometry.x
-            lat = row.geometry.y
+        lons, lats = locations.geometry.x.values, locations.geometry.y.values
+
+        # Basic prompt where and when the activity took place
+        person_prompts = [
+            prompt_for_activity(lon, lat, started_at, finished_at)
+            for lon, lat, started_at, finished_at in zip(
+                lons, lats, locations["started_at"], locations["finished_at"]
+            )
+        ]
+        visits = list(zip(locations["started_at"], locations["finished_at"]))
+        llm_results = self.query(
+            locations.index,
+            lons,
+            lats,
+            person_prompts,
+            visits=visits,
+            output_dir=output_dir,
+            resume=resume,
+            output_file=output_file,
+        )
+        return pd.DataFrame(llm_results, columns=["sp_id"] + RESULT_COLUMNS)
+
+    def query_by_location(
+        self, staypoints, locs: gpd.GeoDataFrame = None, output_dir: str = None, resume: bool = False
+    ):
+        """
+        Query the LLM once per location and fan the labels out to all staypoints at that location. Staypoints
+        without location are queried individually (their results are saved in results_llm_staypoints.jsonl).
+        """
+        assert "location_id" in staypoints.columns, "Staypoints must have a 'location_id' (see find_basic_locations)"
+        all_sp_ids = staypoints.index
+        no_location = staypoints["location_id"].isna()
+        sp_results = None
+        if no_location.any():
+            print(f"{no_location.sum()} staypoints have no location, querying them individually.")
+            sp_results = self.query_staypoints(
+                staypoints[no_location],
+                output_dir=output_dir,
+                resume=resume,
+                output_file="results_llm_staypoints.jsonl",
+            ).assign(location_id=staypoints.loc[no_location, "location_id"].values)
+        staypoints = staypoints[~no_location]
+        visits = staypoints.groupby("location_id")
+        print(f"Querying LLM for {visits.ngroups} locations ({len(staypoints)} staypoints)...")
+
+        location_ids = visits.size().index
+
+        # location centers
+        if locs is not None:
+            centers = gpd.GeoSeries(locs.loc[location_ids, "center"])
+            lons, lats = centers.x.values, centers.y.values
+        else:
+            coords = pd.DataFrame(
+                {"lon": staypoints.geometry.x, "lat": staypoints.geometry.y, "location_id": staypoints["location_id"]}
+            )
+            centers = coords.groupby("location_id")[["lon", "lat"]].mean().loc[location_ids]
+            lons, lats = centers["lon"].values, centers["lat"].values
+
+        # one prompt summarizing all visits per location
+        person_prompts, visit_times = [], []
+        for (_, group), lon, lat in zip(visits, lons, lats):
+            visit_times.append((group["started_at"], group["finished_at"]))
+            if len(group) == 1:
+                person_prompts.append(
+                    prompt_for_activity(lon, lat, group["started_at"].iloc[0], group["finished_at"].iloc[0])
+                )
+            else:
+                person_prompts.append(prompt_for_location(lon, lat, group["started_at"], group["finished_at"]))
+
+        loc_results = self.query(
+            location_ids,
+            lons,
+            lats,
+            person_prompts,
+            id_name="location_id",
+            visits=visit_times,
+            output_dir=output_dir,
+            resume=resume,
+        )
+
+        # assign the label of each location to its staypoints
+        sp_to_loc = pd.DataFrame({"sp_id": staypoints.index, "location_id": staypoints["location_id"].values})
+        loc_results = pd.DataFrame(loc_results, columns=["location_id"] + RESULT_COLUMNS).astype(
+            {"location_id": sp_to_loc["location_id"].dtype}
+        )
+        results = sp_to_loc.merge(loc_results, on="location_id", how="left")
+        if sp_results is not None:
+            results = pd.concat([results, sp_results], ignore_index=True)
+        # in the order of the input staypoints
+        return pd.DataFrame({"sp_id": all_sp_ids}).merge(results, on="sp_id", how="left")
+
+    def query(
+        self,
+        ids,
+        lons,
+        lats,
+        person_prompts,
+        id_name: str = "sp_id",
+        visits: list = None,
+        output_dir: str = None,
+        resume: bool = False,
+        output_file: str = "results_llm.jsonl",
+    ):
+        """
+        Find the surrounding POIs, build the full prompts and query the LLM.
+
+        Args:
+            ids: Identifiers of the queried points (saved in the results under `id_name`)
+            lons, lats: Coordinates of the queried points
+            person_prompts (list): Prompt describing where and when each activity took place
+            visits (list): Tuples (started_at, finished_at) per point, either timestamps or Series for several
+                visits. Required for the `pre_classifier`.
+            output_dir (str): If given, each result is appended to `output_file` in this directory
+            resume (bool): Skip the points whose results are already in `output_file`. A stored result is only
+                reused if its fingerprint (hash of the person prompt, i.e. where and when) matches, since ids such
+                as location ids can refer to other points in a run on updated data.
+
+        Returns:
+            list: One dictionary with the LLM results per queried point, in input order.
+        """
+        ids = [query_id.item() if hasattr(query_id, "item") else query_id for query_id in ids]
+        output_path = os.path.join(output_dir, output_file) if output_dir is not None else None
+
+        fingerprints = [SQLiteCache.make_key(person_prompt) for person_prompt in person_prompts]
+
+        # results from a previous (interrupted) run, in the slots of their points
+        all_results = [None] * len(ids)
+        todo = list(range(len(ids)))
+        if resume and output_path is not None:
+            requested = dict(zip(ids, fingerprints))
+            stored = [res for res in read_jsonl(output_path) if res.get(id_name) in requested]
+            matching = {res[id_name]: res for res in stored if res.get("fingerprint") == requested[res[id_name]]}
+            all_results = [matching.get(query_id) for query_id in ids]
+            n_stale = len({res[id_name] for res in stored} - set(matching))
+            if n_stale > 0:
+                print(f"Warning: {n_stale} stored results describe other points (e.g. changed locations), ignored.")
+            todo = [i for i, query_id in enumerate(ids) if query_id not in matching]
+            print(f"Resuming: {len(matching)} results exist already, {len(todo)} remaining.")
+            ids = [ids[i] for i in todo]
+            fingerprints = [fingerprints[i] for i in todo]
+            lons, lats = [lons[i] for i in todo], [lats[i] for i in todo]
+            person_prompts = [person_prompts[i] for i in todo]
+            visits = [visits[i] for i in todo] if visits is not None else None
+        elif output_path is not None and os.path.exists(output_path):
+            os.remove(output_path)
+        if len(ids) == 0:
+            return all_results
+
+        # Find the closest POIs for all locations at once
+        with profiler.stage("surrounding_poi"):
+            all_closest_pois = self.poi_finder.query_many(lons, lats, k=self.max_pois)
+
+        # Full prompts with the surrounding POIs
+        item_prompts = [
+            person_prompt
+            + (
+                prompt_pois_grouped(closest_pois, max_tokens=self.poi_prompt_tokens)
+                if self.poi_prompt_tokens is not None
+                else prompt_pois(closest_pois)
+            )
+            for person_prompt, closest_pois in zip(person_prompts, all_closest_pois)
+        ]
+        prompt_format = STRUCTURED_PROMPT_FORMAT if self.structured_output else PROMPT_FORMAT
+        full_prompts = [self.base_prompt + item_prompt + prompt_format for item_prompt in item_prompts]
+
+        writer = JsonlWriter(output_path) if output_path is not None else None
+
+        attempt = 0
+
+        def handle_response(i, full_res, prompt=None, batch_item=None):
+            # handle the response (malformed answers are requested again until max_parse_retries is reached)
+            # the label of text answers (batches) is only checked against the vocabulary of the structured output
+            parsed = parse_response(full_res, labels=ACTIVITY_LABELS if self.structured_output else None)
+            if parsed is None:
+                self.parse_failures += 1
+                if attempt < self.max_parse_retries:
+                    return None
+                parsed = ("None", "None")
+            return write_result(i, *parsed, full_res, prompt=prompt, batch_item=batch_item)
+
+        def write_result(i, place_res, type_res, full_res, prompt=None, batch_item=None):
+            # the prompt that was actually sent (the batch prompt for batched items)
+            result = {
+                id_name: ids[i],
+                "place_llm": place_res,
+                "label_llm": type_res,
+                "response_llm": full_res,
+                "prompt_llm": prompt if prompt is not None else full_prompts[i],
+                "batch_item": batch_item,
+                "fingerprint": fingerprints[i],
+            }
+            print(f"\nRESULT FOR {id_name} {ids[i]}:", place_res, type_res)
 
-            # Find the closest POIs
-            closest_pois = self.poi_finder(lon, lat).sort_values("distance").head(self.max_pois)
-            # Prompt defining the surrounding POIs
-            pois_prompt = prompt_pois(closest_pois)
+            # append to the output file right away
+            if writer is not None:
+                writer.write(result)
+            return result
 
-            # Basic prompt where and when the activity took place
-            person_prompt = prompt_for_activity(lon, lat, row["started_at"], row["finished_at"])
+        llm_results = [None] * len(full_prompts)
+        try:
+            # assign the label directly if the POI evidence is unambiguous
+            skipped = set()
+            if self.pre_classifier is not None and visits is not None:
+                for i, (closest_pois, (started_at, finished_at)) in enumerate(zip(all_closest_pois, visits)):
+                    pre_classified = self.pre_classifier.classify(closest_pois, started_at, finished_at)
+                    if pre_classified is not None:
+                        place_res, type_res, confidence = pre_classified
+                        response = f"Pre-classified from the surrounding POIs (confidence {confidence:.2f})"
+                        llm_results[i] = write_result(i, place_res, type_res, response)
+                        skipped.add(i)
+                self.pre_classified += len(skipped)
+                profiler.count("llm_calls_skipped", len(skipped))
+                print(
+                    f"Pre-classified {len(skipped)} of {len(full_prompts)} points"
+                    f" ({len(skipped) / max(len(full_prompts), 1):.1%}) without querying the LLM."
+                )
 
-            full_prompt = self.base_prompt + person_prompt + pois_prompt + PROMPT_FORMAT
+            # route easy staypoints (few POIs nearby) to the cheaper backend
+            easy = [self.easy_llm is not None and len(pois) <= self.easy_max_pois for pois in all_closest_pois]
+            routes = {
+                "easy": [i for i, is_easy in enumerate(easy) if is_easy and i not in skipped],
+                "default": [i for i, is_easy in enumerate(easy) if not is_easy and i not in skipped],
+            }
 
             # Query the LLM
-            response = self.llm.invoke(full_prompt)
-
-            # handle the response
-            full_res = response.content
-            try:
-                place_res = full_res.split("Place:")[1].split("Type:")[0].replace("\n", "").strip()
-            except:
-                place_res = "None"
-            try:
-                type_res = full_res.split("Type:")[1].split("Reasoning:")[0].replace("\n", "").strip()
-            except:
-                type_res = "None"
-
-            # add to dictionary
-            llm_results.append(
-                {
-                    "sp_id": sp_id,
-                    "place_llm": place_res,
-                    "label_llm": type_res,
-                    "response_llm": full_res,
-                    "prompt_llm": full_prompt,
-                }
+            for backend, indices in routes.items():
+                if not indices:
+                    continue
+                if backend == "easy":
+                    print(f"Querying {len(indices)} easy staypoints with the easy backend.")
+
+                def handle_routed(j, response, indices=indices, **kwargs):
+                    return handle_response(indices[j], response, **kwargs)
+
+                if self.batch_size > 1 and backend == "default":
+                    results = self.query_batched(
+                        [item_prompts[i] for i in indices], [full_prompts[i] for i in indices], handle_routed
+                    )
+                else:
+                    results = self.invoke_many([full_prompts[i] for i in indices], handle_routed, backend=backend)
+                for i, result in zip(indices, results):
+                    llm_results[i] = result
+
+            # targeted retries for the malformed answers only (bypassing the cached malformed answer), always with
+            # the default backend so that malformed answers of the easy backend are escalated
+            while attempt < self.max_parse_retries:
+                malformed = [i for i, result in enumerate(llm_results) if result is None]
+                if not malformed:
+                    break
+                attempt += 1
+                print(f"Requesting {len(malformed)} malformed answers again (attempt {attempt}).")
+                retried = self.invoke_many(
+                    [full_prompts[i] for i in malformed],
+                    callback=lambda j, response: handle_response(malformed[j], response),
+                    use_cache=False,
+                )
+                for i, result in zip(malformed, retried):
+                    llm_results[i] = result
+        finally:
+            if writer is not None:
+                writer.close()
+
+        if self.response_cache is not None:
+            print("LLM response cache:", self.response_cache.stats())
+        print("Answers that could not be parsed:", self.parse_failures)
+        for i, result in zip(todo, llm_results):
+            all_results[i] = result
+        return all_results
+
+    def query_batched(self, item_prompts: list, full_prompts: list, handle_response):
+        """
+        Query the LLM with several items per request. Items whose answer cannot be parsed from the batch
+        response are queried again on their own.
+
+        Args:
+            item_prompts (list): Prompt per item (time, location and POIs)
+            full_prompts (list): Single-item prompts used as fallback
+            handle_response: Function `handle_response(i, response_text, prompt=None, batch_item=None)` returning the
+                result for item i. For items answered in a batch, the batch prompt and the item number are passed.
+
+        Returns:
+            list: Results in input order.
+        """
+        prompt_format = STRUCTURED_BATCH_PROMPT_FORMAT if self.structured_output else BATCH_PROMPT_FORMAT
+        budget = self.batch_token_budget - estimate_tokens(self.base_prompt + BATCH_INTRO + prompt_format)
+        batches = make_batches([estimate_tokens(item_prompt) for item_prompt in item_prompts], self.batch_size, budget)
+        batch_prompts = [
+            self.base_prompt + prompt_batch([item_prompts[i] for i in batch]) + prompt_format for batch in batches
+        ]
+        print(f"Querying {len(item_prompts)} items in {len(batches)} batches.")
+
+        llm_results = [None] * len(item_prompts)
+        failed = []
+        responses = self.invoke_many(batch_prompts, structured=False)
+        for batch, batch_prompt, response in zip(batches, batch_prompts, responses):
+            answers = parse_batch_response(response)
+            for item_number, i in enumerate(batch, start=1):
+                if item_number in answers:
+                    llm_results[i] = handle_response(
+                        i, answers[item_number], prompt=batch_prompt, batch_item=item_number
+                    )
+                else:
+                    failed.append(i)
+
+        # fall back to single-item requests for the items that could not be parsed
+        if failed:
+            print(f"Could not parse {len(failed)} items from the batch responses, querying them separately.")
+            fallback_results = self.invoke_many(
+                [full_prompts[i] for i in failed], callback=lambda j, response: handle_response(failed[j], response)
+            )
+            for i, result in zip(failed, fallback_results):
+                llm_results[i] = result
+        return llm_results
+
+    def invoke_many(
+        self, prompts: list, callback=None, use_cache: bool = True, structured: bool = None, backend: str = "default"
+    ):
+        """Query the LLM for all prompts, concurrently if max_concurrency > 1 (see `ainvoke_all`)."""
+        if self.max_concurrency > 1:
+            return run_coroutine(
+                self.ainvoke_all(
+                    prompts, callback=callback, use_cache=use_cache, structured=structured, backend=backend
+                )
             )
-            print(f"\nRESULT FOR SP {sp_id}:", llm_results[-1]["place_llm"], llm_results[-1]["label_llm"])
+        responses = []
+        for i, prompt in enumerate(prompts):
+            response = self.invoke(prompt, use_cache=use_cache, structured=structured, backend=backend)
+            responses.append(callback(i, response) if callback is not None else response)
+        return responses
+
+    def _cache_key(self, prompt: str, backend: str = "default"):
+        if self.normalize_minutes is not None:
+            prompt = normalize_prompt(prompt, self.normalize_minutes)
+        return SQLiteCache.make_key("llm", self._model_name(backend), prompt)
+
+    def _model_name(self, backend: str = "default"):
+        llm = self.easy_llm if backend == "easy" else self.llm
+        return getattr(llm, "model_name", type(llm).__name__)
+
+    def _get_llm(self, backend: str = "default", structured: bool = False):
+        llm = self.easy_llm if backend == "easy" else self.llm
+        if structured:
+            if backend not in self._structured_llms:
+                self._structured_llms[backend] = llm.with_structured_output(ActivityAnswer)
+            return self._structured_llms[backend]
+        return llm
+
+    def _record_usage(self, backend: str, prompt: str, response: str, message=None):
+        """Count the tokens and estimated cost of a request (reported usage if available, otherwise estimated)."""
+        usage = getattr(message, "usage_metadata", None) or {}
+        prompt_tokens = usage.get("input_tokens", estimate_tokens(prompt))
+        completion_tokens = usage.get("output_tokens", estimate_tokens(response))
+        model = self._model_name(backend)
+        profiler.count("llm_prompt_tokens", prompt_tokens, model=model)
+        profiler.count("llm_completion_tokens", completion_tokens, model=model)
+        profiler.count("llm_cost_usd", estimate_cost(model, prompt_tokens, completion_tokens), model=model)
+
+    def _structured_to_text(self, answer):
+        # malformed structured answers are returned as empty text and requested again by `query`
+        return answer.model_dump_json() if answer is not None else ""
+
+    def invoke(self, prompt: str, use_cache: bool = True, structured: bool = None, backend: str = "default"):
+        """
+        Query the LLM with caching, rate limiting and retries, and return the response text.
+
+        Args:
+            prompt (str): Full prompt
+            use_cache (bool): Whether a cached response may be returned (the new response is cached in any case)
+            structured (bool): Request structured output (returned as JSON text). Defaults to `structured_output`.
+            backend (str): "default" for `llm` or "easy" for `easy_llm`
+        """
+        structured = self.structured_output if structured is None else structured
+        if self.response_cache is not None and use_cache:
+            cached = self.response_cache.get(self._cache_key(prompt, backend))
+            if cached is not None:
+                return cached
+
+        self.rate_limiter.acquire(estimate_tokens(prompt))
+        message = None
+        with profiler.timed("llm"):
+            if structured:
+                try:
+                    answer = call_with_retries(
+                        self._get_llm(backend, structured=True).invoke, prompt, max_retries=self.max_retries
+                    )
+                except (OutputParserException, ValidationError):
+                    answer = None
+                response = self._structured_to_text(answer)
+            else:
+                message = call_with_retries(self._get_llm(backend).invoke, prompt, max_retries=self.max_retries)
+                response = message.content
+        self._record_usage(backend, prompt, response, message)
+
+        if self.response_cache is not None:
+            self.response_cache.set(self._cache_key(prompt, backend), response)
+        return response
+
+    async def ainvoke_all(
+        self, prompts: list, callback=None, use_cache: bool = True, structured: bool = None, backend: str = "default"
+    ):
+        """
+        Query the LLM for all prompts with at most `max_concurrency` parallel requests.
+
+        Args:
+            prompts (list): Full prompts
+            callback: Optional function `callback(i, response_text)` that is called as soon as the response to
+                prompt i arrives. Its return value replaces the response text in the results.
+            use_cache, structured, backend: See `invoke`
+
+        Returns:
+            list: Responses (or callback results) in input order.
+        """
+        structured = self.structured_output if structured is None else structured
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def ainvoke(prompt):
+            if self.response_cache is not None and use_cache:
+                cached = self.response_cache.get(self._cache_key(prompt, backend))
+                if cached is not None:
+                    return cached
+
+            async with semaphore:
+                await self.rate_limiter.aacquire(estimate_tokens(prompt))
+                message = None
+                with profiler.timed("llm"):
+                    if structured:
+                        try:
+                            answer = await acall_with_retries(
+                                self._get_llm(backend, structured=True).ainvoke, prompt, max_retries=self.max_retries
+                            )
+                        except (OutputParserException, ValidationError):
+                            answer = None
+                        response = self._structured_to_text(answer)
+                    else:
+                        message = await acall_with_retries(
+                            self._get_llm(backend).ainvoke, prompt, max_retries=self.max_retries
+                        )
+                        response = message.content
+            self._record_usage(backend, prompt, response, message)
+
+            if self.response_cache is not None:
+                self.response_cache.set(self._cache_key(prompt, backend), response)
+            return response
+
+        async def ainvoke_and_handle(i, prompt):
+            response = await ainvoke(prompt)
+            return callback(i, response) if callback is not None else response
 
-            if output_dir is not None:
-                with open(os.path.join(output_dir, "results_llm.json"), "w") as outfile:
-                    json.dump(llm_results, outfile)
-        return pd.DataFrame(llm_results)
+        return await asyncio.gather(*(ainvoke_and_handle(i, prompt) for i, prompt in enumerate(prompts)))
@@ -0,0 +1,112 @@
+import asyncio
+import random
+import threading
+import time
+
+RETRYABLE_ERRORS = [
+    "RateLimitError",
+    "APITimeoutError",
+    "APIConnectionError",
+    "InternalServerError",
+    "TimeoutError",
+    "GeocoderTimedOut",
+    "GeocoderUnavailable",
+    "GeocoderRateLimited",
+]
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        """
+        Token bucket that allows `rate_per_minute` units (requests, tokens, ...) per minute.
+
+        Args:
+            rate_per_minute (float): Number of units that are refilled per minute
+            capacity (float): Maximum burst size. Defaults to one minute's worth of units.
+        """
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.rate = rate_per_minute / 60
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _wait_time(self, amount: float):
+        """Consume `amount` units if available and return 0, otherwise return the time to wait."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0
+            return (amount - self.tokens) / self.rate
+
+    def acquire(self, amount: float = 1):
+        amount = min(amount, self.capacity)
+        while (wait := self._wait_time(amount)) > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, amount: float = 1):
+        amount = min(amount, self.capacity)
+        while (wait := self._wait_time(amount)) > 0:
+            await asyncio.sleep(wait)
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None):
+        """
+        Limit requests by requests per minute and (estimated) tokens per minute.
+
+        Args:
+            requests_per_minute (float): Maximum number of requests per minute. None for no limit.
+            tokens_per_minute (float): Maximum number of tokens per minute. None for no limit.
+        """
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def acquire(self, tokens: int = 0):
+        if self.request_bucket is not None:
+            self.request_bucket.acquire(1)
+        if self.token_bucket is not None:
+            self.token_bucket.acquire(tokens)
+
+    async def aacquire(self, tokens: int = 0):
+        if self.request_bucket is not None:
+            await self.request_bucket.aacquire(1)
+        if self.token_bucket is not None:
+            await self.token_bucket.aacquire(tokens)
+
+
+def is_retryable_error(error: Exception):
+    """Whether an error is a rate limit (429), server error (5xx) or timeout that is worth retrying."""
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    if isinstance(status_code, int):
+        return status_code == 429 or status_code >= 500
+    return type(error).__name__ in RETRYABLE_ERRORS
+
+
+def backoff_delay(attempt: int, base_delay: float = 1.0, max_delay: float = 60.0):
+    """Exponential backoff with jitter."""
+    return min(max_delay, base_delay * 2**attempt) * random.uniform(0.5, 1.0)
+
+
+def call_with_retries(fn, *args, max_retries: int = 5, **kwargs):
+    for attempt in range(max_retries + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as error:
+            if attempt == max_retries or not is_retryable_error(error):
+                raise
+            time.sleep(backoff_delay(attempt))
+
+
+async def acall_with_retries(fn, *args, max_retries: int = 5, **kwargs):
+    for attempt in range(max_retries + 1):
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as error:
+            if attempt == max_retries or not is_retryable_error(error):
+                raise
+            await asyncio.sleep(backoff_delay(attempt))
@@ -1,36 +1,16 @@
 import pandas as pd
+import geopandas as gpd
+import numpy as np
 import math
 import overpy
-from geopy.distance import geodesic
+import shapely
 
+from activity_llm.cache import SQLiteCache
+from activity_llm.profiling import profiler
 
-class SurroundingPOI:
-    def __init__(self, radius: int):
-        """
-        Args:
-            radius (int): Size of the bounding box around point
-        """
-        self.radius = radius
-        self.api = overpy.Overpass()
-
-    def create_bounding_box(self, lat, lon):
-        # Calculate half the size in degrees
-        delta_lat = self.radius / 111_320  # 1 degree latitude ≈ 111.32 km
-        delta_lon = self.radius / (111_320 * abs(math.cos(math.radians(lat))))  # Adjust for longitude
-
-        # Construct bounding box
-        min_lat = lat - delta_lat
-        max_lat = lat + delta_lat
-        min_lon = lon - delta_lon
-        max_lon = lon + delta_lon
-
-        return (min_lat, min_lon, max_lat, max_lon)
-
-    def __call__(self, longitude: float, latitude: float):
-        bbox = self.create_bounding_box(latitude, longitude)
+POI_COLUMNS = ["name", "amenity_type", "details", "opening_hours", "distance"]
 
-        # define query for overpass API
-        query = f"""
+OVERPASS_QUERY = """
         (
           node["amenity"]["amenity"!~"^(parking|parking_space|bench|bicycle_parking|motorcycle_parking|post_box|toilets|drinking_water|vending_machine)$"]
           {bbox};
@@ -39,37 +19,324 @@ class SurroundingPOI:
           node["leisure"] {bbox};
           node["tourism"] {bbox};
           node["building"]["building"~"^(religious|transportation)$"] {bbox};
-          node["public_transport"]["public_transport"="station"] {bbox};        
+          node["public_transport"]["public_transport"="station"] {bbox};
           node["theatre"] {bbox};
           node["cinema"] {bbox};
         );
         out;
         """
-        result = self.api.query(query)
-
-        result_return = []
-        for node in result.nodes:
-            details = (
-                node.tags.get("shop", " ")
-                + node.tags.get("leisure", "")
-                + node.tags.get("tourism", "")
-                + node.tags.get("cuisine", "")
-                + node.tags.get("sport", "")
-            ).strip()
-
-            # Calculate distance
-            node_location = (float(node.lat), float(node.lon))
-            original_location = (latitude, longitude)
-            distance = geodesic(original_location, node_location).meters
-
-            result_return.append(
-                {
-                    "name": node.tags.get("name", "Unnamed"),
-                    "amenity_type": node.tags.get("amenity", "Unknown"),
-                    "details": details,
-                    "opening_hours": node.tags.get("opening_hours", "unknown"),
-                    "distance": distance,
-                }
-            )
-
-        return pd.DataFrame(result_return)
+
+
+def haversine_distance(lon1, lat1, lon2, lat2):
+    """Vectorized haversine distance in meters between (arrays of) coordinates given in degrees."""
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6_371_000 * np.arcsin(np.sqrt(a))
+
+
+def create_bounding_box(lat: float, lon: float, radius: float):
+    """Bounding box (min_lat, min_lon, max_lat, max_lon) reaching `radius` meters from the point in each direction."""
+    # Calculate half the size in degrees
+    delta_lat = radius / 111_320  # 1 degree latitude ≈ 111.32 km
+    delta_lon = radius / (111_320 * abs(math.cos(math.radians(lat))))  # Adjust for longitude
+
+    # Construct bounding box
+    min_lat = lat - delta_lat
+    max_lat = lat + delta_lat
+    min_lon = lon - delta_lon
+    max_lon = lon + delta_lon
+
+    return (min_lat, min_lon, max_lat, max_lon)
+
+
+def nodes_to_frame(nodes: list):
+    """Convert Overpass nodes ({lat, lon, tags} dicts) to POIs with columns name, amenity_type, details,
+    opening_hours, lon and lat."""
+    result_return = []
+    for node in nodes:
+        tags = node["tags"]
+        details = (
+            tags.get("shop", " ")
+            + tags.get("leisure", "")
+            + tags.get("tourism", "")
+            + tags.get("cuisine", "")
+            + tags.get("sport", "")
+        ).strip()
+
+        result_return.append(
+            {
+                "name": tags.get("name", "Unnamed"),
+                "amenity_type": tags.get("amenity", "Unknown"),
+                "details": details,
+                "opening_hours": tags.get("opening_hours", "unknown"),
+                "lon": node["lon"],
+                "lat": node["lat"],
+            }
+        )
+    return pd.DataFrame(result_return, columns=POI_COLUMNS[:-1] + ["lon", "lat"])
+
+
+def top_k_indices(distance: np.ndarray, k: int = None):
+    """Indices of the k smallest distances, sorted ascending (argpartition instead of a full sort)."""
+    if k is not None and k < len(distance):
+        candidates = np.argpartition(distance, k)[:k]
+    else:
+        candidates = np.arange(len(distance))
+    return candidates[np.argsort(distance[candidates], kind="stable")]
+
+
+def top_k_pois(pois: pd.DataFrame, k: int = None):
+    """Restrict a POI DataFrame to the k closest POIs, sorted by distance."""
+    return pois.iloc[top_k_indices(pois["distance"].to_numpy(), k)].reset_index(drop=True)
+
+
+class SurroundingPOI:
+    def __init__(
+        self,
+        radius: int,
+        cache: SQLiteCache = None,
+        snap_decimals: int = 4,
+        overpass_url: str = None,
+        bulk: bool = False,
+        tile_size: float = 2000,
+    ):
+        """
+        Args:
+            radius (int): Size of the bounding box around point
+            cache (SQLiteCache): Optional persistent cache for the Overpass responses
+            snap_decimals (int): If a cache is used, coordinates are rounded to this many decimals before
+                building the bounding box, so that nearby queries share cache entries (4 decimals ≈ 11m)
+            overpass_url (str): URL of the Overpass API interpreter, e.g. of a self-hosted instance.
+                Defaults to the public overpy endpoint.
+            bulk (bool): In `query_many`, group the query points into grid tiles and send one Overpass query per
+                tile instead of one per point (see `query_many_bulk`)
+            tile_size (float): Size of the grid tiles in meters for the bulk mode
+        """
+        self.radius = radius
+        self.api = overpy.Overpass(url=overpass_url)
+        self.cache = cache
+        self.snap_decimals = snap_decimals
+        self.bulk = bulk
+        self.tile_size = tile_size
+
+    def create_bounding_box(self, lat, lon):
+        return create_bounding_box(lat, lon, self.radius)
+
+    def fetch_nodes(self, bbox: tuple):
+        """Query the Overpass API for the POI nodes in a bounding box, as a list of {lat, lon, tags} dicts."""
+        # define query for overpass API
+        query = OVERPASS_QUERY.format(bbox=bbox)
+
+        if self.cache is not None:
+            key = self.cache.make_key("overpass", self.radius, query)
+            nodes = self.cache.get(key)
+            if nodes is not None:
+                return nodes
+
+        with profiler.timed("overpass"):
+            result = self.api.query(query)
+        nodes = [{"lat": float(node.lat), "lon": float(node.lon), "tags": node.tags} for node in result.nodes]
+
+        if self.cache is not None:
+            self.cache.set(key, nodes)
+        return nodes
+
+    def __call__(self, longitude: float, latitude: float):
+        if self.cache is not None:
+            bbox = self.create_bounding_box(round(latitude, self.snap_decimals), round(longitude, self.snap_decimals))
+        else:
+            bbox = self.create_bounding_box(latitude, longitude)
+        result_return = nodes_to_frame(self.fetch_nodes(bbox))
+
+        # Calculate distance
+        result_return["distance"] = haversine_distance(
+            longitude, latitude, result_return["lon"].to_numpy(), result_return["lat"].to_numpy()
+        )
+        return result_return.drop(columns=["lon", "lat"])
+
+    def query_many(self, lons, lats, k: int = None):
+        """
+        Find the surrounding POIs for many coordinates at once.
+
+        Args:
+            lons (array-like): Longitudes of the query points
+            lats (array-like): Latitudes of the query points
+            k (int): If given, only the k closest POIs are returned per query point
+
+        Returns:
+            list: One DataFrame per query point (in input order), sorted by distance.
+        """
+        if self.bulk:
+            return self.query_many_bulk(lons, lats, k)
+        return [top_k_pois(self(lon, lat), k) for lon, lat in zip(lons, lats)]
+
+    def tile_bbox(self, tile: tuple):
+        """Bounding box of a grid tile, extended by the radius so that it covers the bounding boxes of all points
+        in the tile."""
+        cell = self.tile_size / 111_320
+        min_lat, min_lon = tile[0] * cell, tile[1] * cell
+        max_lat, max_lon = min_lat + cell, min_lon + cell
+        # the longitude extension is largest at the latitude furthest from the equator
+        widest_lat = max(abs(min_lat), abs(max_lat))
+        _, _, _, delta_lon = create_bounding_box(widest_lat, 0, self.radius)
+        delta_lat = self.radius / 111_320
+        return tuple(
+            round(value, 6)
+            for value in (min_lat - delta_lat, min_lon - delta_lon, max_lat + delta_lat, max_lon + delta_lon)
+        )
+
+    def query_many_bulk(self, lons, lats, k: int = None):
+        """
+        Find the surrounding POIs for many coordinates with one Overpass query per grid tile of `tile_size` meters.
+        The POIs of each tile are indexed in memory, and the points in the tile are looked up in this index. The
+        tiles are fixed, so the (cached) tile responses are reused across runs.
+
+        Args and Returns: See `query_many`
+        """
+        lons, lats = np.asarray(lons, dtype=float), np.asarray(lats, dtype=float)
+        cell = self.tile_size / 111_320
+        tiles = pd.DataFrame({"lat": np.floor(lats / cell).astype(int), "lon": np.floor(lons / cell).astype(int)})
+        tile_queries = tiles.groupby(["lat", "lon"]).indices
+        print(f"Querying Overpass for {len(lons)} points in {len(tile_queries)} tiles.")
+
+        results = [None] * len(lons)
+        for tile, queries in tile_queries.items():
+            pois = nodes_to_frame(self.fetch_nodes(self.tile_bbox(tile)))
+            if len(pois) == 0:
+                for i in queries:
+                    results[i] = pois.drop(columns=["lon", "lat"]).assign(distance=pd.Series(dtype=float))
+                continue
+            bboxes = [self.create_bounding_box(lats[i], lons[i]) for i in queries]
+            tile_results = POIIndex(pois).query_many(lons[queries], lats[queries], bboxes, k=k)
+            for i, result in zip(queries, tile_results):
+                results[i] = result
+        return results
+
+
+class POIIndex:
+    def __init__(self, pois: pd.DataFrame):
+        """
+        In-memory spatial index over POIs, answering bounding box queries without network access.
+
+        Args:
+            pois (pd.DataFrame): POIs with columns "lon", "lat", "name", "amenity_type", "details" and
+                "opening_hours". Further columns are kept and returned with the query results.
+        """
+        self.pois = pois.reset_index(drop=True)
+        self.lons = self.pois["lon"].to_numpy(dtype=float)
+        self.lats = self.pois["lat"].to_numpy(dtype=float)
+        self.tree = shapely.STRtree(shapely.points(self.lons, self.lats))
+
+    def __len__(self):
+        return len(self.pois)
+
+    def query_bboxes(self, bboxes):
+        """
+        Find all POIs inside each bounding box.
+
+        Args:
+            bboxes: Iterable of (min_lat, min_lon, max_lat, max_lon) tuples as returned by
+                `SurroundingPOI.create_bounding_box`.
+
+        Returns:
+            Tuple of integer arrays (query_idx, poi_idx) with one entry per match.
+        """
+        bboxes = np.asarray(bboxes, dtype=float).reshape(-1, 4)
+        boxes = shapely.box(bboxes[:, 1], bboxes[:, 0], bboxes[:, 3], bboxes[:, 2])
+        query_idx, poi_idx = self.tree.query(boxes, predicate="intersects")
+        return query_idx, poi_idx
+
+    def query_many(self, lons, lats, bboxes, k: int = None):
+        """
+        Vectorized lookup of the POIs inside the bounding box of each query point.
+
+        Args:
+            lons (np.ndarray): Longitudes of the query points
+            lats (np.ndarray): Latitudes of the query points
+            bboxes: One bounding box per query point
+            k (int): If given, only the k closest POIs are returned per query point
+
+        Returns:
+            list: One DataFrame per query point (in input order), sorted by distance.
+        """
+        # np.split would return one (empty) group for zero query points
+        if len(lons) == 0:
+            return []
+        query_idx, poi_idx = self.query_bboxes(bboxes)
+        # distances of all (query, POI) pairs in one pass
+        distance = haversine_distance(lons[query_idx], lats[query_idx], self.lons[poi_idx], self.lats[poi_idx])
+
+        # split the pairs into one group per query point
+        order = np.argsort(query_idx, kind="stable")
+        query_idx, poi_idx, distance = query_idx[order], poi_idx[order], distance[order]
+        splits = np.searchsorted(query_idx, np.arange(1, len(lons)))
+
+        results = []
+        for poi_idx_q, distance_q in zip(np.split(poi_idx, splits), np.split(distance, splits)):
+            closest = top_k_indices(distance_q, k)
+            results.append(self.to_frame(poi_idx_q[closest], distance_q[closest]))
+        return results
+
+    def to_frame(self, poi_idx, distance):
+        """Return the POIs at `poi_idx` in the output format of `SurroundingPOI`."""
+        result = self.pois.iloc[poi_idx].drop(columns=["lon", "lat"]).reset_index(drop=True)
+        result["distance"] = distance
+        return result
+
+
+def read_poi_geojson(poi_path: str):
+    """
+    Load a POI file written by `preprocess_osm_pois.py` into the column format of `SurroundingPOI`.
+
+    Parameters:
+        poi_path (str): Path to a `pois_{city}_osm.geojson` file.
+
+    Returns:
+        pd.DataFrame: POIs with columns [lon, lat, name, amenity_type, details, opening_hours, ...].
+    """
+    return format_osm_pois(gpd.read_file(poi_path)).drop(columns=["id"], errors="ignore")
+
+
+def format_osm_pois(pois: gpd.GeoDataFrame):
+    """Convert the POIs of `preprocess_osm_pois.py` (point geometries, poi_type) to the format of `SurroundingPOI`."""
+    pois = pd.DataFrame(pois.drop(columns="geometry")).assign(
+        lon=pois.geometry.x.values, lat=pois.geometry.y.values
+    )
+    pois = pois.rename(columns={"poi_type": "amenity_type"})
+    pois["name"] = pois["name"].fillna("Unnamed")
+    if "details" not in pois.columns:
+        pois["details"] = ""
+    if "opening_hours" not in pois.columns:
+        pois["opening_hours"] = "unknown"
+    pois["opening_hours"] = pois["opening_hours"].fillna("unknown")
+    return pois
+
+
+class OfflineSurroundingPOI(SurroundingPOI):
+    def __init__(self, radius: int, poi_paths):
+        """
+        Offline alternative to `SurroundingPOI` that answers queries from preprocessed OSM POI files
+        instead of the Overpass API.
+
+        Args:
+            radius (int): Size of the bounding box around point
+            poi_paths (str or list): One or several `pois_{city}_osm.geojson` files from `preprocess_osm_pois.py`
+        """
+        # the Overpass settings of the base class are unused, but set so that all attributes exist
+        super().__init__(radius)
+        if isinstance(poi_paths, str):
+            poi_paths = [poi_paths]
+        pois = pd.concat([read_poi_geojson(poi_path) for poi_path in poi_paths], ignore_index=True)
+        self.index = POIIndex(pois)
+        print(f"Loaded {len(self.index)} POIs for offline lookup.")
+
+    def __call__(self, longitude: float, latitude: float):
+        bbox = self.create_bounding_box(latitude, longitude)
+        _, poi_idx = self.index.query_bboxes([bbox])
+        distance = haversine_distance(longitude, latitude, self.index.lons[poi_idx], self.index.lats[poi_idx])
+        return self.index.to_frame(poi_idx, distance)
+
+    def query_many(self, lons, lats, k: int = None):
+        lons, lats = np.asarray(lons, dtype=float), np.asarray(lats, dtype=float)
+        bboxes = [self.create_bounding_box(lat, lon) for lon, lat in zip(lons, lats)]
+        return self.index.query_many(lons, lats, bboxes, k=k)
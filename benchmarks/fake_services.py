@@ -0,0 +1,156 @@
+import json
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from activity_llm.llm_backends import RuleBasedChatModel
+from activity_llm.prompt_design import POI_TYPE_LABELS, estimate_tokens
+
+BBOX = re.compile(r"\(\s*(-?[\d.]+),\s*(-?[\d.]+),\s*(-?[\d.]+),\s*(-?[\d.]+)\s*\)")
+# POIs are placed on a fixed lattice, so that overlapping bounding boxes return consistent POIs
+POI_SPACING = 0.0004
+POI_TYPES = list(POI_TYPE_LABELS) + ["vending_machine", "recycling", "atm"]
+
+
+def lattice_pois(min_lat: float, min_lon: float, max_lat: float, max_lon: float):
+    """Deterministic synthetic POI nodes (in the Overpass JSON format) inside a bounding box."""
+    lat_idx = np.arange(np.ceil(min_lat / POI_SPACING), np.floor(max_lat / POI_SPACING) + 1, dtype=int)
+    lon_idx = np.arange(np.ceil(min_lon / POI_SPACING), np.floor(max_lon / POI_SPACING) + 1, dtype=int)
+    nodes = []
+    for i in lat_idx:
+        for j in lon_idx:
+            node_id = zlib.crc32(f"{i},{j}".encode())
+            poi_type = POI_TYPES[node_id % len(POI_TYPES)]
+            nodes.append(
+                {
+                    "type": "node",
+                    "id": int(node_id),
+                    "lat": float(i * POI_SPACING),
+                    "lon": float(j * POI_SPACING),
+                    "tags": {"amenity": poi_type, "name": f"{poi_type.replace('_', ' ').title()} {node_id % 1000}"},
+                }
+            )
+    return nodes
+
+
+class FakeServices:
+    def __init__(self, latency: dict = None, port: int = 0):
+        """
+        Local stand-ins for the Overpass API, Nominatim and an OpenAI-compatible chat model, served over HTTP
+        with configurable latency, so that the pipeline can be benchmarked without network access or costs.
+
+        Args:
+            latency (dict): Latency in seconds per service ("overpass", "nominatim", "llm")
+            port (int): Port of the server. 0 picks a free port.
+        """
+        self.latency = {"overpass": 0.0, "nominatim": 0.0, "llm": 0.0, **(latency or {})}
+        self.chat_model = RuleBasedChatModel()
+        self.requests = {"overpass": 0, "nominatim": 0, "llm": 0}
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.thread = None
+
+    @property
+    def host(self):
+        return f"127.0.0.1:{self.server.server_address[1]}"
+
+    @property
+    def overpass_url(self):
+        return f"http://{self.host}/api/interpreter"
+
+    @property
+    def openai_base_url(self):
+        return f"http://{self.host}/v1"
+
+    def nominatim_kwargs(self):
+        """Arguments for `ReverseGeocoder` (and geopy's Nominatim) to use the fake server."""
+        return {"domain": self.host, "scheme": "http"}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def overpass(self, query: str):
+        nodes = {}
+        for bbox in BBOX.findall(query):
+            for node in lattice_pois(*map(float, bbox)):
+                nodes[node["id"]] = node
+        return {"version": 0.6, "generator": "fake overpass", "elements": list(nodes.values())}
+
+    def nominatim(self, params: dict):
+        lat, lon = float(params["lat"][0]), float(params["lon"][0])
+        house_number = zlib.crc32(f"{lat:.4f},{lon:.4f}".encode()) % 200 + 1
+        return {
+            "place_id": house_number,
+            "lat": str(lat),
+            "lon": str(lon),
+            "display_name": f"Rue Synthetique {house_number}, 1200 Geneve, Switzerland",
+            "address": {"road": "Rue Synthetique", "house_number": str(house_number), "city": "Geneve"},
+        }
+
+    def chat_completion(self, request: dict):
+        prompt = request["messages"][-1]["content"]
+        answer = self.chat_model.invoke(prompt).content
+        prompt_tokens, completion_tokens = estimate_tokens(prompt), estimate_tokens(answer)
+        return {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "fake"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def _handler(self):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self, service: str, payload: dict):
+                services.requests[service] += 1
+                time.sleep(services.latency[service])
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path.startswith("/reverse"):
+                    self._respond("nominatim", services.nominatim(parse_qs(url.query)))
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+                if self.path.startswith("/api/interpreter"):
+                    self._respond("overpass", services.overpass(body))
+                elif self.path.endswith("/chat/completions"):
+                    self._respond("llm", services.chat_completion(json.loads(body)))
+                else:
+                    self.send_error(404)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
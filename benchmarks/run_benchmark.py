@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tempfile
+
+from langchain_openai import ChatOpenAI
+
+from activity_llm.io import load_trackintel_from_kml_dir
+from activity_llm.home_work import find_basic_locations
+from activity_llm.surrounding_poi import SurroundingPOI
+from activity_llm.query_llm import QueryLLM
+from activity_llm.geocoding import ReverseGeocoder
+from activity_llm.profiling import profiler
+from fake_services import FakeServices
+from synthetic_data import generate_timeline
+
+
+def git_commit():
+    """Commit hash of the benchmarked code (with a "-dirty" suffix for uncommitted changes)."""
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], text=True).strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if dirty else "")
+
+
+def run_benchmark(args):
+    """Run the pipeline on a synthetic timeline against the fake services and return the results."""
+    latency = {"overpass": args.overpass_latency, "nominatim": args.nominatim_latency, "llm": args.llm_latency}
+    with tempfile.TemporaryDirectory() as tmp_dir, FakeServices(latency) as services:
+        kml_dir = os.path.join(tmp_dir, "kml")
+        n_generated = generate_timeline(kml_dir, n_days=args.n_days, n_places=args.n_places, seed=args.seed)
+        print(f"Generated {n_generated} staypoints in {args.n_days} KML files.")
+
+        profiler.reset()
+        tic = time.perf_counter()
+        with profiler.stage("load_trackintel_from_kml_dir"):
+            staypoints, triplegs = load_trackintel_from_kml_dir(kml_dir, n_workers=args.n_workers)
+
+        geocoder = ReverseGeocoder(requests_per_minute=600_000, **services.nominatim_kwargs())
+        with profiler.stage("find_basic_locations"):
+            sp_w_purpose, locations, _ = find_basic_locations(staypoints, geocoder=geocoder)
+        unknown_staypoints = sp_w_purpose[sp_w_purpose["purpose"].isna()]
+
+        # QueryLLM reports the POI search as its own "surrounding_poi" stage
+        poi_identifier = SurroundingPOI(radius=100, overpass_url=services.overpass_url, bulk=args.bulk_overpass)
+        llm = ChatOpenAI(model="gpt-4o", base_url=services.openai_base_url, api_key="benchmark")
+        llm_to_query = QueryLLM(
+            poi_identifier, llm=llm, max_concurrency=args.max_concurrency, batch_size=args.batch_size
+        )
+        with profiler.stage("query_llm"):
+            llm_to_query(unknown_staypoints)
+        end_to_end = time.perf_counter() - tic
+
+        report = profiler.report()
+        requests = dict(services.requests)
+
+    # number of processed items per stage, for the throughput
+    items = {
+        "load_trackintel_from_kml_dir": len(staypoints) + len(triplegs),
+        "find_basic_locations": len(staypoints),
+        "surrounding_poi": len(unknown_staypoints),
+        "query_llm": len(unknown_staypoints),
+    }
+    stages = {
+        stage: {"seconds": seconds, "items": items.get(stage), "items_per_sec": items.get(stage, 0) / seconds}
+        for stage, seconds in report["stages"].items()
+    }
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "params": vars(args),
+        "n_staypoints": len(staypoints),
+        "n_triplegs": len(triplegs),
+        "end_to_end": {"seconds": end_to_end, "staypoints_per_sec": len(staypoints) / end_to_end},
+        "stages": stages,
+        "requests": requests,
+        "profile": report,
+    }
+
+
+def compare(results: dict, baseline: dict):
+    """Print the speedup of each stage compared to the results of another commit."""
+    print(f"Comparison with {baseline['commit']} (>1 means faster):")
+    for stage, summary in results["stages"].items():
+        if stage in baseline["stages"]:
+            speedup = baseline["stages"][stage]["seconds"] / summary["seconds"]
+            print(f"  {stage}: {round(speedup, 2)}x")
+    speedup = baseline["end_to_end"]["seconds"] / results["end_to_end"]["seconds"]
+    print(f"  end to end: {round(speedup, 2)}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic data with local fake services")
+    parser.add_argument("--n_days", type=int, default=60)
+    parser.add_argument("--n_places", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--n_workers", type=int, default=1)
+    parser.add_argument("--max_concurrency", type=int, default=1)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--bulk_overpass", action="store_true", help="One Overpass query per tile")
+    parser.add_argument("--overpass_latency", type=float, default=0.05)
+    parser.add_argument("--nominatim_latency", type=float, default=0.02)
+    parser.add_argument("--llm_latency", type=float, default=0.2)
+    parser.add_argument("--output_dir", default="benchmarks/results")
+    parser.add_argument("--compare", help="Results file of another commit to compare with")
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    print("End to end:", {key: round(value, 3) for key, value in results["end_to_end"].items()})
+    for stage, summary in results["stages"].items():
+        print(f"  {stage}: {round(summary['seconds'], 3)}s ({round(summary['items_per_sec'], 1)} items/sec)")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    commit, dirty = results["commit"].split("-dirty")[0], results["commit"].endswith("-dirty")
+    out_file = os.path.join(args.output_dir, f"{commit[:12]}{'-dirty' if dirty else ''}_{args.n_days}days.json")
+    with open(out_file, "w") as outfile:
+        json.dump(results, outfile, indent=2)
+    print("Saved results to", out_file)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as infile:
+            compare(results, json.load(infile))
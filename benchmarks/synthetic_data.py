@@ -0,0 +1,108 @@
+import os
+import numpy as np
+import pandas as pd
+
+KML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n'
+KML_FOOTER = "</Document>\n</kml>\n"
+MODES = ["Walking", "Cycling", "On a tram", "Driving"]
+
+
+def _time(timestamp):
+    # strings are written as given, e.g. to test other ISO formats
+    if isinstance(timestamp, str):
+        return timestamp
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def staypoint_placemark(name: str, address: str, lon: float, lat: float, start: pd.Timestamp, end: pd.Timestamp):
+    return f"""<Placemark>
+<name>{name}</name>
+<address>{address}</address>
+<TimeSpan><begin>{_time(start)}</begin><end>{_time(end)}</end></TimeSpan>
+<Point><coordinates>{lon:.6f},{lat:.6f},0</coordinates></Point>
+</Placemark>
+"""
+
+
+def tripleg_placemark(mode: str, coords: np.ndarray, start: pd.Timestamp, end: pd.Timestamp):
+    coordinates = " ".join(f"{lon:.6f},{lat:.6f},0" for lon, lat in coords)
+    distance = int(np.abs(np.diff(coords, axis=0)).sum() * 100_000)
+    return f"""<Placemark>
+<name>{mode}</name>
+<ExtendedData><Data name="Distance"><value>{distance}</value></Data></ExtendedData>
+<TimeSpan><begin>{_time(start)}</begin><end>{_time(end)}</end></TimeSpan>
+<LineString><coordinates>{coordinates}</coordinates></LineString>
+</Placemark>
+"""
+
+
+def write_kml(path: str, placemarks: list):
+    """Write placemarks (of `staypoint_placemark` and `tripleg_placemark`) as a KML file in the Google format."""
+    with open(path, "w") as outfile:
+        outfile.write(KML_HEADER + "".join(placemarks) + KML_FOOTER)
+
+
+def generate_timeline(
+    out_dir: str,
+    n_days: int = 60,
+    n_places: int = 30,
+    center: tuple = (6.1432, 46.2044),
+    extent: float = 0.03,
+    start_date: str = "2024-01-01",
+    seed: int = 0,
+):
+    """
+    Write a synthetic Google timeline with one KML file per day: nights at home, weekdays at work with a lunch
+    break, and visits to other places in the evenings and on weekends. The output is deterministic for a seed.
+
+    Args:
+        out_dir (str): Directory for the KML files
+        n_days (int): Number of days
+        n_places (int): Number of other places (restaurants, shops, ...) that are visited
+        center (tuple): (lon, lat) around which all places are located
+        extent (float): Maximum distance of the places from the center in degrees
+        start_date (str): First day of the timeline
+        seed (int): Random seed
+
+    Returns:
+        int: Number of staypoints
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    home, work = np.asarray(center) + rng.uniform(-extent, extent, size=(2, 2))
+    places = np.asarray(center) + rng.uniform(-extent, extent, size=(n_places, 2))
+
+    n_staypoints = 0
+    for day in pd.date_range(start_date, periods=n_days, freq="D", tz="UTC"):
+        # (name, coordinates, start hour, end hour) of the stays of the day
+        if day.weekday() < 5:
+            stays = [("Home", home, 0, 8), ("Work", work, 8.5, 12)]
+            stays += [(f"Place {rng.integers(n_places)}", None, 12.1, 12.9), ("Work", work, 13, 17.5)]
+            if rng.random() < 0.6:
+                stays.append((f"Place {rng.integers(n_places)}", None, 18, 19.5))
+        else:
+            stays = [("Home", home, 0, 10)]
+            for hour in sorted(rng.choice([11, 14, 17], size=rng.integers(1, 4), replace=False)):
+                stays.append((f"Place {rng.integers(n_places)}", None, hour, hour + 1.5))
+        stays.append(("Home", home, 20, 23.99))
+
+        placemarks = []
+        previous = None
+        for name, coords, start, end in stays:
+            if coords is None:
+                coords = places[int(name.split()[1])]
+            # GPS noise of about 10m
+            coords = coords + rng.normal(0, 0.0001, size=2)
+            started_at, finished_at = day + pd.Timedelta(hours=start), day + pd.Timedelta(hours=end)
+            if previous is not None:
+                prev_coords, prev_end = previous
+                waypoints = np.linspace(prev_coords, coords, 5) + rng.normal(0, 0.0002, size=(5, 2))
+                placemarks.append(tripleg_placemark(rng.choice(MODES), waypoints, prev_end, started_at))
+            placemarks.append(
+                staypoint_placemark(name, f"{name} street 1, Geneva", *coords, started_at, finished_at)
+            )
+            previous = (coords, finished_at)
+        n_staypoints += len(stays)
+
+        write_kml(os.path.join(out_dir, f"history-{day.strftime('%Y-%m-%d')}.kml"), placemarks)
+    return n_staypoints
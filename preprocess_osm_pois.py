@@ -1,107 +1,158 @@
 import os
 import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+import numpy as np
 import pandas as pd
 from pyrosm import OSM
 from pyrosm import get_data
 
-out_path = "data"
+from activity_llm.poi_store import write_poi_tiles
 
-for city in ["Genf", "Paris"]:  #  ["Zuerich", "newyorkcity", "tokyo"]:
+# By default pyrosm reads all elements having "amenity", "shop" or "tourism" tag
+# Here, let's read only "amenity" and "shop" by applying a custom filter that
+# overrides the default filtering mechanism
+CUSTOM_FILTER = {
+    "healthcare": True,
+    "shop": True,
+    "leisure": True,
+    "amenity": True,
+    "tourism": True,  # ["museum", "hotel", "attraction"],
+    "building": ["religious", "transportation"],
+    "public_transport": ["station"],
+    "theatre": True,
+    "cinema": True,
+}
+# remove parking stuff
+EXCLUDED_AMENITIES = [
+    "parking",
+    "parking_space",
+    "bench",
+    "bicycle_parking",
+    "motorcycle_parking",
+    "post_box",
+    "toilets",
+]
+# columns that are needed to derive the poi type, all others are dropped right after reading
+KEEP_COLUMNS = [
+    "id",
+    "lon",
+    "lat",
+    "geometry",
+    "name",
+    "tags",
+    "amenity",
+    "leisure",
+    "religion",
+    "public_transport",
+    "shop",
+    "tourism",
+]
+
+
+def derive_poi_type(pois: pd.DataFrame):
+    """
+    Combine everything in the poi type in one vectorized pass: the first available of amenity, leisure, healthcare
+    (from the tags), museum (from the name), religion, public_transport, shop and tourism.
+    """
+    no_value = pd.Series(np.nan, index=pois.index, dtype=object)
+
+    def contains(col, pattern):
+        return pois[col].str.contains(pattern).fillna(False).astype(bool)
+
+    candidates = [
+        pois.get("amenity", no_value),
+        pois.get("leisure", no_value),
+        no_value.mask(contains("tags", "healthcare"), "healthcare"),
+        no_value.mask(contains("name", "museum"), "museum"),
+        pois.get("religion", no_value),
+        pois.get("public_transport", no_value),
+        pois.get("shop", no_value),
+        pois.get("tourism", no_value),
+    ]
+    values = np.column_stack([candidate.to_numpy(dtype=object) for candidate in candidates])
+    available = pd.notna(values)
+    first = available.argmax(axis=1)
+    poi_type = values[np.arange(len(values)), first]
+    poi_type[~available.any(axis=1)] = np.nan
+    return pd.Series(poi_type, index=pois.index, dtype=object)
+
+
+def preprocess_city(city: str, out_path: str, osm_poi_mapping: dict):
+    """Extract the POIs of one city, save them as GeoJSON and return them with the processing statistics."""
+    tic = time.time()
     fp = get_data(city)
     # Initialize the OSM parser object
     osm = OSM(fp)
+    pois = osm.get_data_by_custom_criteria(custom_filter=CUSTOM_FILTER, keep_ways=False, keep_relations=False)
+    n_raw = len(pois)
+    print(city, "raw POIs length", n_raw)
+    # only keep the columns that are needed to free the memory of the full pyrosm result early
+    pois = pois[[col for col in KEEP_COLUMNS if col in pois.columns]]
 
-    # By default pyrosm reads all elements having "amenity", "shop" or "tourism" tag
-    # Here, let's read only "amenity" and "shop" by applying a custom filter that
-    # overrides the default filtering mechanism
-    custom_filter = {
-        "healthcare": True,
-        "shop": True,
-        "leisure": True,
-        "amenity": True,
-        "tourism": True,  # ["museum", "hotel", "attraction"],
-        "building": ["religious", "transportation"],
-        "public_transport": ["station"],
-        "theatre": True,
-        "cinema": True,
-    }
-    pois = osm.get_data_by_custom_criteria(custom_filter=custom_filter, keep_ways=False, keep_relations=False)
-    print("Raw POIs length", len(pois))
-
-    pois_simple = pois.drop(
-        [
-            "timestamp",
-            "addr:city",
-            "addr:country",
-            "addr:full",
-            "addr:housenumber",
-            "addr:housename",
-            "addr:postcode",
-            "addr:place",
-            "addr:street",
-            "email",
-            "operator",
-            "phone",
-            "ref",
-            "url",
-            "website",
-            "wikipedia",
-            "version",
-            "changeset",
-            "opening_hours",
-        ],
-        axis=1,
-        errors="ignore",
-    )
-    # remove parking stuff
-    pois_simple = pois_simple[pois_simple["amenity"] != "parking"]
-    pois_simple = pois_simple[pois_simple["amenity"] != "parking_space"]
-    pois_simple = pois_simple[pois_simple["amenity"] != "bench"]
-    pois_simple = pois_simple[pois_simple["amenity"] != "bicycle_parking"]
-    pois_simple = pois_simple[pois_simple["amenity"] != "motorcycle_parking"]
-    pois_simple = pois_simple[pois_simple["amenity"] != "post_box"]
-    pois_simple = pois_simple[pois_simple["amenity"] != "toilets"]
-    # pois_simple.to_file(os.path.join(out_path, f"pois_{city}_osm_raw.geojson"), driver="GeoJSON")
-
-    with open(os.path.join(out_path, "osm_poi_mapping.json"), "r") as infile:
-        osm_poi_mapping = json.load(infile)
-
-    # Combine everything in the poi type
-    pois_simple["poi_type"] = pois_simple["amenity"]
-    pois_simple["poi_type"] = pois_simple["poi_type"].fillna(pois_simple["leisure"])
-    pois_simple.loc[
-        pd.isna(pois_simple["poi_type"]) & (pois_simple["tags"].str.contains("healthcare").fillna(False)),
-        "poi_type",
-    ] = "healthcare"
-    # add museums
-    pois_simple.loc[
-        pd.isna(pois_simple["poi_type"]) & (pois_simple["name"].str.contains("museum").fillna(False)),
-        "poi_type",
-    ] = "museum"
-    pois_simple["poi_type"] = pois_simple["poi_type"].fillna(pois_simple["religion"])
-    pois_simple["poi_type"] = pois_simple["poi_type"].fillna(pois_simple["public_transport"])
-    pois_simple["poi_type"] = pois_simple["poi_type"].fillna(pois_simple["shop"])
-    pois_simple["poi_type"] = pois_simple["poi_type"].fillna(pois_simple["tourism"])
+    # remove parking stuff in one pass
+    pois_simple = pois[~pois["amenity"].isin(EXCLUDED_AMENITIES)].copy()
+    del pois
+    pois_simple["poi_type"] = derive_poi_type(pois_simple)
 
     # reduce to relevant columns and dropn nans
     prev_len = len(pois_simple)
     pois_simple = pois_simple[["id", "lon", "lat", "geometry", "poi_type", "name"]].dropna()
     print(
-        "Number of POIs that are dropped because they cannot be assigned a poi_type:",
+        city,
+        "number of POIs that are dropped because they cannot be assigned a poi_type:",
         prev_len - len(pois_simple),
     )
 
     # Add my labels
-    prev_len = len(pois_simple)
     pois_simple["poi_my_label"] = pois_simple["poi_type"].map(osm_poi_mapping)
-    # pois_simple = pois_simple[~pd.isna(pois_simple["poi_my_label"])]
-    print(
-        "Number of POIs that are dropped because they cannot be assigned a label:",
-        prev_len - len(pois_simple),
-    )
+    print(city, "number of POIs without label:", pois_simple["poi_my_label"].isna().sum())
 
     # save
     if city == "Zuerich":
         city = "yumuv"
     pois_simple.to_file(os.path.join(out_path, f"pois_{city}_osm.geojson"), driver="GeoJSON")
-    print(f"Saving {len(pois_simple)} POIs")
+    runtime = time.time() - tic
+    print(f"Saving {len(pois_simple)} POIs for {city} ({round(n_raw / runtime)} rows/sec)")
+    return pois_simple, n_raw, runtime
+
+
+def preprocess_cities(cities: list, out_path: str = "data", n_workers: int = 1):
+    """
+    Preprocess the POIs of several cities in parallel worker processes and add them to the tiled POI store.
+
+    Args:
+        cities (list): City names as supported by `pyrosm.get_data`
+        out_path (str): Directory with `osm_poi_mapping.json`, where the POI files and the tiled store are written
+        n_workers (int): Number of worker processes
+    """
+    with open(os.path.join(out_path, "osm_poi_mapping.json"), "r") as infile:
+        osm_poi_mapping = json.load(infile)
+    # tiled POI store of all cities for `TiledSurroundingPOI`
+    tile_store_path = os.path.join(out_path, "poi_tiles")
+
+    tic = time.time()
+    n_raw_total = 0
+    with ProcessPoolExecutor(n_workers) if n_workers > 1 else nullcontext() as executor:
+        map_fn = executor.map if executor is not None else map
+        results = map_fn(preprocess_city, cities, [out_path] * len(cities), [osm_poi_mapping] * len(cities))
+        # the tiles are written by the main process only, since neighbouring cities can share tiles
+        for pois_simple, n_raw, _ in results:
+            write_poi_tiles(pois_simple, tile_store_path)
+            n_raw_total += n_raw
+    runtime = time.time() - tic
+    print(
+        f"Preprocessed {len(cities)} cities with {n_workers} worker(s) in {round(runtime, 2)}s "
+        f"({round(n_raw_total / runtime)} rows/sec)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cities", nargs="+", default=["Genf", "Paris"])  #  ["Zuerich", "newyorkcity", "tokyo"]
+    parser.add_argument("--out_path", default="data")
+    parser.add_argument("--n_workers", type=int, default=1)
+    args = parser.parse_args()
+    preprocess_cities(args.cities, out_path=args.out_path, n_workers=args.n_workers)
@@ -0,0 +1,38 @@
+import numpy as np
+import geopandas as gpd
+import pytest
+
+# center of the synthetic POIs and query points (Zurich)
+CENTER = (8.5417, 47.3769)
+
+
+@pytest.fixture
+def make_pois():
+    """Factory for POIs in the format of `preprocess_osm_pois.py`, scattered within `extent` degrees of the center."""
+
+    def make_pois(n: int = 300, extent: float = 0.01, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        lons, lats = np.asarray(CENTER)[:, None] + rng.uniform(-extent, extent, size=(2, n))
+        return gpd.GeoDataFrame(
+            {
+                "id": np.arange(n),
+                "name": [f"POI {i}" for i in range(n)],
+                "poi_type": rng.choice(["restaurant", "cafe", "supermarket", "school"], size=n),
+                "opening_hours": rng.choice(["Mo-Fr 08:00-18:00", None], size=n),
+            },
+            geometry=gpd.points_from_xy(lons, lats),
+            crs="EPSG:4326",
+        )
+
+    return make_pois
+
+
+@pytest.fixture
+def make_queries():
+    """Factory for query coordinates (lons, lats) within `extent` degrees of the center."""
+
+    def make_queries(n: int = 20, extent: float = 0.012, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        return np.asarray(CENTER)[:, None] + rng.uniform(-extent, extent, size=(2, n))
+
+    return make_queries
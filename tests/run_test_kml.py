@@ -8,14 +8,24 @@ from activity_llm.io import parse_kml, load_trackintel_from_kml_dir
 from activity_llm.home_work import find_basic_locations
 from activity_llm.surrounding_poi import SurroundingPOI
 from activity_llm.query_llm import QueryLLM
+from activity_llm.cache import SQLiteCache
+from activity_llm.geocoding import ReverseGeocoder
+from activity_llm.profiling import profiler
 
 if __name__ == "__main__":
     kml_path = "data/kml_data"
     out_path = "outputs/final_labeled_sp.csv"
+    # set to True to continue an interrupted run (stored results are only reused for unchanged locations)
+    resume = False
 
-    staypoints, triplegs = load_trackintel_from_kml_dir(kml_path)
+    # parsed files are cached, so only new or changed KML files are parsed again
+    with profiler.stage("load_kml"):
+        staypoints, triplegs = load_trackintel_from_kml_dir(kml_path, cache_dir="outputs/cache/kml")
 
-    sp_w_purpose, locations, home_work_result = find_basic_locations(staypoints)
+    geocoder = ReverseGeocoder(cache=SQLiteCache("outputs/cache/nominatim.sqlite"))
+    profiler.track_cache("nominatim", geocoder.cache)
+    with profiler.stage("find_basic_locations"):
+        sp_w_purpose, locations, home_work_result = find_basic_locations(staypoints, geocoder=geocoder)
 
     # filter for the ones that have unknown purpose
     unknown_staypoints = sp_w_purpose[sp_w_purpose["purpose"].isna()]
@@ -28,15 +38,33 @@ if __name__ == "__main__":
     print(unknown_staypoints.head())
     print()
 
-    poi_identifier = SurroundingPOI(radius=100)
-    llm_to_query = QueryLLM(poi_identifier, model="gpt-4o")
+    # cache Overpass responses between runs (entries expire after 30 days)
+    overpass_cache = SQLiteCache("outputs/cache/overpass.sqlite", ttl=30 * 24 * 3600, max_entries=100_000)
+    # one Overpass query per 2km tile instead of one per location
+    poi_identifier = SurroundingPOI(radius=100, cache=overpass_cache, bulk=True, tile_size=2000)
+    llm_to_query = QueryLLM(
+        poi_identifier, model="gpt-4o", response_cache=SQLiteCache("outputs/cache/llm_responses.sqlite")
+    )
+    profiler.track_cache("overpass", overpass_cache)
+    profiler.track_cache("llm", llm_to_query.response_cache)
 
-    # query the LLM for the unknown locations
-    results = llm_to_query(unknown_staypoints, output_dir="outputs")
+    # query the LLM for the unknown locations (once per location, labels are assigned to all its staypoints)
+    # (includes the "surrounding_poi" stage, which is also reported separately)
+    with profiler.stage("query_llm"):
+        results = llm_to_query(
+            unknown_staypoints, output_dir="outputs", group_by_location=True, locs=locations, resume=resume
+        )
 
-    # merge with original
+    # merge with original (the staypoints have their location_id already)
+    results = results.drop(columns="location_id")
     all_sp_w_purpose = pd.merge(sp_w_purpose, results, left_index=True, right_on="sp_id", how="left")
     all_sp_w_purpose["purpose"] = all_sp_w_purpose["purpose"].fillna(all_sp_w_purpose["label_llm"])
 
     all_sp_w_purpose.set_index("sp_id").to_csv(out_path)
     print("Finished and saved to", out_path)
+    print("Overpass cache:", overpass_cache.stats())
+
+    # where the time and money of the run went
+    profiler.save_json("outputs/profile.json")
+    profiler.save_prometheus("outputs/profile.prom")
+    print("Stage times:", {stage: round(seconds, 2) for stage, seconds in profiler.report()["stages"].items()})
@@ -0,0 +1,70 @@
+import pytest
+
+from activity_llm import cache as cache_module
+from activity_llm.cache import SQLiteCache
+
+
+class FakeClock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache_module.time, "time", clock)
+    return clock
+
+
+def test_get_and_set(tmp_path):
+    cache = SQLiteCache(str(tmp_path / "cache.sqlite"))
+    assert cache.get("a") is None
+    cache.set("a", {"nodes": [1, 2]})
+    assert cache.get("a") == {"nodes": [1, 2]}
+    assert cache.stats() == {"hits": 1, "misses": 1, "hit_rate": 0.5, "entries": 1}
+
+
+def test_persistent(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    SQLiteCache(path).set("a", "value")
+    assert SQLiteCache(path).get("a") == "value"
+
+
+def test_make_key():
+    assert SQLiteCache.make_key("overpass", 100, "query") == SQLiteCache.make_key("overpass", 100, "query")
+    assert SQLiteCache.make_key("overpass", 100, "query") != SQLiteCache.make_key("overpass", 200, "query")
+
+
+def test_expiry(tmp_path, clock):
+    cache = SQLiteCache(str(tmp_path / "cache.sqlite"), ttl=60)
+    cache.set("a", 1)
+    clock.now += 30
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+
+    clock.now += 40
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    # expired entries are deleted on the next write
+    cache.set("c", 3)
+    assert len(cache) == 2
+
+
+def test_lru_eviction(tmp_path, clock):
+    cache = SQLiteCache(str(tmp_path / "cache.sqlite"), max_entries=2)
+    cache.set("a", 1)
+    clock.now += 1
+    cache.set("b", 2)
+    clock.now += 1
+    # reading "a" makes "b" the least recently used entry
+    assert cache.get("a") == 1
+    clock.now += 1
+    cache.set("c", 3)
+
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
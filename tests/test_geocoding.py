@@ -0,0 +1,75 @@
+import geopandas as gpd
+import pytest
+
+from activity_llm.cache import SQLiteCache
+from activity_llm.geocoding import ADDRESS_NOT_FOUND, OfflineAddressLookup, ReverseGeocoder
+
+
+@pytest.fixture
+def address_path(tmp_path):
+    """Two addresses with OSM address tags, about 150m apart."""
+    path = str(tmp_path / "addresses.geojson")
+    gpd.GeoDataFrame(
+        {
+            "addr:street": ["Bahnhofstrasse", "Rennweg"],
+            "addr:housenumber": ["1", "10"],
+            "addr:postcode": ["8001", "8001"],
+            "addr:city": ["Zürich", "Zürich"],
+        },
+        geometry=gpd.points_from_xy([8.5400, 8.5420], [47.3700, 47.3700]),
+        crs="EPSG:4326",
+    ).to_file(path, driver="GeoJSON")
+    return path
+
+
+class FakeNominatim:
+    domain = "nominatim.example.org"
+
+    def __init__(self):
+        self.calls = 0
+
+    def reverse(self, coords, exactly_one=True):
+        self.calls += 1
+        return type("Location", (), {"address": f"Nominatim address at {coords}"})()
+
+
+def test_offline_nearest_address(address_path):
+    lookup = OfflineAddressLookup(address_path, max_distance=100)
+    assert lookup(47.3700, 8.5401) == "Bahnhofstrasse 1, 8001 Zürich"
+    assert lookup(47.3700, 8.5418) == "Rennweg 10, 8001 Zürich"
+
+
+def test_offline_distance_cutoff(address_path):
+    # about 75m from the closest address
+    assert OfflineAddressLookup(address_path, max_distance=100)(47.3700, 8.5410) != ADDRESS_NOT_FOUND
+    assert OfflineAddressLookup(address_path, max_distance=50)(47.3700, 8.5410) == ADDRESS_NOT_FOUND
+    assert OfflineAddressLookup(address_path, max_distance=100)(47.3800, 8.5400) == ADDRESS_NOT_FOUND
+
+
+def test_cache_hits(tmp_path, address_path):
+    cache = SQLiteCache(str(tmp_path / "nominatim.sqlite"))
+    geocoder = ReverseGeocoder(cache=cache, offline_backend=OfflineAddressLookup(address_path))
+    # the same snapped coordinates are only resolved once
+    addresses = geocoder.reverse_many([47.37001, 47.37002, 47.3700], [8.54011, 8.54012, 8.5418])
+    assert addresses == ["Bahnhofstrasse 1, 8001 Zürich"] * 2 + ["Rennweg 10, 8001 Zürich"]
+    assert cache.stats()["misses"] == 2
+
+    assert geocoder(47.37001, 8.54011) == "Bahnhofstrasse 1, 8001 Zürich"
+    assert cache.stats()["hits"] == 1
+    # missing addresses are not cached
+    assert geocoder(47.3800, 8.5400) == ADDRESS_NOT_FOUND
+    assert len(cache) == 2
+
+
+def test_cache_keys_per_backend(tmp_path, address_path):
+    cache = SQLiteCache(str(tmp_path / "nominatim.sqlite"))
+    offline = ReverseGeocoder(cache=cache, offline_backend=OfflineAddressLookup(address_path, max_distance=10))
+    assert offline(47.3700, 8.5410) == ADDRESS_NOT_FOUND
+    assert offline(47.3700, 8.5400) == "Bahnhofstrasse 1, 8001 Zürich"
+
+    # a Nominatim run with the same cache does not get the addresses of the offline lookup
+    nominatim = ReverseGeocoder(cache=cache, requests_per_minute=60_000)
+    nominatim.geolocator = FakeNominatim()
+    assert nominatim(47.3700, 8.5410).startswith("Nominatim address")
+    assert nominatim(47.3700, 8.5400).startswith("Nominatim address")
+    assert nominatim.geolocator.calls == 2
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import trackintel as ti
+import pytest
+
+from activity_llm.home_work import (
+    IncrementalLocationIdentifier,
+    find_basic_locations,
+    location_identifier_with_grouping,
+)
+
+HOME = (8.5417, 47.3769)
+WORK = (8.5500, 47.3900)
+OTHER = (8.5300, 47.3650)
+
+
+def make_staypoints(n_days: int = 90, seed: int = 0, user_id: int = 1, shift: float = 0.0):
+    """Home at night, work on weekdays and a second place visited in the evenings (moved by `shift` degrees)."""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for day in pd.date_range("2024-01-01", periods=n_days, freq="D", tz="UTC"):
+        stays = [(HOME, 0, 8)]
+        if day.weekday() < 5:
+            stays.append((WORK, 9, 17))
+        stays += [(OTHER, 18, 19), (HOME, 20, 23.5)]
+        for (lon, lat), start, end in stays:
+            lon, lat = np.array([lon + shift, lat]) + rng.normal(0, 0.00005, size=2)
+            rows.append(
+                {
+                    "user_id": user_id,
+                    "started_at": day + pd.Timedelta(hours=start),
+                    "finished_at": day + pd.Timedelta(hours=end),
+                    "geometry": gpd.points_from_xy([lon], [lat])[0],
+                }
+            )
+    sp = gpd.GeoDataFrame(rows, geometry="geometry", crs="EPSG:4326")
+    sp.index.name = "id"
+    return ti.io.from_geopandas.read_staypoints_gpd(sp.reset_index(), geom_col="geometry", tz="utc").set_index("id")
+
+
+def test_incremental_update_matches_full_recompute(tmp_path):
+    sp = make_staypoints()
+    loc_generate_kwargs = {"epsilon": 100}
+    loc_identify_kwargs = {"method": "OSNA", "pre_filter": False}
+
+    full_sp, _ = ti.preprocessing.staypoints.generate_locations(sp, **loc_generate_kwargs)
+    full = location_identifier_with_grouping(full_sp, loc_identify_kwargs)
+
+    identifier = IncrementalLocationIdentifier(str(tmp_path), loc_generate_kwargs, loc_identify_kwargs)
+    # the later months arrive first, the first month arrives late
+    late = sp["started_at"] < "2024-02-01"
+    identifier.update(sp[~late])
+    incremental, _ = identifier.update(sp)
+
+    pd.testing.assert_series_equal(
+        incremental["purpose"].sort_index(), full["purpose"].sort_index(), check_dtype=False
+    )
+
+
+class FakeGeocoder:
+    def reverse_many(self, latitudes, longitudes):
+        return [f"{lat:.3f}, {lon:.3f}" for lat, lon in zip(latitudes, longitudes)]
+
+
+def make_users(n_users: int = 3):
+    sps = [make_staypoints(30, seed=user_id, user_id=user_id, shift=0.01 * user_id) for user_id in range(n_users)]
+    sp = pd.concat(sps, ignore_index=True)
+    sp.index.name = "id"
+    return sp
+
+
+def test_parallel_matches_serial():
+    sp = make_users()
+    serial_sp, serial_locs, serial_result = find_basic_locations(sp, geocoder=FakeGeocoder())
+    parallel_sp, parallel_locs, parallel_result = find_basic_locations(sp, geocoder=FakeGeocoder(), n_workers=2)
+
+    pd.testing.assert_series_equal(
+        parallel_sp["purpose"].sort_index(), serial_sp["purpose"].sort_index(), check_dtype=False
+    )
+    assert set(serial_result["user_id"]) == {0, 1, 2}
+    # location ids are unique across users
+    assert parallel_locs.index.is_unique and len(parallel_locs) == len(serial_locs)
+    assert (parallel_sp.groupby("location_id")["user_id"].nunique() == 1).all()
+    columns = ["user_id", "purpose", "address"]
+    pd.testing.assert_frame_equal(
+        parallel_result[columns].sort_values(columns, ignore_index=True),
+        serial_result[columns].sort_values(columns, ignore_index=True),
+    )
+
+
+def test_incremental_requires_one_worker(tmp_path):
+    with pytest.raises(AssertionError):
+        find_basic_locations(make_users(1), incremental_state_dir=str(tmp_path), n_workers=2)
@@ -0,0 +1,118 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from activity_llm import io
+from activity_llm.io import iter_kml_chunks, load_trackintel_from_kml_dir, parse_kml
+
+from benchmarks.synthetic_data import staypoint_placemark, tripleg_placemark, write_kml
+
+HOME, WORK = (6.1432, 46.2044), (6.1500, 46.2100)
+
+
+def staypoint(name, lon, lat, begin, end):
+    return staypoint_placemark(name, f"{name} street 1", lon, lat, begin, end)
+
+
+def tripleg(begin, end):
+    return tripleg_placemark("Walking", np.array([HOME, WORK]), begin, end)
+
+
+def write_timeline(kml_dir, n_days: int = 10, n_home_days: int = 3):
+    """One KML file per day: commuting days (3 staypoints, 2 triplegs) followed by days spent at home."""
+    os.makedirs(kml_dir, exist_ok=True)
+    for i, day in enumerate(pd.date_range("2024-01-01", periods=n_days, freq="D", tz="UTC")):
+        hours = [day + pd.Timedelta(time) for time in ("0h", "8h", "8h30m", "17h", "17h30m", "23h59m")]
+        if i >= n_days - n_home_days:
+            placemarks = [staypoint("Home", *HOME, hours[0], hours[-1])]
+        else:
+            placemarks = [
+                staypoint("Home", *HOME, hours[0], hours[1]),
+                tripleg(hours[1], hours[2]),
+                staypoint("Work", *WORK, hours[2], hours[3]),
+                tripleg(hours[3], hours[4]),
+                staypoint("Home", *HOME, hours[4], hours[5]),
+            ]
+        write_kml(os.path.join(kml_dir, f"history-{day.strftime('%Y-%m-%d')}.kml"), placemarks)
+
+
+def test_iter_kml_chunks(tmp_path):
+    write_timeline(str(tmp_path))
+    kml_path = str(tmp_path / "history-2024-01-01.kml")
+    chunks = list(iter_kml_chunks(kml_path, chunk_size=2))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), parse_kml(kml_path))
+
+
+def test_parse_kml_mixed_timestamp_formats(tmp_path):
+    kml_path = str(tmp_path / "history.kml")
+    placemarks = [
+        staypoint("Home", *HOME, "2024-01-01T00:00:00Z", "2024-01-01T08:00:00Z"),
+        staypoint("Work", *WORK, "2024-01-01T08:30:00.000Z", "2024-01-01T17:00:00.250Z"),
+    ]
+    write_kml(kml_path, placemarks)
+
+    gdf = parse_kml(kml_path)
+    assert gdf["time_start"].tolist() == [
+        pd.Timestamp("2024-01-01 00:00", tz="UTC"),
+        pd.Timestamp("2024-01-01 08:30", tz="UTC"),
+    ]
+    assert gdf["time_end"].iloc[1] == pd.Timestamp("2024-01-01 17:00:00.250", tz="UTC")
+
+
+@pytest.mark.parametrize("chunk_size", [2, 3, 5, 10])
+def test_load_kml_dir_chunk_sizes(tmp_path, chunk_size):
+    # chunks of the last days contain no triplegs
+    write_timeline(str(tmp_path))
+    sp, tpls = load_trackintel_from_kml_dir(str(tmp_path), chunk_size=chunk_size)
+    expected_sp, expected_tpls = load_trackintel_from_kml_dir(str(tmp_path))
+
+    assert len(sp) == 7 * 3 + 3 and len(tpls) == 7 * 2
+    pd.testing.assert_frame_equal(sp, expected_sp)
+    pd.testing.assert_frame_equal(tpls, expected_tpls)
+
+
+@pytest.mark.parametrize("chunk_size", [5, 100_000])
+def test_load_kml_dir_parallel(tmp_path, chunk_size):
+    write_timeline(str(tmp_path))
+    sp, tpls = load_trackintel_from_kml_dir(str(tmp_path), chunk_size=chunk_size, n_workers=2)
+    expected_sp, expected_tpls = load_trackintel_from_kml_dir(str(tmp_path), chunk_size=chunk_size)
+
+    # the same ids as for serial parsing
+    pd.testing.assert_frame_equal(sp, expected_sp)
+    pd.testing.assert_frame_equal(tpls, expected_tpls)
+
+
+def test_load_kml_dir_cache(tmp_path, monkeypatch):
+    kml_dir, cache_dir = str(tmp_path / "kml"), str(tmp_path / "cache")
+    write_timeline(kml_dir)
+    expected_sp, expected_tpls = load_trackintel_from_kml_dir(kml_dir, chunk_size=5)
+
+    parsed = []
+
+    def iter_kml_chunks_counted(kml_path, chunk_size):
+        parsed.append(os.path.basename(kml_path))
+        return iter_kml_chunks(kml_path, chunk_size)
+
+    monkeypatch.setattr(io, "iter_kml_chunks", iter_kml_chunks_counted)
+    load_trackintel_from_kml_dir(kml_dir, chunk_size=5, cache_dir=cache_dir)
+    assert len(parsed) == 10
+
+    # nothing changed: the staypoints and triplegs are loaded from the cache
+    sp, tpls = load_trackintel_from_kml_dir(kml_dir, chunk_size=5, cache_dir=cache_dir)
+    assert len(parsed) == 10
+    pd.testing.assert_frame_equal(sp, expected_sp)
+    pd.testing.assert_frame_equal(tpls, expected_tpls)
+
+    # only the changed file is parsed again
+    changed = os.path.join(kml_dir, "history-2024-01-05.kml")
+    with open(changed, "r") as infile:
+        content = infile.read()
+    with open(changed, "w") as outfile:
+        outfile.write(content.replace("Work", "Office"))
+    sp, tpls = load_trackintel_from_kml_dir(kml_dir, chunk_size=5, cache_dir=cache_dir)
+    assert parsed[10:] == ["history-2024-01-05.kml"]
+    assert (sp["label"] == "Office").sum() == 1
+    pd.testing.assert_frame_equal(tpls, expected_tpls)
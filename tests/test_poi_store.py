@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+
+from activity_llm.poi_store import TiledSurroundingPOI, lonlat_to_tile, write_poi_tiles
+from activity_llm.surrounding_poi import OfflineSurroundingPOI, top_k_pois
+
+# POIs and queries spread over several tiles
+EXTENT = 0.03
+
+
+def test_tiled_store_matches_offline_lookup(tmp_path, make_pois, make_queries):
+    pois = make_pois(1000, extent=EXTENT)
+    store_dir, poi_path = str(tmp_path / "tiles"), str(tmp_path / "pois_test_osm.geojson")
+    write_poi_tiles(pois, store_dir)
+    pois.to_file(poi_path, driver="GeoJSON")
+    lons, lats = make_queries(100, extent=EXTENT)
+    # the queries touch several tiles
+    assert len(set(zip(*lonlat_to_tile(lons, lats)))) > 4
+
+    tiled = TiledSurroundingPOI(radius=200, store_dir=store_dir)
+    offline = OfflineSurroundingPOI(radius=200, poi_paths=poi_path)
+    results = tiled.query_many(lons, lats, k=5)
+    assert sum(len(result) for result in results) > 0
+    for result, expected in zip(results, offline.query_many(lons, lats, k=5)):
+        assert list(result["name"]) == list(expected["name"])
+        np.testing.assert_allclose(result["distance"], expected["distance"])
+        # plain strings as the other backends, although the tiles store categoricals
+        assert not any(isinstance(dtype, pd.CategoricalDtype) for dtype in result.dtypes)
+
+    single = tiled(lons[0], lats[0])
+    assert single["name"].tolist() == top_k_pois(offline(lons[0], lats[0]))["name"].tolist()
+    assert tiled.query_many([], []) == []
+
+
+def test_tiled_store_loads_tiles_lazily(tmp_path, make_pois, make_queries):
+    store_dir = str(tmp_path / "tiles")
+    write_poi_tiles(make_pois(1000, extent=EXTENT), store_dir)
+    lons, lats = make_queries(100, extent=EXTENT)
+    n_tiles = len(set(zip(*lonlat_to_tile(lons, lats))))
+
+    tiled = TiledSurroundingPOI(radius=10, store_dir=store_dir, max_tiles=2)
+    tiled.query_many(lons[:1], lats[:1])
+    assert tiled.store.tiles_loaded == 1
+
+    tiled.query_many(lons, lats)
+    # least recently used tiles are dropped and loaded again when needed
+    assert len(tiled.store.tiles) == 2
+    assert tiled.store.tiles_loaded >= n_tiles
+
+
+def test_write_poi_tiles_merges_existing_tiles(tmp_path, make_pois, make_queries):
+    store_dir = str(tmp_path / "tiles")
+    pois = make_pois(1000, extent=EXTENT)
+    # two overlapping cities
+    write_poi_tiles(pois.iloc[:600], store_dir)
+    write_poi_tiles(pois.iloc[400:], store_dir)
+
+    lons, lats = make_queries(100, extent=EXTENT)
+    merged = TiledSurroundingPOI(radius=200, store_dir=store_dir).query_many(lons, lats)
+    write_poi_tiles(pois, str(tmp_path / "all"))
+    expected = TiledSurroundingPOI(radius=200, store_dir=str(tmp_path / "all")).query_many(lons, lats)
+    for result, expected_result in zip(merged, expected):
+        assert sorted(result["name"]) == sorted(expected_result["name"])
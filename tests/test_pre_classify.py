@@ -0,0 +1,100 @@
+import pandas as pd
+import pytest
+
+from activity_llm.pre_classify import PreClassifier, is_open
+from activity_llm.surrounding_poi import POI_COLUMNS
+
+# a Monday
+MONDAY = pd.Timestamp("2024-01-01")
+
+
+@pytest.mark.parametrize(
+    "opening_hours, time, expected",
+    [
+        ("Mo-Fr 08:00-18:00", "2024-01-01 12:00", True),
+        ("Mo-Fr 08:00-18:00", "2024-01-01 18:00", False),
+        ("Mo-Fr 08:00-18:00", "2024-01-06 12:00", False),
+        ("Mo-Fr 08:00-18:00; Sa 09:00-12:00", "2024-01-06 10:00", True),
+        ("Mo-Sa 08:00-12:00,14:00-18:00", "2024-01-01 13:00", False),
+        ("Mo-Sa 08:00-12:00,14:00-18:00", "2024-01-01 15:00", True),
+        # later rules override earlier ones
+        ("Mo-Su 08:00-20:00; Su off", "2024-01-07 12:00", False),
+        # ranges past midnight and day ranges across the end of the week
+        ("Fr-Mo 20:00-02:00", "2024-01-01 01:00", True),
+        ("Fr-Mo 20:00-02:00", "2024-01-02 01:00", False),
+        ("10:00-22:00", "2024-01-03 21:00", True),
+        ("24/7", "2024-01-03 03:00", True),
+    ],
+)
+def test_is_open(opening_hours, time, expected):
+    assert is_open(opening_hours, pd.Timestamp(time)) is expected
+
+
+@pytest.mark.parametrize("opening_hours", ["unknown", "", None, "by appointment"])
+def test_is_open_unknown(opening_hours):
+    assert is_open(opening_hours, MONDAY) is None
+
+
+def make_pois(rows):
+    return pd.DataFrame(rows, columns=POI_COLUMNS)
+
+
+def visit(start: str, hours: float = 1, tz: str = "Europe/Zurich"):
+    started_at = pd.Timestamp(start, tz=tz).tz_convert("UTC")
+    return started_at, started_at + pd.Timedelta(hours=hours)
+
+
+def test_single_close_poi():
+    pre_classifier = PreClassifier(tz="Europe/Zurich")
+    pois = make_pois([["Fitnesspark", "Unknown", "fitness_centre", "Mo-Su 06:00-22:00", 5.0]])
+    place, label, confidence = pre_classifier.classify(pois, *visit("2024-01-01 18:00"))
+    assert (place, label) == ("Fitnesspark", "sport")
+    assert confidence >= 0.7
+
+
+def test_ambiguous_pois():
+    pre_classifier = PreClassifier(tz="Europe/Zurich")
+    pois = make_pois(
+        [
+            ["Cafe Odeon", "cafe", "", "unknown", 10.0],
+            ["Migros", "Unknown", "supermarket", "unknown", 12.0],
+        ]
+    )
+    assert pre_classifier.classify(pois, *visit("2024-01-01 12:00")) is None
+    place, label, confidence = pre_classifier(pois, *visit("2024-01-01 12:00"))
+    assert label in ("eating", "shopping") and confidence < 0.7
+
+
+def test_no_pois():
+    pre_classifier = PreClassifier(tz="Europe/Zurich")
+    pois = make_pois([["Far away", "restaurant", "", "unknown", 80.0]])
+    assert pre_classifier(pois, *visit("2024-01-01 12:00")) == (None, None, 0.0)
+
+
+def test_closed_and_implausible_times():
+    pre_classifier = PreClassifier(tz="Europe/Zurich")
+    pois = make_pois([["Migros", "Unknown", "supermarket", "Mo-Sa 08:00-20:00", 5.0]])
+    _, _, open_confidence = pre_classifier(pois, *visit("2024-01-01 17:00"))
+    # closed and outside of the shopping hours
+    _, _, closed_confidence = pre_classifier(pois, *visit("2024-01-01 23:00"))
+    assert open_confidence >= 0.7 > closed_confidence
+
+
+def test_local_time_zone():
+    pre_classifier = PreClassifier(tz="Asia/Tokyo")
+    pois = make_pois([["Migros", "Unknown", "supermarket", "Mo-Sa 08:00-20:00", 5.0]])
+    # 17:00 in Zurich is 01:00 in Tokyo, when the shop is closed
+    zurich_visit = visit("2024-01-01 17:00")
+    tokyo_visit = visit("2024-01-01 17:00", tz="Asia/Tokyo")
+    assert pre_classifier(pois, *tokyo_visit)[2] > pre_classifier(pois, *zurich_visit)[2]
+
+    with pytest.raises(ValueError):
+        PreClassifier(tz=None)
+
+
+def test_several_visits():
+    pre_classifier = PreClassifier(tz="Europe/Zurich")
+    pois = make_pois([["Fitnesspark", "Unknown", "fitness_centre", "unknown", 5.0]])
+    started_at = pd.Series([visit(f"2024-01-0{day} 18:00")[0] for day in range(1, 4)])
+    finished_at = started_at + pd.Timedelta(hours=1)
+    assert pre_classifier.classify(pois, started_at, finished_at)[1] == "sport"
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+from activity_llm.cache import SQLiteCache
+from activity_llm.llm_backends import CallableChatModel
+from activity_llm.profiling import LATENCY_BUCKETS, estimate_cost, profiler
+from activity_llm.prompt_design import estimate_tokens
+from activity_llm.query_llm import QueryLLM
+
+PROMPT = "Where did the person go?"
+ANSWER = "Place: Cafe Odeon Type: eating Reasoning: lunch time"
+
+
+@pytest.fixture(autouse=True)
+def empty_profiler():
+    profiler.reset()
+    yield
+    profiler.reset()
+
+
+def run_pipeline(tmp_path):
+    cache = SQLiteCache(str(tmp_path / "llm.sqlite"))
+    profiler.track_cache("llm", cache)
+    llm = CallableChatModel(fn=lambda prompt: ANSWER, model_name="gpt-4o")
+    with profiler.stage("query_llm"):
+        query_llm = QueryLLM(None, llm=llm, response_cache=cache)
+        # the second request is answered from the cache
+        assert query_llm.invoke(PROMPT) == ANSWER
+        assert query_llm.invoke(PROMPT) == ANSWER
+
+
+def test_report(tmp_path):
+    run_pipeline(tmp_path)
+    report = profiler.report()
+
+    assert set(report["stages"]) == {"query_llm"} and report["stages"]["query_llm"] > 0
+    latency = report["latencies"]["llm"]
+    assert latency["count"] == 1
+    assert latency["p50"] == latency["max"] == latency["total"]
+    assert list(latency["buckets"]) == [str(bound) for bound in LATENCY_BUCKETS]
+    assert latency["buckets"][str(LATENCY_BUCKETS[-1])] == 1
+
+    # tokens and cost of the one request that was sent (estimated, since the stub reports no usage)
+    prompt_tokens, completion_tokens = estimate_tokens(PROMPT), estimate_tokens(ANSWER)
+    assert report["counters"] == {
+        'llm_prompt_tokens{model="gpt-4o"}': prompt_tokens,
+        'llm_completion_tokens{model="gpt-4o"}': completion_tokens,
+        'llm_cost_usd{model="gpt-4o"}': pytest.approx(estimate_cost("gpt-4o", prompt_tokens, completion_tokens)),
+    }
+    assert report["counters"]['llm_cost_usd{model="gpt-4o"}'] > 0
+    assert report["caches"] == {"llm": {"hits": 1, "misses": 1, "hit_rate": 0.5, "entries": 1}}
+
+    profiler.save_json(str(tmp_path / "profile.json"))
+    with open(tmp_path / "profile.json", "r") as infile:
+        assert json.load(infile) == report
+
+
+def test_prometheus(tmp_path):
+    run_pipeline(tmp_path)
+    lines = profiler.to_prometheus().splitlines()
+
+    assert any(line.startswith('activity_llm_stage_seconds{stage="query_llm"} ') for line in lines)
+    assert "# TYPE activity_llm_llm_request_seconds histogram" in lines
+    assert 'activity_llm_llm_request_seconds_bucket{le="+Inf"} 1' in lines
+    assert "activity_llm_llm_request_seconds_count 1" in lines
+    assert f'activity_llm_llm_prompt_tokens{{model="gpt-4o"}} {estimate_tokens(PROMPT)}' in lines
+    assert 'activity_llm_cache_hits{cache="llm"} 1' in lines
+    assert 'activity_llm_cache_misses{cache="llm"} 1' in lines
+
+    profiler.save_prometheus(str(tmp_path / "profile.prom"))
+    with open(tmp_path / "profile.prom", "r") as infile:
+        assert infile.read().splitlines() == lines
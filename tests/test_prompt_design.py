@@ -0,0 +1,121 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from activity_llm.prompt_design import (
+    ACTIVITY_LABELS,
+    make_batches,
+    parse_batch_response,
+    estimate_tokens,
+    parse_response,
+    prompt_for_activity,
+    prompt_for_location,
+    prompt_pois_grouped,
+)
+
+
+def make_pois():
+    return pd.DataFrame(
+        {
+            "name": ["Cafe Odeon", "Migros", "Coop", "Migros", "Unnamed"],
+            "amenity_type": ["cafe", "Unknown", "Unknown", "Unknown", "bench"],
+            "details": ["Unknown", "supermarket", "supermarket", "supermarket", "Unknown"],
+            "opening_hours": ["Mo-Fr 08:00-20:00", "unknown", "unknown", "unknown", "unknown"],
+            "distance": [20.0, 50.0, 80.0, 90.0, 5.0],
+        }
+    )
+
+
+def test_prompt_pois_grouped():
+    prompt = prompt_pois_grouped(make_pois(), max_tokens=250)
+    assert prompt == (
+        "Nearby OSM points of interests are:\n"
+        "cafe 20m away: Cafe Odeon (opened Mo-Fr 08:00-20:00);\n"
+        "2x supermarket within 50-80m: Migros, Coop.\n"
+    )
+
+
+def test_prompt_pois_grouped_token_budget():
+    for max_tokens in range(0, 60):
+        prompt = prompt_pois_grouped(make_pois(), max_tokens=max_tokens)
+        assert estimate_tokens(prompt) <= max_tokens or prompt == ""
+        # never an empty list of POIs
+        assert "are.\n" not in prompt
+    # nothing fits but the type of the first group
+    first_line = "Nearby OSM points of interests are:\ncafe 20m away: Cafe Odeon (opened Mo-Fr 08:00-20:00)."
+    short = "Nearby OSM points of interests are: cafe 20m away.\n"
+    max_tokens = estimate_tokens(first_line) - 1
+    assert prompt_pois_grouped(make_pois(), max_tokens=max_tokens) == short
+
+
+def test_prompt_for_activity_numpy_coordinates():
+    started_at, finished_at = pd.Timestamp("2024-01-01 12:05"), pd.Timestamp("2024-01-01 13:00")
+    prompt = prompt_for_activity(np.float64(8.54171), np.float64(47.37692), started_at, finished_at)
+    assert prompt.startswith("Detected at coordinates (8.542, 47.377) on Monday, 2024/01/01 from 12:05 PM")
+
+
+def test_prompt_for_location_numpy_coordinates():
+    started_at = pd.Series(pd.to_datetime(["2024-01-01 12:00", "2024-01-03 12:30", "2024-01-08 13:00"]))
+    finished_at = started_at + pd.Timedelta(minutes=45)
+    prompt = prompt_for_location(np.float64(8.53), np.float64(47.365), started_at, finished_at)
+    assert prompt.startswith("Detected at coordinates (8.53, 47.365). The person visited this location 3 times")
+    assert "Monday: 2, Tuesday: 0, Wednesday: 1" in prompt
+    assert "lasted 45 minutes" in prompt
+
+
+def test_parse_response_text():
+    response = "Place: Cafe Odeon Type: eating Reasoning: The closest POI is a cafe."
+    assert parse_response(response) == ("Cafe Odeon", "eating")
+    # line breaks between the fields
+    assert parse_response("Place:\nCafe Odeon\nType:\neating\nReasoning: lunch time") == ("Cafe Odeon", "eating")
+
+
+def test_parse_response_json():
+    response = json.dumps({"place": "Kunsthaus", "label": "culture", "reasoning": "A museum nearby."})
+    assert parse_response(response) == ("Kunsthaus", "culture")
+
+
+@pytest.mark.parametrize("response", ["", "I am not sure.", "Place: Type: eating", "Place: Cafe Odeon Type:"])
+def test_parse_response_malformed(response):
+    assert parse_response(response) is None
+
+
+def test_parse_response_labels():
+    response = "Place: Cafe Odeon Type: having coffee Reasoning: ..."
+    assert parse_response(response) == ("Cafe Odeon", "having coffee")
+    assert parse_response(response, labels=ACTIVITY_LABELS) is None
+    assert parse_response("Place: Cafe Odeon Type: eating", labels=ACTIVITY_LABELS) == ("Cafe Odeon", "eating")
+
+
+def test_parse_batch_response():
+    response = (
+        "Item 1: Place: Cafe Odeon Type: eating Reasoning: lunch time\n"
+        "**Item 2:** Place: Migros Type: shopping Reasoning: supermarket\n"
+        "Item 3: I cannot tell.\n"
+        "## Item 4:\nPlace: Kunsthaus\nType: culture\nReasoning: museum"
+    )
+    answers = parse_batch_response(response)
+    assert set(answers) == {1, 2, 4}
+    assert parse_response(answers[1]) == ("Cafe Odeon", "eating")
+    assert parse_response(answers[2]) == ("Migros", "shopping")
+    assert parse_response(answers[4]) == ("Kunsthaus", "culture")
+
+
+def test_parse_batch_response_without_items():
+    assert parse_batch_response("Place: Cafe Odeon Type: eating") == {}
+
+
+def test_make_batches_max_batch_size():
+    assert make_batches([10] * 5, max_batch_size=2, token_budget=1000) == [[0, 1], [2, 3], [4]]
+
+
+def test_make_batches_token_budget():
+    assert make_batches([40, 40, 30, 80, 10], max_batch_size=10, token_budget=100) == [[0, 1], [2], [3, 4]]
+
+
+def test_make_batches_large_item():
+    # an item above the budget is sent on its own instead of being dropped
+    assert make_batches([10, 500, 10], max_batch_size=10, token_budget=100) == [[0], [1], [2]]
+    assert make_batches([], max_batch_size=10, token_budget=100) == []
@@ -0,0 +1,227 @@
+import asyncio
+import sys
+import threading
+import time
+from typing import Any
+
+import geopandas as gpd
+import pandas as pd
+import pytest
+from langchain_core.language_models import chat_models
+from pydantic import PrivateAttr
+
+from activity_llm import rate_limit
+from activity_llm.cache import SQLiteCache
+from activity_llm.io import read_jsonl
+from activity_llm.llm_backends import LocalChatModel, RuleBasedChatModel
+from activity_llm.query_llm import QueryLLM
+from activity_llm.surrounding_poi import POI_COLUMNS
+
+N_PROMPTS = 12
+
+
+class RateLimitError(Exception):
+    status_code = 429
+
+
+class SlowChatModel(chat_models.SimpleChatModel):
+    """
+    Fake chat model with injected latency that echoes the prompt. Later prompts answer faster, so that the
+    responses arrive out of order, and the number of concurrent calls is tracked.
+    """
+
+    latency: float = 0.2
+    failures: int = 0
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _calls: int = PrivateAttr(default=0)
+    _active: int = PrivateAttr(default=0)
+    _max_active: int = PrivateAttr(default=0)
+
+    @property
+    def _llm_type(self):
+        return "slow"
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt = messages[-1].content
+        with self._lock:
+            self._calls += 1
+            # the first calls fail with a rate limit error
+            if self._calls <= self.failures:
+                raise RateLimitError("Too many requests")
+            self._active += 1
+            self._max_active = max(self._max_active, self._active)
+        time.sleep(self.latency / (1 + int(prompt.split()[-1])))
+        with self._lock:
+            self._active -= 1
+        return f"Place: {prompt} Type: other Reasoning: echo"
+
+
+def make_prompts(n: int = N_PROMPTS):
+    prompts = [f"prompt {i}" for i in range(n)]
+    return prompts, [f"Place: {prompt} Type: other Reasoning: echo" for prompt in prompts]
+
+
+def test_async_results_in_input_order():
+    prompts, expected = make_prompts()
+    llm = SlowChatModel()
+    query_llm = QueryLLM(None, llm=llm, max_concurrency=4)
+
+    assert query_llm.invoke_many(prompts) == expected
+    assert llm._calls == N_PROMPTS
+    assert 1 < llm._max_active <= 4
+
+
+def test_async_matches_sequential():
+    prompts, expected = make_prompts()
+    sequential = QueryLLM(None, llm=SlowChatModel(latency=0.01), max_concurrency=1)
+    concurrent = QueryLLM(None, llm=SlowChatModel(latency=0.01), max_concurrency=4)
+
+    def callback(i, response):
+        return i, response
+
+    assert concurrent.invoke_many(prompts, callback=callback) == sequential.invoke_many(prompts, callback=callback)
+    assert concurrent.invoke_many(prompts) == expected
+
+
+def test_async_inside_running_loop():
+    # e.g. in a Jupyter notebook
+    prompts, expected = make_prompts()
+    query_llm = QueryLLM(None, llm=SlowChatModel(latency=0.01), max_concurrency=4)
+
+    async def main():
+        return query_llm.invoke_many(prompts)
+
+    assert asyncio.run(main()) == expected
+
+
+def test_async_retries_rate_limit_errors(monkeypatch):
+    monkeypatch.setattr(rate_limit, "backoff_delay", lambda attempt: 0)
+    prompts, expected = make_prompts()
+    llm = SlowChatModel(latency=0.01, failures=3)
+    query_llm = QueryLLM(None, llm=llm, max_concurrency=4, max_retries=3)
+
+    assert query_llm.invoke_many(prompts) == expected
+    assert llm._calls == N_PROMPTS + 3
+
+
+def test_async_rate_limit_errors_after_max_retries(monkeypatch):
+    monkeypatch.setattr(rate_limit, "backoff_delay", lambda attempt: 0)
+    prompts, _ = make_prompts()
+    query_llm = QueryLLM(None, llm=SlowChatModel(latency=0.01, failures=100), max_concurrency=4, max_retries=1)
+
+    with pytest.raises(RateLimitError):
+        query_llm.invoke_many(prompts)
+
+
+def test_callable_backends_have_separate_cache_keys(tmp_path):
+    def answer_eating(prompt):
+        return "Place: Cafe Type: eating Reasoning: ..."
+
+    def answer_shopping(prompt):
+        return "Place: Shop Type: shopping Reasoning: ..."
+
+    cache = SQLiteCache(str(tmp_path / "llm.sqlite"))
+    assert QueryLLM(None, llm=answer_eating, response_cache=cache).invoke("prompt 0").startswith("Place: Cafe")
+    assert QueryLLM(None, llm=answer_shopping, response_cache=cache).invoke("prompt 0").startswith("Place: Shop")
+    assert QueryLLM(None, llm=answer_eating, response_cache=cache).invoke("prompt 0").startswith("Place: Cafe")
+    assert cache.stats()["hits"] == 1
+
+
+class FixedPOIs:
+    """POI finder that returns one cafe next to every point."""
+
+    def query_many(self, lons, lats, k=None):
+        cafe = pd.DataFrame([["Cafe Odeon", "cafe", "", "unknown", 10.0]], columns=POI_COLUMNS)
+        return [cafe for _ in lons]
+
+
+def test_local_backend_names_the_extra(monkeypatch):
+    monkeypatch.setitem(sys.modules, "transformers", None)
+    with pytest.raises(ImportError, match=r"pip install -e \.\[local\]"):
+        LocalChatModel().invoke("Where did the person go?")
+
+
+def test_batched_results_store_the_batch_prompt(tmp_path):
+    started_at = pd.date_range("2024-01-01 12:00", periods=3, freq="D", tz="UTC")
+    staypoints = gpd.GeoDataFrame(
+        {"started_at": started_at, "finished_at": started_at + pd.Timedelta(hours=1)},
+        geometry=gpd.points_from_xy([8.54, 8.55, 8.56], [47.37, 47.38, 47.39]),
+        crs="EPSG:4326",
+    )
+    query_llm = QueryLLM(FixedPOIs(), llm="rule-based", batch_size=2)
+    results = query_llm(staypoints, output_dir=str(tmp_path))
+
+    assert results["label_llm"].tolist() == ["eating"] * 3
+    assert results["batch_item"].tolist() == [1, 2, 1]
+    # the items of a batch share the prompt that was sent, the response is the answer to the item
+    assert results["prompt_llm"].iloc[0] == results["prompt_llm"].iloc[1] != results["prompt_llm"].iloc[2]
+    assert "Item 2:" in results["prompt_llm"].iloc[0]
+    assert not results["response_llm"].str.contains("Item").any()
+
+
+class POIsByLongitude:
+    """POI finder with a cafe west of longitude 8.545 and a gym east of it."""
+
+    def query_many(self, lons, lats, k=None):
+        cafe = pd.DataFrame([["Cafe Odeon", "cafe", "", "unknown", 10.0]], columns=POI_COLUMNS)
+        gym = pd.DataFrame([["Fitnesspark", "fitness_centre", "", "unknown", 10.0]], columns=POI_COLUMNS)
+        return [cafe if lon < 8.545 else gym for lon in lons]
+
+
+def test_query_by_location():
+    prompts = []
+
+    def rule_based(prompt):
+        prompts.append(prompt)
+        return RuleBasedChatModel().label_prompt(prompt)
+
+    # two visits to the cafe, three to the gym and one staypoint without location
+    started_at = pd.date_range("2024-01-01 12:00", periods=6, freq="D", tz="UTC")
+    staypoints = gpd.GeoDataFrame(
+        {
+            "started_at": started_at,
+            "finished_at": started_at + pd.Timedelta(hours=1),
+            "location_id": [0, 1, 0, 1, None, 1],
+        },
+        geometry=gpd.points_from_xy([8.54, 8.55, 8.5401, 8.5501, 8.54, 8.55], [47.37] * 6),
+        crs="EPSG:4326",
+        index=pd.Index([10, 11, 12, 13, 14, 15], name="id"),
+    )
+    results = QueryLLM(POIsByLongitude(), llm=rule_based)(staypoints, group_by_location=True)
+
+    # one query per location, the staypoint without location is queried on its own
+    assert len(prompts) == 3
+    assert sum("visited this location 3 times" in prompt for prompt in prompts) == 1
+    assert results["sp_id"].tolist() == [10, 11, 12, 13, 14, 15]
+    assert results["label_llm"].tolist() == ["eating", "sport", "eating", "sport", "eating", "sport"]
+    assert results["location_id"].iloc[[0, 2]].tolist() == [0, 0]
+
+
+def test_resume_requeries_changed_staypoints(tmp_path):
+    prompts = []
+
+    def rule_based(prompt):
+        prompts.append(prompt)
+        return RuleBasedChatModel().label_prompt(prompt)
+
+    started_at = pd.date_range("2024-01-01 12:00", periods=5, freq="D", tz="UTC")
+    staypoints = gpd.GeoDataFrame(
+        {"started_at": started_at, "finished_at": started_at + pd.Timedelta(hours=1)},
+        geometry=gpd.points_from_xy([8.54 + 0.001 * i for i in range(5)], [47.37] * 5),
+        crs="EPSG:4326",
+        index=pd.Index([10, 11, 12, 13, 14], name="id"),
+    )
+    query_llm = QueryLLM(FixedPOIs(), llm=rule_based)
+    first = query_llm(staypoints, output_dir=str(tmp_path))
+    assert len(prompts) == 5
+
+    # staypoint 11 changed (e.g. after an update of the data), the others are read from the JSONL file
+    staypoints.loc[11, "finished_at"] += pd.Timedelta(hours=2)
+    second = query_llm(staypoints, output_dir=str(tmp_path), resume=True)
+    assert len(prompts) == 6
+    assert "to 03:00 PM" in prompts[-1]
+    assert second["sp_id"].tolist() == [10, 11, 12, 13, 14]
+    unchanged = [0, 2, 3, 4]
+    pd.testing.assert_frame_equal(second.iloc[unchanged], first.iloc[unchanged])
+    assert second["fingerprint"].iloc[1] != first["fingerprint"].iloc[1]
+    assert [res["sp_id"] for res in read_jsonl(str(tmp_path / "results_llm.jsonl"))] == [10, 11, 12, 13, 14, 11]
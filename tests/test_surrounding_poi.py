@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+from activity_llm.surrounding_poi import OfflineSurroundingPOI, POIIndex, SurroundingPOI, top_k_pois
+
+
+def test_query_many_matches_single_queries(tmp_path, make_pois, make_queries):
+    poi_path = str(tmp_path / "pois_test_osm.geojson")
+    make_pois().to_file(poi_path, driver="GeoJSON")
+    poi_finder = OfflineSurroundingPOI(radius=200, poi_paths=poi_path)
+    lons, lats = make_queries()
+
+    results = poi_finder.query_many(lons, lats)
+    assert len(results) == len(lons)
+    assert sum(len(result) for result in results) > 0
+    for lon, lat, result in zip(lons, lats, results):
+        pd.testing.assert_frame_equal(result, top_k_pois(poi_finder(lon, lat)))
+
+    # only the k closest POIs
+    for result, closest in zip(poi_finder.query_many(lons, lats, k=3), results):
+        pd.testing.assert_frame_equal(result, closest.iloc[:3])
+
+
+def test_query_many_without_points(tmp_path, make_pois):
+    poi_path = str(tmp_path / "pois_test_osm.geojson")
+    make_pois().to_file(poi_path, driver="GeoJSON")
+    poi_finder = OfflineSurroundingPOI(radius=200, poi_paths=poi_path)
+    assert poi_finder.query_many([], []) == []
+
+    pois = make_pois()
+    index = POIIndex(pd.DataFrame({"lon": pois.geometry.x, "lat": pois.geometry.y, "name": pois["name"]}))
+    assert index.query_many(np.array([]), np.array([]), []) == []
+
+
+class FakeOverpassPOI(SurroundingPOI):
+    """Answers the Overpass queries from nodes in memory and counts them."""
+
+    def __init__(self, nodes, **kwargs):
+        super().__init__(**kwargs)
+        self.nodes = nodes
+        self.n_queries = 0
+
+    def fetch_nodes(self, bbox):
+        self.n_queries += 1
+        min_lat, min_lon, max_lat, max_lon = bbox
+        return [
+            node
+            for node in self.nodes
+            if min_lat <= node["lat"] <= max_lat and min_lon <= node["lon"] <= max_lon
+        ]
+
+
+def test_query_many_bulk_matches_single_queries(make_pois, make_queries):
+    pois = make_pois()
+    nodes = [
+        {"lon": point.x, "lat": point.y, "tags": {"name": name, "amenity": poi_type}}
+        for point, name, poi_type in zip(pois.geometry, pois["name"], pois["poi_type"])
+    ]
+    lons, lats = make_queries(50)
+    single = FakeOverpassPOI(nodes, radius=200)
+    bulk = FakeOverpassPOI(nodes, radius=200, bulk=True, tile_size=500)
+
+    expected = single.query_many(lons, lats, k=5)
+    results = bulk.query_many(lons, lats, k=5)
+    # one query per tile instead of one per point
+    assert single.n_queries == 50
+    assert 1 < bulk.n_queries < 50
+    assert sum(len(result) for result in results) > 0
+    for result, closest in zip(results, expected):
+        if len(closest) == 0:
+            # empty frames only differ in the inferred dtypes
+            assert len(result) == 0 and list(result.columns) == list(closest.columns)
+        else:
+            pd.testing.assert_frame_equal(result, closest)
+
+    # tiles without POIs
+    assert all(len(result) == 0 for result in FakeOverpassPOI([], radius=200, bulk=True).query_many(lons, lats))